@@ -1,36 +1,52 @@
+import sys
+# `python app.py` runs this file as __main__; register it as `app` too, so the lazy
+# `from app import ...` in routes and helpers gets this module instead of executing app.py a
+# second time (a second db, second models and a second scheduler in the same process)
+if __name__ == '__main__':
+    sys.modules.setdefault('app', sys.modules[__name__])
+
 from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from scheduler import start_scheduler
+from scheduler import start_scheduler, scheduler_enabled, schedule_job, unschedule_job
+from utils.feed_config import feed_config, init_feed_config, get_feed_ratio, set_feed_ratio
+from utils.metrics import init_metrics, DISPENSE_TOTAL, IOT_ROUND_TRIP, SCHEDULER_LAG
+from utils.profiler import init_profiler, get_profiles
+from utils.device_registry import registry as device_registry, init_registry
+from utils import timeseries
 from datetime import datetime, time, timedelta
 import os
-import requests
 import json
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
-import atexit
-# Load environment variables from .env
-from dotenv import load_dotenv
-load_dotenv()
+import secrets
 
 db = SQLAlchemy()
 login_manager = LoginManager()
 
 def create_app():
+    # Load environment variables from .env (optional in production, where env is set by the process manager)
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
     app = Flask(__name__, instance_relative_config=True)
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'secret_key')
     app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'uploads')
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(app.instance_path, 'chickenfeeder.sqlite')
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv(
+        'DATABASE_URL', 'sqlite:///' + os.path.join(app.instance_path, 'chickenfeeder.sqlite'))
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
     db.init_app(app)
     login_manager.init_app(app)
     login_manager.login_view = 'login'
+    init_metrics(app)
+    init_profiler(app)
 
     # Ensure instance folder exists
     os.makedirs(app.instance_path, exist_ok=True)
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    timeseries.init_timeseries(app)
 
     # Register blueprints
     from routes.api import api_bp
@@ -56,11 +72,6 @@ app = create_app()
 def load_user(user_id):
     return db.session.get(User, int(user_id))
 
-# Initialize scheduler for automated feeding
-scheduler = BackgroundScheduler()
-scheduler.start()
-atexit.register(lambda: scheduler.shutdown())
-
 # Database Models
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -69,7 +80,24 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(120), nullable=False)
     is_admin = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    iot_device_url = db.Column(db.String(255), nullable=True)  # IoT device association
+    iot_device_url = db.Column(db.String(255), nullable=True)  # Legacy; migrated to Device rows
+
+class Device(db.Model):
+    """A feeder; a user may own many. Looked up through utils.device_registry at dispatch time."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    name = db.Column(db.String(100), nullable=False)
+    device_key = db.Column(db.String(100), unique=True, nullable=False)  # e.g. codesiot config device_id
+    url = db.Column(db.String(255), nullable=True)  # dispense endpoint
+    status = db.Column(db.String(20), default='unknown')  # 'unknown', 'online' or 'offline'
+    last_seen = db.Column(db.DateTime, nullable=True)
+    telemetry = db.Column(db.Text, nullable=True)  # JSON from the latest heartbeat
+    api_token = db.Column(db.String(64), unique=True, nullable=False, default=lambda: secrets.token_urlsafe(32))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    user = db.relationship('User', backref=db.backref('devices', lazy=True, cascade='all, delete-orphan'))
+
+init_registry(db, Device)
 
 class FeedSchedule(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -78,9 +106,13 @@ class FeedSchedule(db.Model):
     amount_grams = db.Column(db.Integer, nullable=False)
     is_active = db.Column(db.Boolean, default=True)
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    device_id = db.Column(db.Integer, db.ForeignKey('device.id'), nullable=True)  # None = user's default device
+    auto_adjust = db.Column(db.Boolean, default=False)  # opt-in: amount adapted nightly to leftover counts
+    adjusted_at = db.Column(db.DateTime, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     user = db.relationship('User', backref=db.backref('schedules', lazy=True))
+    device = db.relationship('Device', backref=db.backref('schedules', lazy=True))
 
 class DispenseLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -91,10 +123,35 @@ class DispenseLog(db.Model):
     status = db.Column(db.String(20), default='success')  # 'success' or 'failure'
     error_message = db.Column(db.Text, nullable=True)
     triggered_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    device_id = db.Column(db.Integer, db.ForeignKey('device.id'), nullable=True)
     
     schedule = db.relationship('FeedSchedule', backref=db.backref('dispense_logs', lazy=True))
+    device = db.relationship('Device', backref=db.backref('dispense_logs', lazy=True))
     user = db.relationship('User', backref=db.backref('dispense_logs', lazy=True))
 
+class PelletCount(db.Model):
+    """A leftover count from /api/count_pellets; schedule_id is set when it followed that schedule's dispense"""
+    id = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+    device_id = db.Column(db.Integer, db.ForeignKey('device.id'), nullable=True)
+    schedule_id = db.Column(db.Integer, db.ForeignKey('feed_schedule.id'), nullable=True, index=True)
+    dispense_log_id = db.Column(db.Integer, db.ForeignKey('dispense_log.id'), nullable=True)
+    pellet_count = db.Column(db.Float, nullable=False)
+    leftover_grams = db.Column(db.Float, nullable=False)
+    remaining_grams = db.Column(db.Float, nullable=True)  # next schedule's amount minus the leftover
+
+class FeedRatio(db.Model):
+    """Per-user pellets-to-grams override of the global ratio in config.json"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), unique=True, nullable=False)
+    pellets = db.Column(db.Integer, nullable=False)
+    grams = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    user = db.relationship('User', backref=db.backref('feed_ratio', uselist=False, cascade='all, delete-orphan'))
+
+init_feed_config(db, FeedRatio)
+
 @app.context_processor
 def inject_datetime():
     return {'datetime': datetime}
@@ -118,16 +175,20 @@ def communicate_with_iot_device(amount_grams, device_url=None):
         return False, str(e)
 
 
-def dispense_feed(amount_grams, trigger_type='manual', schedule_id=None, user_id=None):
+def dispense_feed(amount_grams, trigger_type='manual', schedule_id=None, user_id=None, device_id=None):
     """
     Core function to dispense feed and log the action
+    The target device (explicit device_id, else the user's default) comes from the in-memory registry.
     """
-    device_url = None
-    if user_id:
-        user = db.session.get(User, user_id)
-        if user:
-            device_url = user.iot_device_url
-    success, error_message = communicate_with_iot_device(amount_grams, device_url)
+    device = device_registry.resolve(device_id, user_id)
+    device_url = device.url if device else None
+    with IOT_ROUND_TRIP.time(device=device.device_key if device else 'none'):
+        success, error_message = communicate_with_iot_device(amount_grams, device_url)
+    DISPENSE_TOTAL.inc(trigger_type=trigger_type, status='success' if success else 'failure')
+    if success:
+        timeseries.record('dispensed_grams', amount_grams, device_id=device.id if device else None)
+    else:
+        timeseries.record('dispense_failures', 1, device_id=device.id if device else None)
     # Log the dispense action
     log_entry = DispenseLog(
         amount_grams=amount_grams,
@@ -135,7 +196,8 @@ def dispense_feed(amount_grams, trigger_type='manual', schedule_id=None, user_id
         schedule_id=schedule_id,
         status='success' if success else 'failure',
         error_message=error_message,
-        triggered_by=user_id
+        triggered_by=user_id,
+        device_id=device.id if device else None
     )
     db.session.add(log_entry)
     db.session.commit()
@@ -145,19 +207,33 @@ def scheduled_feed_task(schedule_id):
     """
     Task executed by scheduler for automatic feeding
     """
+    fired_at = datetime.now()
     with app.app_context():
         schedule = db.session.get(FeedSchedule, schedule_id)
         if schedule and schedule.is_active:
+            # Lag of the actual fire time behind today's planned feed_time (cron runs in local time)
+            planned = datetime.combine(fired_at.date(), schedule.feed_time)
+            if planned > fired_at:
+                planned -= timedelta(days=1)
+            SCHEDULER_LAG.observe((fired_at - planned).total_seconds())
             success, error_message, log_id = dispense_feed(
                 amount_grams=schedule.amount_grams,
                 trigger_type='scheduled',
                 schedule_id=schedule_id,
-                user_id=schedule.created_by
+                user_id=schedule.created_by,
+                device_id=schedule.device_id
             )
             if not success:
                 # Here you could implement email/SMS notifications
                 print(f"Scheduled feed failed: {error_message}")
 
+def adjust_schedules_task():
+    """
+    Nightly task run by the scheduler: adapt auto-adjust schedule amounts to recent leftover counts
+    """
+    from utils.adaptive_feeding import adjust_schedule_amounts
+    return adjust_schedule_amounts(db, FeedSchedule, PelletCount)
+
 # Routes
 @app.route('/')
 def index():
@@ -215,6 +291,8 @@ def register():
             iot_device_url=iot_device_url
         )
         db.session.add(user)
+        db.session.flush()
+        sync_default_device(user, iot_device_url)
         db.session.commit()
         flash('Account created. You may now log in.')
         return redirect(url_for('login'))
@@ -263,6 +341,8 @@ def admin_create_user():
             iot_device_url=iot_device_url
         )
         db.session.add(u)
+        db.session.flush()
+        sync_default_device(u, iot_device_url)
         db.session.commit()
         flash('User created successfully.')
         return redirect(url_for('admin_dashboard'))
@@ -297,6 +377,7 @@ def admin_edit_user(user_id):
         user.is_admin = is_admin
         if iot_device_url:
             user.iot_device_url = iot_device_url
+            sync_default_device(user, iot_device_url)
         if password:
             user.password_hash = generate_password_hash(password)
         db.session.commit()
@@ -332,6 +413,17 @@ def admin_delete_user(user_id):
         flash('Error deleting user.')
     return redirect(url_for('admin_dashboard'))
 
+@app.route('/admin/profiles')
+@login_required
+def admin_profiles():
+    if not require_admin():
+        return redirect(url_for('dashboard'))
+    profiles = get_profiles()
+    if request.args.get('format') == 'json':
+        return jsonify(profiles)
+    return render_template('admin/profiles.html', profiles=profiles,
+                           enabled=float(os.getenv('PROFILE_SAMPLE_RATE', '0')) > 0)
+
 @app.route('/dashboard')
 @login_required
 def dashboard():
@@ -356,7 +448,8 @@ def dashboard():
 @login_required
 def schedules():
     schedules = FeedSchedule.query.filter_by(created_by=current_user.id).order_by(FeedSchedule.feed_time).all()
-    return render_template('schedules.html', schedules=schedules)
+    devices = {d.id: d for d in device_registry.for_user(current_user.id)}
+    return render_template('schedules.html', schedules=schedules, devices=devices)
 
 @app.route('/schedules/add', methods=['GET', 'POST'])
 @login_required
@@ -366,9 +459,17 @@ def add_schedule():
         feed_time_str = request.form['feed_time']
         amount_grams = int(request.form['amount_grams'])
         
+        device_id = request.form.get('device_id', type=int)
+        auto_adjust = request.form.get('auto_adjust') == 'on'
+        
         # Parse time
         feed_time = datetime.strptime(feed_time_str, '%H:%M').time()
         
+        device = device_registry.get(device_id) if device_id else None
+        if device_id and (device is None or device.user_id != current_user.id):
+            flash('Unknown device.')
+            return redirect(url_for('add_schedule'))
+        
         # --- Limit: 20-150 grams per feeding ---
         if amount_grams < 20 or amount_grams > 150:
             flash('Amount must be between 20 and 150 grams (for 1-5 chickens, 20-30g each).')
@@ -378,25 +479,21 @@ def add_schedule():
             name=name,
             feed_time=feed_time,
             amount_grams=amount_grams,
-            created_by=current_user.id
+            created_by=current_user.id,
+            device_id=device_id,
+            auto_adjust=auto_adjust
         )
         
         db.session.add(schedule)
         db.session.commit()
         
-        # Add to scheduler
-        scheduler.add_job(
-            func=scheduled_feed_task,
-            trigger=CronTrigger(hour=feed_time.hour, minute=feed_time.minute),
-            args=[schedule.id],
-            id=f'schedule_{schedule.id}',
-            replace_existing=True
-        )
+        # Add to scheduler (other processes pick it up on the scheduler's next DB resync)
+        schedule_job(schedule)
         
         flash('Schedule added successfully!')
         return redirect(url_for('schedules'))
     
-    return render_template('add_schedule.html')
+    return render_template('add_schedule.html', devices=device_registry.for_user(current_user.id))
 
 @app.route('/schedules/<int:schedule_id>/delete', methods=['POST'])
 @login_required
@@ -410,10 +507,7 @@ def delete_schedule(schedule_id):
         return redirect(url_for('schedules'))
     
     # Remove from scheduler
-    try:
-        scheduler.remove_job(f'schedule_{schedule_id}')
-    except:
-        pass
+    unschedule_job(schedule_id)
     
     db.session.delete(schedule)
     db.session.commit()
@@ -435,18 +529,9 @@ def toggle_schedule(schedule_id):
     
     # Update scheduler
     if schedule.is_active:
-        scheduler.add_job(
-            func=scheduled_feed_task,
-            trigger=CronTrigger(hour=schedule.feed_time.hour, minute=schedule.feed_time.minute),
-            args=[schedule.id],
-            id=f'schedule_{schedule.id}',
-            replace_existing=True
-        )
+        schedule_job(schedule)
     else:
-        try:
-            scheduler.remove_job(f'schedule_{schedule_id}')
-        except:
-            pass
+        unschedule_job(schedule_id)
     
     return jsonify({'success': True, 'is_active': schedule.is_active})
 
@@ -459,15 +544,21 @@ def manual_dispense():
     """
     data = request.get_json()
     amount_grams = data.get('amount', 0)
+    device_id = data.get('device_id')
     
     # --- Limit: 20-150 grams per feeding ---
     if amount_grams < 20 or amount_grams > 150:
         return jsonify({'error': 'Invalid amount. Must be between 20 and 150 grams (for 1-5 chickens, 20-30g each)'}), 400
+    if device_id is not None:
+        device = device_registry.get(device_id)
+        if device is None or device.user_id != current_user.id:
+            return jsonify({'error': 'Unknown device'}), 404
     
     success, error_message, log_id = dispense_feed(
         amount_grams=amount_grams,
         trigger_type='manual',
-        user_id=current_user.id
+        user_id=current_user.id,
+        device_id=device_id
     )
     
     if success:
@@ -481,7 +572,59 @@ def manual_dispense():
             'success': False,
             'error': error_message
         }), 500
-        start_scheduler()
+
+@app.route('/devices')
+@login_required
+def devices():
+    user_devices = Device.query.filter_by(user_id=current_user.id).order_by(Device.id).all()
+    return render_template('devices.html', devices=user_devices)
+
+@app.route('/devices/add', methods=['POST'])
+@login_required
+def add_device():
+    name = request.form.get('name', '').strip()
+    device_key = request.form.get('device_key', '').strip()
+    url = request.form.get('url', '').strip()
+    if not name or not device_key:
+        flash('Device name and ID are required.')
+        return redirect(url_for('devices'))
+    if Device.query.filter_by(device_key=device_key).first():
+        flash('Device ID already registered.')
+        return redirect(url_for('devices'))
+    db.session.add(Device(user_id=current_user.id, name=name, device_key=device_key, url=url or None))
+    db.session.commit()
+    flash('Device added.')
+    return redirect(url_for('devices'))
+
+@app.route('/devices/<int:device_id>/edit', methods=['POST'])
+@login_required
+def edit_device(device_id):
+    device = db.session.get(Device, device_id)
+    if not device or device.user_id != current_user.id:
+        flash('Device not found.')
+        return redirect(url_for('devices'))
+    device.name = request.form.get('name', device.name).strip() or device.name
+    device.url = request.form.get('url', '').strip() or None
+    if request.form.get('regenerate_token'):
+        device.api_token = secrets.token_urlsafe(32)
+    db.session.commit()
+    flash('Device updated.')
+    return redirect(url_for('devices'))
+
+@app.route('/devices/<int:device_id>/delete', methods=['POST'])
+@login_required
+def delete_device(device_id):
+    device = db.session.get(Device, device_id)
+    if not device or device.user_id != current_user.id:
+        flash('Device not found.')
+        return redirect(url_for('devices'))
+    # Schedules fall back to the user's default device; history keeps the log rows
+    FeedSchedule.query.filter_by(device_id=device.id).update({'device_id': None})
+    DispenseLog.query.filter_by(device_id=device.id).update({'device_id': None})
+    db.session.delete(device)
+    db.session.commit()
+    flash('Device deleted.')
+    return redirect(url_for('devices'))
 
 @app.route('/logs')
 @login_required
@@ -534,54 +677,93 @@ def create_admin_user():
         db.session.add(admin)
         db.session.commit()
 
-def setup_scheduled_jobs():
-    """Setup all active schedules in the scheduler"""
-    active_schedules = FeedSchedule.query.filter_by(is_active=True).all()
-    for schedule in active_schedules:
-        scheduler.add_job(
-            func=scheduled_feed_task,
-            trigger=CronTrigger(hour=schedule.feed_time.hour, minute=schedule.feed_time.minute),
-            args=[schedule.id],
-            id=f'schedule_{schedule.id}',
-            replace_existing=True
-        )
-
-CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'config.json')
-
-def get_feed_ratio():
-    if not os.path.exists(CONFIG_PATH):
-        return {'pellets': 50, 'grams': 10}
-    with open(CONFIG_PATH, 'r') as f:
-        return json.load(f)
-
-def set_feed_ratio(pellets, grams):
-    with open(CONFIG_PATH, 'w') as f:
-        json.dump({'pellets': pellets, 'grams': grams}, f)
+def sync_default_device(user, url):
+    """Point the user's default device at `url`, creating it if needed (legacy iot_device_url forms)"""
+    if not url:
+        return None
+    device = Device.query.filter_by(user_id=user.id).order_by(Device.id).first()
+    if device is None:
+        device = Device(user_id=user.id, name='Feeder', device_key=f'user{user.id}-feeder')
+        db.session.add(device)
+    device.url = url
+    return device
+
+def upgrade_schema():
+    """
+    create_all() plus a minimal SQLite-friendly migration:
+    - ADD COLUMN for model columns missing from existing tables (new columns are nullable)
+    - schedules from before auto_adjust existed are opted out (NULL -> False)
+    - one Device per user that only has the legacy iot_device_url
+    """
+    db.create_all()
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                col_type = column.type.compile(dialect=db.engine.dialect)
+                db.session.execute(db.text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {col_type}'))
+                print(f"🛠️ Added column {table.name}.{column.name}")
+    FeedSchedule.query.filter(FeedSchedule.auto_adjust.is_(None)).update(
+        {'auto_adjust': False}, synchronize_session=False)
+    db.session.commit()
+    
+    legacy_users = User.query.filter(User.iot_device_url.isnot(None), User.iot_device_url != '',
+                                     ~User.devices.any()).all()
+    for user in legacy_users:
+        sync_default_device(user, user.iot_device_url)
+    if legacy_users:
+        db.session.commit()
+        print(f"🛠️ Migrated {len(legacy_users)} legacy device URLs")
 
 @app.route('/admin/feed-ratio', methods=['GET', 'POST'])
 @login_required
 def admin_feed_ratio():
     if not require_admin():
         return redirect(url_for('dashboard'))
-    ratio = get_feed_ratio()
+    user_id = request.values.get('user_id', type=int)
     if request.method == 'POST':
         try:
+            if user_id and request.form.get('clear'):
+                feed_config.clear_override(user_id)
+                flash('User ratio override removed.', 'success')
+                return redirect(url_for('admin_feed_ratio'))
             pellets = int(request.form.get('pellets', 50))
             grams = float(request.form.get('grams', 10))
             if pellets <= 0 or grams <= 0:
                 flash('Values must be positive.', 'danger')
             else:
-                set_feed_ratio(pellets, grams)
+                set_feed_ratio(pellets, grams, user_id=user_id)
                 flash('Feed-to-gram ratio updated!', 'success')
-                return redirect(url_for('admin_feed_ratio'))
+                return redirect(url_for('admin_feed_ratio', user_id=user_id))
         except Exception:
             flash('Invalid input.', 'danger')
-    return render_template('admin/feed_ratio.html', ratio=ratio)
+    ratio = get_feed_ratio(user_id)
+    users = User.query.order_by(User.username).all()
+    overrides = FeedRatio.query.all()
+    return render_template('admin/feed_ratio.html', ratio=ratio, users=users,
+                           overrides=overrides, selected_user_id=user_id)
+
+def run_scheduler():
+    """
+    The only way this app starts the scheduler; start_scheduler() is once-per-process, so
+    reaching it from both the import path and the __main__ path still starts one scheduler
+    """
+    return start_scheduler(app, scheduled_feed_task, FeedSchedule, nightly_task=adjust_schedules_task)
+
+# Only the designated process (RUN_SCHEDULER=1) runs scheduled feeds; web workers never start it.
+# Imported as `app` (gunicorn app:app); under `python app.py` this module stays __main__ (see the
+# sys.modules alias at the top) and the __main__ block below starts it instead. Spawned inference
+# workers re-import __main__ as __mp_main__ and never start it.
+if scheduler_enabled() and __name__ == 'app':
+    run_scheduler()
 
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        upgrade_schema()
         create_admin_user()
-        setup_scheduled_jobs()
     
+    # With the debug reloader, only the serving child process starts the scheduler
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        run_scheduler()
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Import-time / worker boot benchmark
+- Imports a module (default: app) in fresh interpreters and records wall time and peak RSS
+- Uses `python -X importtime` to list the slowest imports (cumulative)
+- Reports which heavy modules (torch, APScheduler, requests, ...) were pulled in by the import
+- Fails (exit code 1) when boot time or RSS regress beyond a threshold vs. a stored baseline
+
+Usage:
+    python bench_startup.py                       # python -c "import app" x5
+    python bench_startup.py --module routes.api --runs 10
+    python bench_startup.py --save-baseline       # record startup_baseline.json
+    python bench_startup.py --baseline startup_baseline.json --max-regression 0.2
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import subprocess
+
+
+HEAVY_MODULES = ('torch', 'torchvision', 'cv2', 'numpy', 'apscheduler', 'requests', 'dotenv', 'matplotlib')
+
+# Child process: import the module, then report which heavy modules got loaded and peak RSS
+PROBE = '''
+import sys, json, resource, importlib
+importlib.import_module({module!r})
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform == 'darwin':
+    rss //= 1024
+print(json.dumps({{'rss_kb': rss, 'loaded': sorted(m for m in {heavy!r} if m in sys.modules)}}))
+'''
+
+
+def _child_env():
+    env = dict(os.environ)
+    # Never start the scheduler or touch a real database while benchmarking
+    env.pop('RUN_SCHEDULER', None)
+    env.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'bench_startup.sqlite'))
+    return env
+
+
+def measure_once(module):
+    code = PROBE.format(module=module, heavy=HEAVY_MODULES)
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                            env=_child_env(), cwd=os.path.dirname(os.path.abspath(__file__)))
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+    probe = json.loads(result.stdout.strip().splitlines()[-1])
+    return elapsed, probe
+
+
+def slowest_imports(module, top=15):
+    """[(cumulative_us, module_name)] from -X importtime, slowest first"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, env=_child_env(),
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        # "import time:  self_us | cumulative_us | [indent]name"
+        _, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        rows.append((int(cumulative_us), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def run_benchmark(module, runs):
+    times, rss, loaded = [], [], []
+    for _ in range(runs):
+        elapsed, probe = measure_once(module)
+        times.append(elapsed)
+        rss.append(probe['rss_kb'])
+        loaded = probe['loaded']
+    times.sort()
+    return {
+        'module': module,
+        'runs': runs,
+        'boot_s_median': times[len(times) // 2],
+        'boot_s_min': times[0],
+        'rss_mb_max': max(rss) / 1024.0,
+        'heavy_modules': loaded,
+    }
+
+
+def compare_to_baseline(results, baseline, max_regression):
+    failures = []
+    for key in ('boot_s_median', 'rss_mb_max'):
+        if baseline.get(key) and results[key] > baseline[key] * (1 + max_regression):
+            failures.append(f"{key}: {results[key]:.3f} vs baseline {baseline[key]:.3f}")
+    new_heavy = sorted(set(results['heavy_modules']) - set(baseline.get('heavy_modules', [])))
+    if new_heavy:
+        failures.append(f"new heavy imports: {', '.join(new_heavy)}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure import time and RSS of the web app')
+    parser.add_argument('--module', default='app')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15, help='Slowest imports to list')
+    parser.add_argument('--baseline', default='startup_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--max-regression', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run_benchmark(args.module, args.runs)
+    print(f"🚀 import {args.module}: median {results['boot_s_median'] * 1000:.0f} ms "
+          f"(min {results['boot_s_min'] * 1000:.0f} ms), peak RSS {results['rss_mb_max']:.1f} MB")
+    print(f"📦 Heavy modules loaded: {', '.join(results['heavy_modules']) or 'none'}")
+    print(f"\n🐢 Slowest imports (cumulative):")
+    for cumulative_us, name in slowest_imports(args.module, args.top):
+        print(f"   {cumulative_us / 1000:8.1f} ms  {name}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\n💾 Baseline saved to {args.baseline}")
+        return
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        failures = compare_to_baseline(results, baseline, args.max_regression)
+        if failures:
+            print("\n❌ Startup regression:")
+            for failure in failures:
+                print(f"   {failure}")
+            sys.exit(1)
+        print("\n✅ No startup regression vs baseline")
+
+
+if __name__ == '__main__':
+    main()
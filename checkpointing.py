@@ -0,0 +1,206 @@
+"""
+Checkpoint management for training and serving
+- Training checkpoints are written on a background thread (state is snapshotted to CPU first)
+- Only the top-K checkpoints by validation MAE are kept on disk
+- The best model is also exported as a small weights-only inference artifact plus a JSON manifest
+"""
+
+import os
+import json
+import queue
+import hashlib
+import threading
+from datetime import datetime
+
+import torch
+
+
+INFERENCE_WEIGHTS = 'inference_weights.pt'
+INFERENCE_MANIFEST = 'inference_manifest.json'
+
+
+def build_model(arch, load_weights=True):
+    """Instantiate a model class by name (as recorded in checkpoints and manifests)"""
+    import enhanced_mcnn_model
+    import mcnn_model
+    for module in (enhanced_mcnn_model, mcnn_model):
+        cls = getattr(module, arch, None)
+        if cls is not None:
+            try:
+                return cls(load_weights=load_weights)
+            except TypeError:
+                return cls()
+    raise ValueError(f"Unknown model architecture: {arch}")
+
+
+def _snapshot(obj):
+    """Detached CPU copy of every tensor in a (nested) state dict"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, _snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(v) for v in obj)
+    return obj
+
+
+def _atomic_torch_save(obj, path):
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CheckpointManager:
+    """
+    Asynchronous top-K checkpoint writer
+    save() only copies state to CPU; serialisation, pruning and inference export run on a worker thread.
+    """
+    def __init__(self, save_dir, prefix='best_optimized', arch='EnhancedMCNNForPellets',
+                 keep_top_k=3, export_inference=True, inference_fp16=False):
+        self.save_dir = save_dir
+        self.prefix = prefix
+        self.arch = arch
+        self.keep_top_k = keep_top_k
+        self.export_inference = export_inference
+        self.inference_fp16 = inference_fp16
+        self.index_path = os.path.join(save_dir, f'{prefix}_index.json')
+        os.makedirs(save_dir, exist_ok=True)
+
+        # [(mae, epoch, path)] of checkpoints kept on disk, persisted across runs
+        self.kept = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.kept = [tuple(entry) for entry in json.load(f)
+                             if os.path.exists(entry[2])]
+
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._worker, name='checkpoint-writer', daemon=True)
+        self._thread.start()
+
+    @property
+    def best_path(self):
+        return min(self.kept)[2] if self.kept else None
+
+    def save(self, epoch, mae, model, optimizer=None, scheduler=None, **extra):
+        """Snapshot training state and queue it for writing; returns the checkpoint path"""
+        if self._error is not None:
+            raise RuntimeError(f"Checkpoint writer failed: {self._error}")
+        state = {
+            'epoch': epoch,
+            'arch': self.arch,
+            'model_state_dict': _snapshot(model.state_dict()),
+            'best_mae': mae,
+        }
+        if optimizer is not None:
+            state['optimizer_state_dict'] = _snapshot(optimizer.state_dict())
+        if scheduler is not None:
+            state['scheduler_state_dict'] = scheduler.state_dict()
+        state.update(extra)
+        path = os.path.join(self.save_dir, f'{self.prefix}_epoch_{epoch}.pth')
+        self._queue.put((self._write, path, state))
+        return path
+
+    def save_resume_state(self, path, model, optimizer=None, scheduler=None, **extra):
+        """Queue an overwrite of a single rolling resume checkpoint (not ranked or pruned)"""
+        if self._error is not None:
+            raise RuntimeError(f"Checkpoint writer failed: {self._error}")
+        state = {'model_state_dict': _snapshot(model.state_dict())}
+        if optimizer is not None:
+            state['optimizer_state_dict'] = _snapshot(optimizer.state_dict())
+        if scheduler is not None:
+            state['scheduler_state_dict'] = scheduler.state_dict()
+        state.update(extra)
+        self._queue.put((_atomic_torch_save, state, path))
+
+    def wait(self):
+        """Block until every queued checkpoint is on disk"""
+        self._queue.join()
+        if self._error is not None:
+            raise RuntimeError(f"Checkpoint writer failed: {self._error}")
+
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                func, *args = job
+                func(*args)
+            except Exception as e:
+                self._error = e
+                print(f"⚠️ Failed to write checkpoint: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _write(self, path, state):
+        _atomic_torch_save(state, path)
+        entry = (float(state['best_mae']), int(state['epoch']), path)
+        self.kept = sorted(self.kept + [entry])
+
+        # Retention: keep the K lowest-MAE checkpoints
+        for _, _, stale in self.kept[self.keep_top_k:]:
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass
+        self.kept = self.kept[:self.keep_top_k]
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump(self.kept, f)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+        if self.export_inference and self.kept and self.kept[0][2] == path:
+            self._export_inference(state)
+
+    def _export_inference(self, state):
+        weights = state['model_state_dict']
+        dtype = 'float32'
+        if self.inference_fp16:
+            weights = {k: v.half() if v.is_floating_point() else v for k, v in weights.items()}
+            dtype = 'float16'
+        weights_path = os.path.join(self.save_dir, INFERENCE_WEIGHTS)
+        _atomic_torch_save(weights, weights_path)
+
+        manifest = {
+            'arch': state['arch'],
+            'weights': INFERENCE_WEIGHTS,
+            'dtype': dtype,
+            'epoch': state['epoch'],
+            'mae': state['best_mae'],
+            'sha256': _sha256(weights_path),
+            'size_bytes': os.path.getsize(weights_path),
+            'created': datetime.now().isoformat(timespec='seconds'),
+        }
+        manifest_path = os.path.join(self.save_dir, INFERENCE_MANIFEST)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def load_inference_model(manifest_path, device):
+    """Load the model described by an inference manifest (weights-only, memory-mapped when supported)"""
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    weights_path = os.path.join(os.path.dirname(manifest_path), manifest['weights'])
+    try:
+        state_dict = torch.load(weights_path, map_location='cpu', weights_only=True, mmap=True)
+    except TypeError:
+        # Older torch without mmap/weights_only arguments
+        state_dict = torch.load(weights_path, map_location='cpu')
+    model = build_model(manifest['arch'])
+    # load_state_dict copies into the fp32 parameters, upcasting fp16 artifacts
+    model.load_state_dict(state_dict)
+    return model.to(device).eval()
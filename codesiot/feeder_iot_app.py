@@ -3,10 +3,27 @@
 
 from flask import Flask, request, jsonify
 import RPi.GPIO as GPIO
+import threading
+import requests
+import json
 import time
+import os
 
 app = Flask(__name__)
 
+# Load configuration (heartbeat is disabled without an endpoint and token)
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+config = {}
+if os.path.exists(CONFIG_PATH):
+    with open(CONFIG_PATH) as f:
+        config = json.load(f)
+DEVICE_ID = config.get('device_id')
+USER_TOKEN = config.get('user_token')
+HEARTBEAT_ENDPOINT = config.get('heartbeat_endpoint')
+HEARTBEAT_INTERVAL = float(config.get('heartbeat_interval', 30))
+START_TIME = time.time()
+last_dispense = None
+
 # GPIO setup (example: pin 18 for motor/servo)
 FEEDER_PIN = 18
 GPIO.setmode(GPIO.BCM)
@@ -23,16 +40,38 @@ def dispense():
         GPIO.output(FEEDER_PIN, GPIO.HIGH)
         time.sleep(duration)
         GPIO.output(FEEDER_PIN, GPIO.LOW)
+        global last_dispense
+        last_dispense = {'amount': amount_grams, 'at': time.time()}
         return jsonify({'success': True, 'message': f'Dispensed {amount_grams}g'}), 200
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def device_status():
+    return {
+        'status': 'online',
+        'uptime_s': round(time.time() - START_TIME),
+        'last_dispense': last_dispense,
+    }
+
 @app.route('/status', methods=['GET'])
 def status():
-    # Optionally return device status, uptime, etc.
-    return jsonify({'status': 'online'})
+    return jsonify(device_status())
+
+def heartbeat_loop():
+    """Push device health to the server every HEARTBEAT_INTERVAL seconds"""
+    session = requests.Session()
+    headers = {'Authorization': f'Bearer {USER_TOKEN}'}
+    while True:
+        try:
+            session.post(HEARTBEAT_ENDPOINT, json=dict(device_status(), device_id=DEVICE_ID),
+                         headers=headers, timeout=10)
+        except requests.RequestException as e:
+            print(f"Heartbeat failed: {e}")
+        time.sleep(HEARTBEAT_INTERVAL)
 
 if __name__ == '__main__':
+    if HEARTBEAT_ENDPOINT and USER_TOKEN:
+        threading.Thread(target=heartbeat_loop, daemon=True).start()
     try:
         app.run(host='0.0.0.0', port=5001)
     finally:
@@ -328,5 +328,81 @@ class UltraEnhancedMCNN(nn.Module):
                     nn.init.constant_(m.bias, 0)
 
 
+class DepthwiseSeparableConv(nn.Module):
+    """Depthwise 3x3 conv followed by a pointwise 1x1 conv, each with BN + ReLU"""
+    def __init__(self, in_channels, out_channels, stride=1, dilation=1):
+        super(DepthwiseSeparableConv, self).__init__()
+        self.depthwise = nn.Sequential(
+            nn.Conv2d(in_channels, in_channels, 3, stride=stride, padding=dilation,
+                      dilation=dilation, groups=in_channels, bias=False),
+            nn.BatchNorm2d(in_channels),
+            nn.ReLU(inplace=True)
+        )
+        self.pointwise = nn.Sequential(
+            nn.Conv2d(in_channels, out_channels, 1, bias=False),
+            nn.BatchNorm2d(out_channels),
+            nn.ReLU(inplace=True)
+        )
+
+    def forward(self, x):
+        return self.pointwise(self.depthwise(x))
+
+
+class LightweightMCNN(nn.Module):
+    """
+    Small student model for latency-critical inference
+    - Strided shared stem brings 512x512 input to the 128x128 output grid early
+    - Multi-scale context from dilated depthwise-separable branches instead of large kernels
+    - Trained by distillation against EnhancedMCNNForPellets (see train.py --mode distill)
+    """
+
+    def __init__(self, load_weights=False):
+        super(LightweightMCNN, self).__init__()
+
+        # Shared stem: 512 -> 256 -> 128
+        self.stem = nn.Sequential(
+            nn.Conv2d(3, 16, 3, stride=2, padding=1, bias=False),
+            nn.BatchNorm2d(16),
+            nn.ReLU(inplace=True),
+            DepthwiseSeparableConv(16, 32),
+            DepthwiseSeparableConv(32, 48, stride=2),
+        )
+
+        # Multi-scale context with dilation (fine, medium, coarse)
+        self.branches = nn.ModuleList([
+            DepthwiseSeparableConv(48, 32, dilation=1),
+            DepthwiseSeparableConv(48, 32, dilation=2),
+            DepthwiseSeparableConv(48, 32, dilation=3),
+        ])
+
+        # Fusion and density head (32*3=96 channels)
+        self.head = nn.Sequential(
+            nn.Conv2d(96, 32, 1, bias=False),
+            nn.BatchNorm2d(32),
+            nn.ReLU(inplace=True),
+            DepthwiseSeparableConv(32, 16),
+            nn.Conv2d(16, 1, 1, bias=True)
+        )
+
+        if not load_weights:
+            self._initialize_weights()
+
+    def forward(self, x):
+        features = self.stem(x)
+        features = torch.cat([branch(features) for branch in self.branches], dim=1)
+        density_map = self.head(features)
+        return F.relu(density_map)
+
+    def _initialize_weights(self):
+        for m in self.modules():
+            if isinstance(m, nn.Conv2d):
+                nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
+                if m.bias is not None:
+                    nn.init.constant_(m.bias, 0)
+            elif isinstance(m, nn.BatchNorm2d):
+                nn.init.constant_(m.weight, 1)
+                nn.init.constant_(m.bias, 0)
+
+
 # Alias for easy import
 PelletMCNN = EnhancedMCNNForPellets
\ No newline at end of file
@@ -0,0 +1,74 @@
+"""
+Count-based evaluation shared by train.py and test.py
+- Per-image errors are accumulated on-device; the host syncs once per pass
+- Several models can be scored in one pass over the decoded data
+"""
+
+import numpy as np
+import torch
+
+
+def accumulate_counts(models, dataloader, device, criterion=None, return_counts=False):
+    """
+    Run every model over the dataloader once.
+    Returns one sums tensor per model on `device`: [abs_err_sum, sq_err_sum, loss_sum, n_images]
+    (these can be all-reduced across processes before finalize_metrics), plus per-image
+    predicted counts per model and ground-truth counts when return_counts is set.
+    """
+    sums = [torch.zeros(4, dtype=torch.float64, device=device) for _ in models]
+    pred_counts = [[] for _ in models]
+    gt_counts = []
+    for model in models:
+        model.eval()
+
+    with torch.no_grad():
+        for images, targets in dataloader:
+            images = images.to(device, non_blocking=True)
+            targets = targets.to(device, non_blocking=True)
+            target_counts = targets.sum(dim=(1, 2, 3)).double()
+            batch_size = images.size(0)
+            if return_counts:
+                gt_counts.append(target_counts)
+
+            for i, model in enumerate(models):
+                predictions = model(images)
+                counts = predictions.sum(dim=(1, 2, 3)).double()
+                diff = counts - target_counts
+                if criterion is not None:
+                    loss, _ = criterion(predictions, targets)
+                    loss_sum = loss.detach().double() * batch_size
+                else:
+                    loss_sum = torch.zeros((), dtype=torch.float64, device=device)
+                sums[i] += torch.stack([
+                    diff.abs().sum(),
+                    (diff * diff).sum(),
+                    loss_sum,
+                    torch.tensor(float(batch_size), dtype=torch.float64, device=device),
+                ])
+                if return_counts:
+                    pred_counts[i].append(counts)
+
+    if return_counts:
+        pred_counts = [torch.cat(c) if c else torch.empty(0, device=device) for c in pred_counts]
+        gt_counts = torch.cat(gt_counts) if gt_counts else torch.empty(0, device=device)
+        return sums, pred_counts, gt_counts
+    return sums
+
+
+def finalize_metrics(sums):
+    """Turn a sums tensor from accumulate_counts into per-image loss/MAE/MSE/RMSE (single host sync)"""
+    abs_err, sq_err, loss_sum, n = sums.tolist()
+    n = max(n, 1.0)
+    mse = sq_err / n
+    return {
+        'loss': loss_sum / n,
+        'mae': abs_err / n,
+        'mse': mse,
+        'rmse': float(np.sqrt(mse)),
+        'n': int(n),
+    }
+
+
+def evaluate_models(models, dataloader, device, criterion=None):
+    """Per-image metrics for each model, evaluated in a single pass over the data"""
+    return [finalize_metrics(s) for s in accumulate_counts(models, dataloader, device, criterion)]
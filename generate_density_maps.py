@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Ground-truth density map generation from point annotations
+- Fixed sigma or geometry-adaptive sigma (beta * mean distance to the k nearest pellets)
+- KD-tree neighbour search, process pool across images
+- Maps are written directly at the gt_downsample grid used by CrowdDataset (e.g. 128x128),
+  with every point contributing exactly 1 to the total count
+
+Annotation files share the image's base name and may be:
+- .json: [[x, y], ...] or {"points": [[x, y], ...]}
+- .csv / .txt: one "x,y" (or "x y") pair per line
+- .mat: ShanghaiTech-style image_info (requires scipy)
+
+Usage:
+    python generate_density_maps.py --images ./data/train_data/images \
+        --annotations ./data/train_data/annotations --output ./data/train_data/densitymaps --adaptive
+"""
+
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+try:
+    from scipy.spatial import cKDTree
+    SCIPY_AVAILABLE = True
+except ImportError:
+    SCIPY_AVAILABLE = False
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+ANNOTATION_EXTENSIONS = ('.json', '.csv', '.txt', '.mat')
+
+
+def load_points(path):
+    """Read an annotation file into an (N, 2) float array of (x, y) pixel coordinates"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.json':
+        with open(path) as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            data = data.get('points', [])
+        points = np.asarray(data, dtype=np.float64)
+    elif ext == '.mat':
+        from scipy.io import loadmat
+        points = np.asarray(loadmat(path)['image_info'][0, 0][0, 0][0], dtype=np.float64)
+    else:
+        rows = []
+        with open(path) as f:
+            for line in f:
+                parts = line.replace(',', ' ').split()
+                if len(parts) >= 2:
+                    try:
+                        rows.append((float(parts[0]), float(parts[1])))
+                    except ValueError:
+                        continue  # header line
+        points = np.asarray(rows, dtype=np.float64)
+    return points.reshape(-1, 2)
+
+
+def adaptive_sigmas(points, k=3, beta=0.3, fallback_sigma=4.0):
+    """Per-point sigma = beta * mean distance to the k nearest neighbours (input pixel units)"""
+    n = len(points)
+    if n < 2:
+        return np.full(n, fallback_sigma)
+    k_eff = min(k, n - 1)
+    if SCIPY_AVAILABLE:
+        # k + 1 because the nearest neighbour of each point is itself
+        distances, _ = cKDTree(points).query(points, k=k_eff + 1)
+        distances = distances[:, 1:]
+    else:
+        diff = points[:, None, :] - points[None, :, :]
+        dist = np.sqrt((diff ** 2).sum(-1))
+        distances = np.sort(dist, axis=1)[:, 1:k_eff + 1]
+    return beta * distances.mean(axis=1)
+
+
+def render_density(points, sigmas, out_h, out_w, truncate=3.0):
+    """
+    Sum of per-point Gaussians on an out_h x out_w grid. Each kernel is truncated to
+    +-truncate*sigma, clipped to the image and renormalised so every point adds exactly 1.
+    """
+    density = np.zeros((out_h, out_w), dtype=np.float32)
+    kernel_cache = {}
+    for (x, y), sigma in zip(points, sigmas):
+        cx = min(max(int(x), 0), out_w - 1)
+        cy = min(max(int(y), 0), out_h - 1)
+        sigma = max(float(sigma), 0.5)
+        radius = int(np.ceil(truncate * sigma))
+
+        key = (round(sigma, 2), radius)
+        g = kernel_cache.get(key)
+        if g is None:
+            offsets = np.arange(-radius, radius + 1, dtype=np.float64)
+            g = np.exp(-0.5 * (offsets / sigma) ** 2)
+            kernel_cache[key] = g
+
+        y0, y1 = max(cy - radius, 0), min(cy + radius + 1, out_h)
+        x0, x1 = max(cx - radius, 0), min(cx + radius + 1, out_w)
+        gy = g[y0 - (cy - radius):y1 - (cy - radius)]
+        gx = g[x0 - (cx - radius):x1 - (cx - radius)]
+        patch = np.outer(gy, gx)
+        density[y0:y1, x0:x1] += (patch / patch.sum()).astype(np.float32)
+    return density
+
+
+def generate_one(job):
+    """Worker: (image_path, annotation_path, output_path, options) -> (name, count)"""
+    image_path, annotation_path, output_path, opts = job
+    with Image.open(image_path) as img:  # header only, no full decode
+        width, height = img.size
+    points = load_points(annotation_path)
+
+    ds = opts['gt_downsample']
+    out_size = opts['target_size'] // ds if ds > 1 else opts['target_size']
+    scale_x, scale_y = out_size / width, out_size / height
+
+    if opts['adaptive']:
+        sigmas = adaptive_sigmas(points, k=opts['k'], beta=opts['beta'], fallback_sigma=opts['sigma'])
+    else:
+        sigmas = np.full(len(points), opts['sigma'])
+    # Sigmas are in input pixels; convert to output grid units
+    sigmas = sigmas * (scale_x + scale_y) / 2.0
+
+    scaled = points * np.array([scale_x, scale_y])
+    density = render_density(scaled, sigmas, out_size, out_size, truncate=opts['truncate'])
+    np.save(output_path, density)
+    return os.path.basename(image_path), float(len(points))
+
+
+def find_jobs(images_dir, annotations_dir, output_dir, opts):
+    jobs = []
+    missing = 0
+    for name in sorted(os.listdir(images_dir)):
+        stem, ext = os.path.splitext(name)
+        if ext.lower() not in IMAGE_EXTENSIONS:
+            continue
+        annotation = next((os.path.join(annotations_dir, stem + a) for a in ANNOTATION_EXTENSIONS
+                           if os.path.exists(os.path.join(annotations_dir, stem + a))), None)
+        if annotation is None:
+            missing += 1
+            continue
+        # Same naming rule as CrowdDataset / write_shards: <stem>.<any ext> -> <stem>.npy
+        output_path = os.path.join(output_dir, stem + '.npy')
+        if opts['skip_existing'] and os.path.exists(output_path):
+            continue
+        jobs.append((os.path.join(images_dir, name), annotation, output_path, opts))
+    return jobs, missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate density maps from point annotations')
+    parser.add_argument('--images', required=True)
+    parser.add_argument('--annotations', required=True)
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--gt-downsample', type=int, default=4)
+    parser.add_argument('--target-size', type=int, default=512)
+    parser.add_argument('--sigma', type=float, default=4.0, help='Fixed sigma in input pixels')
+    parser.add_argument('--adaptive', action='store_true', help='Geometry-adaptive k-NN sigma')
+    parser.add_argument('--k', type=int, default=3)
+    parser.add_argument('--beta', type=float, default=0.3)
+    parser.add_argument('--truncate', type=float, default=3.0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--skip-existing', action='store_true')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    opts = {
+        'gt_downsample': args.gt_downsample,
+        'target_size': args.target_size,
+        'sigma': args.sigma,
+        'adaptive': args.adaptive,
+        'k': args.k,
+        'beta': args.beta,
+        'truncate': args.truncate,
+        'skip_existing': args.skip_existing,
+    }
+    jobs, missing = find_jobs(args.images, args.annotations, args.output, opts)
+    if args.adaptive and not SCIPY_AVAILABLE:
+        print("⚠️ scipy not available; using brute-force neighbour search")
+    print(f"🗺️ Generating {len(jobs)} density maps ({missing} images without annotations)")
+
+    total = 0.0
+    if args.workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            for _, count in pool.map(generate_one, jobs, chunksize=max(1, len(jobs) // (args.workers * 8))):
+                total += count
+    else:
+        for job in jobs:
+            total += generate_one(job)[1]
+    print(f"✅ Done: {len(jobs)} maps, {total:.0f} annotated pellets written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+End-to-end HTTP load test for the counting and dispense APIs
+- Starts the Flask app on a throwaway SQLite database
+- Starts an in-process fake IoT feeder and points the admin account's device URL at it, so
+  /dispense goes through the normal device lookup; --device-latency-ms only shows up in the
+  dispense latencies once communicate_with_iot_device talks to the device
+- Drives /api/count_pellets, /dispense and /api/stats at a fixed concurrency
+- Records throughput, latency percentiles and error rates per endpoint
+- Fails (exit code 1) when results regress beyond thresholds vs. a stored baseline
+
+Usage:
+    python load_test.py --concurrency 16 --duration 30
+    python load_test.py --save-baseline              # record bench_baseline.json
+    python load_test.py --baseline bench_baseline.json --max-regression 0.2
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import argparse
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+
+ENDPOINTS = ('count_pellets', 'dispense', 'stats')
+
+
+class ServerThread(threading.Thread):
+    """Serve a WSGI app on an ephemeral port in a background thread"""
+    def __init__(self, wsgi_app, host='127.0.0.1'):
+        super().__init__(daemon=True)
+        self.server = make_server(host, 0, wsgi_app, threaded=True)
+        self.url = f"http://{host}:{self.server.server_port}"
+
+    def run(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()
+
+
+def create_fake_device(latency_ms=0.0):
+    """Minimal stand-in for codesiot/feeder_iot_app.py without GPIO"""
+    device = Flask('fake_feeder')
+    device.config['dispensed'] = 0
+
+    @device.route('/dispense', methods=['POST'])
+    def dispense():
+        if latency_ms:
+            time.sleep(latency_ms / 1000.0)
+        amount_grams = (request.get_json(silent=True) or {}).get('amount', 0)
+        device.config['dispensed'] += 1
+        return jsonify({'success': True, 'message': f'Dispensed {amount_grams}g'}), 200
+
+    @device.route('/status', methods=['GET'])
+    def status():
+        return jsonify({'status': 'online'})
+
+    return device
+
+
+def start_servers(device_latency_ms):
+    """Start the fake device and the feeder app; returns (app_server, device_server, device_app)"""
+    device_app = create_fake_device(device_latency_ms)
+    device_server = ServerThread(device_app)
+    device_server.start()
+
+    # Must be set before app.py is imported: the engine is bound in create_app()
+    db_path = os.path.join(tempfile.mkdtemp(prefix='feeder_bench_'), 'bench.sqlite')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + db_path
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as feeder
+
+    with feeder.app.app_context():
+        feeder.upgrade_schema()
+        feeder.create_admin_user()
+        admin = feeder.User.query.filter_by(username='admin').first()
+        admin.iot_device_url = device_server.url + '/dispense'
+        feeder.sync_default_device(admin, admin.iot_device_url)
+        feeder.db.session.commit()
+
+    app_server = ServerThread(feeder.app)
+    app_server.start()
+    return app_server, device_server, device_app
+
+
+def _login(base_url, username, password):
+    session = requests.Session()
+    resp = session.post(f"{base_url}/login", data={'username': username, 'password': password},
+                        allow_redirects=False, timeout=10)
+    if resp.status_code not in (302, 303):
+        raise RuntimeError(f"Login failed with HTTP {resp.status_code}")
+    return session
+
+
+def _request(session, base_url, endpoint, image_bytes, amount):
+    if endpoint == 'count_pellets':
+        return session.post(f"{base_url}/api/count_pellets",
+                            files={'image': ('bench.jpg', image_bytes, 'image/jpeg')}, timeout=60)
+    if endpoint == 'dispense':
+        return session.post(f"{base_url}/dispense", json={'amount': amount}, timeout=30)
+    return session.get(f"{base_url}/api/stats", timeout=30)
+
+
+def run_load(base_url, endpoints, weights, concurrency, duration, image_bytes,
+             username='admin', password='admin123', amount=50, seed=0):
+    """Closed-loop load: `concurrency` clients issue requests back-to-back until `duration` elapses"""
+    samples = defaultdict(list)   # endpoint -> [latency_ms]
+    errors = defaultdict(int)
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(idx):
+        rng = random.Random(seed + idx)
+        session = _login(base_url, username, password)
+        local_samples = defaultdict(list)
+        local_errors = defaultdict(int)
+        while time.perf_counter() < deadline:
+            endpoint = rng.choices(endpoints, weights=weights)[0]
+            start = time.perf_counter()
+            try:
+                resp = _request(session, base_url, endpoint, image_bytes, amount)
+                ok = resp.status_code < 400
+            except requests.RequestException:
+                ok = False
+            local_samples[endpoint].append((time.perf_counter() - start) * 1000.0)
+            if not ok:
+                local_errors[endpoint] += 1
+        with lock:
+            for k, v in local_samples.items():
+                samples[k].extend(v)
+            for k, v in local_errors.items():
+                errors[k] += v
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(client, range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    results = {}
+    for endpoint in endpoints:
+        lat = np.array(samples.get(endpoint, []))
+        n = len(lat)
+        results[endpoint] = {
+            'requests': n,
+            'throughput_rps': n / elapsed if elapsed > 0 else 0.0,
+            'p50_ms': float(np.percentile(lat, 50)) if n else None,
+            'p90_ms': float(np.percentile(lat, 90)) if n else None,
+            'p99_ms': float(np.percentile(lat, 99)) if n else None,
+            'error_rate': errors.get(endpoint, 0) / n if n else None,
+        }
+    return results, elapsed
+
+
+def compare_to_baseline(results, baseline, max_regression, max_error_increase):
+    """Return a list of human-readable regressions (empty when within thresholds)"""
+    failures = []
+    for endpoint, cur in results.items():
+        base = baseline.get('endpoints', {}).get(endpoint)
+        if not base or not cur['requests'] or not base.get('requests'):
+            continue
+        for key in ('p50_ms', 'p99_ms'):
+            if base[key] and cur[key] > base[key] * (1 + max_regression):
+                failures.append(f"{endpoint} {key}: {cur[key]:.1f} > {base[key]:.1f} (+{max_regression:.0%})")
+        if base['throughput_rps'] and cur['throughput_rps'] < base['throughput_rps'] * (1 - max_regression):
+            failures.append(f"{endpoint} throughput: {cur['throughput_rps']:.1f} < "
+                            f"{base['throughput_rps']:.1f} rps (-{max_regression:.0%})")
+        if cur['error_rate'] > base['error_rate'] + max_error_increase:
+            failures.append(f"{endpoint} error_rate: {cur['error_rate']:.2%} > {base['error_rate']:.2%}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the feeder HTTP APIs')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20.0, help='Seconds of load')
+    parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument('--weights', nargs='+', type=float, default=None,
+                        help='Relative request mix, one weight per endpoint')
+    parser.add_argument('--image', default='./test.jpg')
+    parser.add_argument('--device-latency-ms', type=float, default=0.0,
+                        help='Artificial delay of the fake IoT device')
+    parser.add_argument('--base-url', default=None,
+                        help='Target an already running server instead of starting one')
+    parser.add_argument('--baseline', default='bench_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='Allowed relative latency/throughput regression')
+    parser.add_argument('--max-error-increase', type=float, default=0.01,
+                        help='Allowed absolute error-rate increase')
+    parser.add_argument('--output', default=None, help='Write results JSON here')
+    args = parser.parse_args()
+
+    weights = args.weights or [1.0] * len(args.endpoints)
+    if len(weights) != len(args.endpoints):
+        parser.error('--weights must have one value per endpoint')
+    with open(args.image, 'rb') as f:
+        image_bytes = f.read()
+
+    servers = []
+    device_app = None
+    base_url = args.base_url
+    if base_url is None:
+        app_server, device_server, device_app = start_servers(args.device_latency_ms)
+        servers = [app_server, device_server]
+        base_url = app_server.url
+    print(f"🚀 Load testing {base_url} | concurrency={args.concurrency} duration={args.duration}s")
+
+    try:
+        results, elapsed = run_load(base_url, args.endpoints, weights, args.concurrency,
+                                    args.duration, image_bytes)
+    finally:
+        for server in servers:
+            server.shutdown()
+
+    print(f"\n{'Endpoint':<15}{'Reqs':>8}{'RPS':>9}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'Errors':>9}")
+    for endpoint, r in results.items():
+        if not r['requests']:
+            print(f"{endpoint:<15}{0:>8}")
+            continue
+        print(f"{endpoint:<15}{r['requests']:>8}{r['throughput_rps']:>9.1f}{r['p50_ms']:>9.1f}"
+              f"{r['p90_ms']:>9.1f}{r['p99_ms']:>9.1f}{r['error_rate']:>9.2%}")
+    if device_app is not None:
+        print(f"🔌 Fake device received {device_app.config['dispensed']} dispense commands")
+        if not device_app.config['dispensed']:
+            print("⚠️ Dispenses did not reach the fake device; dispense latencies exclude the device round trip")
+
+    report = {
+        'concurrency': args.concurrency,
+        'duration_s': elapsed,
+        'endpoints': results,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"💾 Baseline saved to {args.baseline}")
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        failures = compare_to_baseline(results, baseline, args.max_regression, args.max_error_increase)
+        if failures:
+            print("\n❌ Regressions vs. baseline:")
+            for failure in failures:
+                print(f"   - {failure}")
+            return 1
+        print("\n✅ Within baseline thresholds")
+    else:
+        print(f"\nℹ️ No baseline at {args.baseline}; run with --save-baseline to record one")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,11 @@
 from torch.utils.data import Dataset
 import os
+import json
 import matplotlib.pyplot as plt
 import numpy as np
+import math
 import torch
+import torch.nn.functional as F
 import cv2
 import random
 import torchvision.transforms.functional as TF
@@ -41,60 +44,262 @@ class CrowdDataset(Dataset):
             img /= 255.0
 
         # Load corresponding density map
-        gt_path = os.path.join(self.gt_dmap_root, img_name.replace('.jpg', '.npy'))
+        gt_path = os.path.join(self.gt_dmap_root, os.path.splitext(img_name)[0] + '.npy')
         gt_dmap = np.load(gt_path).astype(np.float32)
 
         target_size = 512
         img = cv2.resize(img, (target_size, target_size), interpolation=cv2.INTER_LINEAR)
+        gt_dmap = resize_density_map(gt_dmap, target_size, self.gt_downsample)
 
-        # Resize + rescale density map based on gt_downsample
-        orig_sum = np.sum(gt_dmap)
-        if self.gt_downsample > 1:
-            # Downsample the density map to match model output size
-            ds_size = target_size // self.gt_downsample
-            gt_resized = cv2.resize(gt_dmap, (ds_size, ds_size), interpolation=cv2.INTER_LINEAR)
-        else:
-            # Keep same size as input image
-            gt_resized = cv2.resize(gt_dmap, (target_size, target_size), interpolation=cv2.INTER_LINEAR)
-        
-        # Rescale to preserve total count
-        resized_sum = np.sum(gt_resized)
-        if resized_sum > 0 and orig_sum > 0:
-            gt_resized *= (orig_sum / resized_sum)
-        gt_dmap = gt_resized[np.newaxis, :, :]
-
-        # --- 🔁 DATA AUGMENTATION ---
+        img_tensor = torch.tensor(img.transpose((2, 0, 1)), dtype=torch.float32)
+        gt_tensor = torch.tensor(gt_dmap, dtype=torch.float32)
+        if self.augment:
+            return augment_sample(img_tensor, gt_tensor)
+        return img_tensor, gt_tensor
+
+
+def resize_density_map(gt_dmap, target_size, gt_downsample):
+    """Resize a density map to the model output grid, preserving its total count; returns 1xHxW"""
+    orig_sum = np.sum(gt_dmap)
+    if gt_downsample > 1:
+        # Downsample the density map to match model output size
+        ds_size = target_size // gt_downsample
+        gt_resized = cv2.resize(gt_dmap, (ds_size, ds_size), interpolation=cv2.INTER_LINEAR)
+    else:
+        # Keep same size as input image
+        gt_resized = cv2.resize(gt_dmap, (target_size, target_size), interpolation=cv2.INTER_LINEAR)
+    
+    # Rescale to preserve total count
+    resized_sum = np.sum(gt_resized)
+    if resized_sum > 0 and orig_sum > 0:
+        gt_resized *= (orig_sum / resized_sum)
+    return gt_resized[np.newaxis, :, :]
+
+
+def augment_sample(img_tensor, gt_tensor):
+    """Random flips, rotation and brightness jitter applied jointly to a CHW image and its density map"""
+    # Random horizontal flip
+    if random.random() > 0.5:
+        img_tensor = TF.hflip(img_tensor)
+        gt_tensor = TF.hflip(gt_tensor)
+
+    # Random vertical flip
+    if random.random() > 0.5:
+        img_tensor = TF.vflip(img_tensor)
+        gt_tensor = TF.vflip(gt_tensor)
+
+    # Random rotation (-15° to +15°)
+    angle = random.uniform(-15, 15)
+    img_tensor = TF.rotate(img_tensor, angle, interpolation=TF.InterpolationMode.BILINEAR)
+    gt_tensor = TF.rotate(gt_tensor, angle, interpolation=TF.InterpolationMode.BILINEAR)
+
+    # Optional: Random brightness jitter
+    if random.random() > 0.5:
+        factor = random.uniform(0.8, 1.2)
+        img_tensor = TF.adjust_brightness(img_tensor, factor)
+
+    return img_tensor, gt_tensor
+
+
+class BatchAugmenter:
+    """
+    Batched counterpart of augment_sample() for collated batches on the training device.
+    One affine grid per sample (flip + rotation) is applied to both the image and its
+    density map via F.affine_grid/F.grid_sample; density maps are rescaled afterwards so
+    each sample keeps its count.
+    """
+    def __init__(self, max_angle=15.0, flip_prob=0.5, brightness_prob=0.5,
+                 brightness_range=(0.8, 1.2), preserve_count=True):
+        self.max_angle = max_angle
+        self.flip_prob = flip_prob
+        self.brightness_prob = brightness_prob
+        self.brightness_range = brightness_range
+        self.preserve_count = preserve_count
+
+    def _random_theta(self, batch_size, device):
+        hflip = torch.rand(batch_size, device=device) < self.flip_prob
+        vflip = torch.rand(batch_size, device=device) < self.flip_prob
+        sx = 1.0 - 2.0 * hflip.float()
+        sy = 1.0 - 2.0 * vflip.float()
+        angle = (torch.rand(batch_size, device=device) * 2.0 - 1.0) * math.radians(self.max_angle)
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        zeros = torch.zeros_like(angle)
+        # Sampling grid = flip @ rotation (output coords -> input coords)
+        return torch.stack([
+            torch.stack([sx * cos, -sx * sin, zeros], dim=1),
+            torch.stack([sy * sin, sy * cos, zeros], dim=1),
+        ], dim=1)
+
+    @staticmethod
+    def _warp(x, theta):
+        grid = F.affine_grid(theta.to(x.dtype), list(x.shape), align_corners=False)
+        return F.grid_sample(x, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+
+    def __call__(self, images, dmaps):
+        batch_size = images.size(0)
+        device = images.device
+        theta = self._random_theta(batch_size, device)
+
+        images = self._warp(images, theta)
+        orig_counts = dmaps.sum(dim=(1, 2, 3), keepdim=True)
+        dmaps = self._warp(dmaps, theta)
+        if self.preserve_count:
+            new_counts = dmaps.sum(dim=(1, 2, 3), keepdim=True)
+            scale = torch.where(new_counts > 0, orig_counts / new_counts.clamp_min(1e-12),
+                                torch.ones_like(new_counts))
+            dmaps = dmaps * scale
+
+        # Brightness jitter on a random subset of the batch
+        low, high = self.brightness_range
+        factors = torch.empty(batch_size, 1, 1, 1, device=device).uniform_(low, high)
+        apply = torch.rand(batch_size, 1, 1, 1, device=device) < self.brightness_prob
+        factors = torch.where(apply, factors, torch.ones_like(factors))
+        images = (images * factors).clamp_(0.0, 1.0)
+        return images, dmaps
+
+
+def _list_images(img_root):
+    return sorted(
+        filename for filename in os.listdir(img_root)
+        if os.path.isfile(os.path.join(img_root, filename))
+    )
+
+
+def _source_files(img_root, gt_dmap_root, img_names):
+    """[name, size, mtime_ns] of every source image and its density map, in img_names order"""
+    files = []
+    for img_name in img_names:
+        for path in (os.path.join(img_root, img_name),
+                     os.path.join(gt_dmap_root, os.path.splitext(img_name)[0] + '.npy')):
+            try:
+                st = os.stat(path)
+                files.append([os.path.basename(path), st.st_size, st.st_mtime_ns])
+            except OSError:
+                files.append([os.path.basename(path), None, None])
+    return files
+
+
+def build_dataset_cache(img_root, gt_dmap_root, cache_dir, img_names=None, gt_downsample=1, target_size=512):
+    """
+    One-time preprocessing of a CrowdDataset into memory-mappable arrays:
+    cache_dir/images.npy (N x H x W x 3 uint8), cache_dir/density.npy (N x 1 x h x w float32)
+    and cache_dir/index.json with the image names, settings and source file sizes/mtimes.
+    """
+    if img_names is None:
+        img_names = _list_images(img_root)
+    sources = _source_files(img_root, gt_dmap_root, img_names)
+    ds_size = target_size // gt_downsample if gt_downsample > 1 else target_size
+    os.makedirs(cache_dir, exist_ok=True)
+    # A rebuild invalidates the old manifest first; it is only rewritten once the arrays are complete
+    if os.path.exists(os.path.join(cache_dir, 'index.json')):
+        os.remove(os.path.join(cache_dir, 'index.json'))
+
+    images = np.lib.format.open_memmap(
+        os.path.join(cache_dir, 'images.npy.tmp'), mode='w+', dtype=np.uint8,
+        shape=(len(img_names), target_size, target_size, 3))
+    density = np.lib.format.open_memmap(
+        os.path.join(cache_dir, 'density.npy.tmp'), mode='w+', dtype=np.float32,
+        shape=(len(img_names), 1, ds_size, ds_size))
+
+    for i, img_name in enumerate(img_names):
+        img = plt.imread(os.path.join(img_root, img_name))
+        if len(img.shape) == 2:
+            img = np.stack([img] * 3, axis=2)
+        img = img[:, :, :3]
+        if img.dtype != np.uint8:
+            img = np.clip(img * 255.0 if img.max() <= 1.0 else img, 0, 255).astype(np.uint8)
+        images[i] = cv2.resize(img, (target_size, target_size), interpolation=cv2.INTER_LINEAR)
+
+        gt_path = os.path.join(gt_dmap_root, os.path.splitext(img_name)[0] + '.npy')
+        gt_dmap = np.load(gt_path).astype(np.float32)
+        density[i] = resize_density_map(gt_dmap, target_size, gt_downsample)
+
+    images.flush()
+    density.flush()
+    del images, density
+    # Rename last so a partially written cache is never picked up
+    os.replace(os.path.join(cache_dir, 'images.npy.tmp'), os.path.join(cache_dir, 'images.npy'))
+    os.replace(os.path.join(cache_dir, 'density.npy.tmp'), os.path.join(cache_dir, 'density.npy'))
+    with open(os.path.join(cache_dir, 'index.json'), 'w') as f:
+        json.dump({'img_names': list(img_names), 'gt_downsample': gt_downsample,
+                   'target_size': target_size, 'sources': sources}, f)
+    return cache_dir
+
+
+def dataset_cache_exists(cache_dir, gt_downsample=None, target_size=None, img_root=None, gt_dmap_root=None):
+    """
+    Whether cache_dir holds a complete cache built with these settings (None = don't check).
+    A cache built with a different gt_downsample/target_size, from a different set of images or
+    density maps (added, removed, or changed size/mtime under img_root/gt_dmap_root), or whose
+    arrays don't match its manifest, is reported missing so the caller rebuilds it.
+    """
+    index_path = os.path.join(cache_dir, 'index.json')
+    if not os.path.exists(index_path):
+        return False
+    with open(index_path) as f:
+        index = json.load(f)
+    for key, wanted in (('gt_downsample', gt_downsample), ('target_size', target_size)):
+        if wanted is not None and index.get(key) != wanted:
+            print(f"🗄️ Cache {cache_dir} was built with {key}={index.get(key)}, need {wanted}; rebuilding")
+            return False
+    if img_root is not None and gt_dmap_root is not None:
+        sources = _source_files(img_root, gt_dmap_root, _list_images(img_root))
+        if index.get('sources') != sources:
+            print(f"🗄️ Cache {cache_dir} source images/density maps changed; rebuilding")
+            return False
+    n, size, ds = len(index['img_names']), index['target_size'], index['gt_downsample']
+    ds_size = size // ds if ds > 1 else size
+    try:
+        images = np.load(os.path.join(cache_dir, 'images.npy'), mmap_mode='r')
+        density = np.load(os.path.join(cache_dir, 'density.npy'), mmap_mode='r')
+    except (OSError, ValueError):
+        return False
+    if images.shape != (n, size, size, 3) or density.shape != (n, 1, ds_size, ds_size):
+        print(f"🗄️ Cache {cache_dir} arrays don't match its manifest; rebuilding")
+        return False
+    return True
+
+
+class CachedCrowdDataset(Dataset):
+    """
+    CrowdDataset backed by a build_dataset_cache() directory.
+    Arrays are memory-mapped (opened lazily per worker) so samples are read zero-copy;
+    augmentation is still applied on the fly.
+    """
+    def __init__(self, cache_dir, augment=False):
+        self.cache_dir = cache_dir
+        self.augment = augment
+        with open(os.path.join(cache_dir, 'index.json')) as f:
+            index = json.load(f)
+        self.img_names = index['img_names']
+        self.gt_downsample = index['gt_downsample']
+        self.n_samples = len(self.img_names)
+        self._images = None
+        self._density = None
+
+    def __len__(self):
+        return self.n_samples
+
+    def __getstate__(self):
+        # Never pickle the memmaps into worker processes; each worker maps the files itself
+        state = self.__dict__.copy()
+        state['_images'] = None
+        state['_density'] = None
+        return state
+
+    def _open(self):
+        # Copy-on-write maps give writable views without reading the whole file
+        self._images = np.load(os.path.join(self.cache_dir, 'images.npy'), mmap_mode='c')
+        self._density = np.load(os.path.join(self.cache_dir, 'density.npy'), mmap_mode='c')
+
+    def __getitem__(self, index):
+        if self._images is None:
+            self._open()
+        img_tensor = torch.from_numpy(self._images[index]).permute(2, 0, 1).float().div_(255.0)
+        gt_tensor = torch.from_numpy(self._density[index]).clone()
         if self.augment:
-            # Convert to tensor format for torchvision transforms
-            img_tensor = torch.tensor(img.transpose((2, 0, 1)), dtype=torch.float32)
-            gt_tensor = torch.tensor(gt_dmap, dtype=torch.float32)
-
-            # Random horizontal flip
-            if random.random() > 0.5:
-                img_tensor = TF.hflip(img_tensor)
-                gt_tensor = TF.hflip(gt_tensor)
-
-            # Random vertical flip
-            if random.random() > 0.5:
-                img_tensor = TF.vflip(img_tensor)
-                gt_tensor = TF.vflip(gt_tensor)
-
-            # Random rotation (-15° to +15°)
-            angle = random.uniform(-15, 15)
-            img_tensor = TF.rotate(img_tensor, angle, interpolation=TF.InterpolationMode.BILINEAR)
-            gt_tensor = TF.rotate(gt_tensor, angle, interpolation=TF.InterpolationMode.BILINEAR)
-
-            # Optional: Random brightness jitter
-            if random.random() > 0.5:
-                factor = random.uniform(0.8, 1.2)
-                img_tensor = TF.adjust_brightness(img_tensor, factor)
-
-            return img_tensor, gt_tensor
-
-        # --- Default (no augmentation) ---
-        img = torch.tensor(img.transpose((2, 0, 1)), dtype=torch.float32)
-        gt_dmap = torch.tensor(gt_dmap, dtype=torch.float32)
-        return img, gt_dmap
+            return augment_sample(img_tensor, gt_tensor)
+        return img_tensor, gt_tensor
 
 
 # --- Test code ---
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Cost profiler for all pellet counting architectures
+- Parameters, MACs and activation memory per model and per layer
+- p50/p99 latency across batch sizes and thread counts
+- CPU contiguous vs channels_last memory format
+Results are written as JSON for tracking across commits.
+
+Usage:
+    python profile_models.py --output profile_results.json
+    python profile_models.py --models EnhancedMCNNForPellets LightweightMCNN --batch-sizes 1 4
+"""
+
+import os
+import json
+import time
+import argparse
+import platform
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from mcnn_model import MCNN, ImprovedMCNN, MCNNPlusPlus
+from enhanced_mcnn_model import EnhancedMCNNForPellets, UltraEnhancedMCNN, LightweightMCNN
+
+
+MODELS = OrderedDict([
+    ('MCNN', MCNN),
+    ('ImprovedMCNN', ImprovedMCNN),
+    ('MCNNPlusPlus', MCNNPlusPlus),
+    ('EnhancedMCNNForPellets', EnhancedMCNNForPellets),
+    ('UltraEnhancedMCNN', UltraEnhancedMCNN),
+    ('LightweightMCNN', LightweightMCNN),
+])
+
+
+def _leaf_modules(model):
+    return [(name, m) for name, m in model.named_modules() if len(list(m.children())) == 0]
+
+
+def _layer_macs(module, inputs, output):
+    """Multiply-accumulates for a single leaf module call"""
+    if isinstance(module, nn.Conv2d):
+        kh, kw = module.kernel_size
+        return output.numel() * (module.in_channels // module.groups) * kh * kw
+    if isinstance(module, nn.Linear):
+        return output.numel() * module.in_features
+    if isinstance(module, (nn.BatchNorm2d, nn.ReLU, nn.MaxPool2d, nn.Sigmoid, nn.AdaptiveAvgPool2d)):
+        return inputs[0].numel()
+    return 0
+
+
+def profile_layers(model, input_size=512, timing_runs=5):
+    """Per-layer parameters, MACs, output shape/bytes and median time (batch 1, eval mode)"""
+    model.eval()
+    x = torch.rand(1, 3, input_size, input_size)
+    layers = OrderedDict()
+    starts = {}
+    handles = []
+
+    for name, module in _leaf_modules(model):
+        def pre_hook(mod, inputs, name=name):
+            starts[name] = time.perf_counter()
+
+        def hook(mod, inputs, output, name=name):
+            elapsed = (time.perf_counter() - starts[name]) * 1000.0
+            entry = layers.get(name)
+            if entry is None:
+                in_bytes = sum(t.numel() * t.element_size() for t in inputs if torch.is_tensor(t))
+                entry = layers[name] = {
+                    'type': type(mod).__name__,
+                    'params': sum(p.numel() for p in mod.parameters(recurse=False)),
+                    'macs': _layer_macs(mod, inputs, output),
+                    'output_shape': list(output.shape),
+                    'input_bytes': in_bytes,
+                    'output_bytes': output.numel() * output.element_size(),
+                    'times_ms': [],
+                }
+            entry['times_ms'].append(elapsed)
+
+        handles.append(module.register_forward_pre_hook(pre_hook))
+        handles.append(module.register_forward_hook(hook))
+
+    try:
+        with torch.no_grad():
+            model(x)  # warmup
+            for entry in layers.values():
+                entry['times_ms'] = []
+            for _ in range(timing_runs):
+                model(x)
+    finally:
+        for h in handles:
+            h.remove()
+
+    for entry in layers.values():
+        entry['time_ms_p50'] = float(np.median(entry.pop('times_ms')))
+    return layers
+
+
+def peak_activation_bytes(model, layers, input_size=512):
+    """
+    Peak activation memory at batch 1
+    - CUDA: measured with the caching allocator
+    - CPU: estimated by tracking which layer inputs/outputs are still alive at each layer boundary,
+      so multi-column models count every branch output held until the fuse; scratch memory
+      inside a single layer is not included
+    """
+    if torch.cuda.is_available():
+        device = torch.device('cuda')
+        model = model.to(device).eval()
+        x = torch.rand(1, 3, input_size, input_size, device=device)
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        with torch.no_grad():
+            model(x)
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() - base
+        model.to('cpu')
+        return int(peak), 'measured_cuda'
+    peak = max((l['input_bytes'] + l['output_bytes'] for l in layers.values()), default=0)
+    return int(max(peak, _live_activation_peak(model, input_size))), 'estimated_cpu'
+
+
+def _live_activation_peak(model, input_size=512):
+    """Largest total size of tensors alive at once, sampled around every leaf layer call"""
+    model.eval()
+    live = {}  # data_ptr -> bytes, dropped when the tensor is freed
+    peak = [0]
+    handles = []
+
+    def track(tensors):
+        for t in tensors:
+            if torch.is_tensor(t) and t.data_ptr() not in live:
+                live[t.data_ptr()] = t.numel() * t.element_size()
+                weakref.finalize(t, live.pop, t.data_ptr(), None)
+        peak[0] = max(peak[0], sum(live.values()))
+
+    for _, module in _leaf_modules(model):
+        handles.append(module.register_forward_pre_hook(lambda mod, inputs: track(inputs)))
+        handles.append(module.register_forward_hook(lambda mod, inputs, output: track((output,))))
+
+    try:
+        with torch.no_grad():
+            x = torch.rand(1, 3, input_size, input_size)
+            track((x,))
+            model(x)
+    finally:
+        for h in handles:
+            h.remove()
+    return peak[0]
+
+
+def measure_latencies(model, batch_size, input_size=512, channels_last=False, warmup=3, runs=20):
+    """p50/p99 CPU latency in milliseconds for one configuration"""
+    model.eval()
+    x = torch.rand(batch_size, 3, input_size, input_size)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+        x = x.contiguous(memory_format=torch.channels_last)
+    else:
+        model = model.to(memory_format=torch.contiguous_format)
+    timings = []
+    with torch.no_grad():
+        for i in range(warmup + runs):
+            start = time.perf_counter()
+            model(x)
+            if i >= warmup:
+                timings.append((time.perf_counter() - start) * 1000.0)
+    return {
+        'p50_ms': float(np.percentile(timings, 50)),
+        'p99_ms': float(np.percentile(timings, 99)),
+        'images_per_s': float(batch_size * 1000.0 / np.median(timings)),
+    }
+
+
+def profile_model(name, model_cls, batch_sizes, thread_counts, input_size=512, runs=20):
+    print(f"🔎 Profiling {name}")
+    model = model_cls()
+    layers = profile_layers(model, input_size=input_size)
+    peak_bytes, peak_method = peak_activation_bytes(model, layers, input_size=input_size)
+
+    latency = []
+    default_threads = torch.get_num_threads()
+    try:
+        for threads in thread_counts:
+            torch.set_num_threads(threads)
+            for batch_size in batch_sizes:
+                for channels_last in (False, True):
+                    stats = measure_latencies(model, batch_size, input_size=input_size,
+                                              channels_last=channels_last, runs=runs)
+                    stats.update({
+                        'threads': threads,
+                        'batch_size': batch_size,
+                        'memory_format': 'channels_last' if channels_last else 'contiguous',
+                    })
+                    latency.append(stats)
+                    print(f"   threads={threads:<3} batch={batch_size:<3} {stats['memory_format']:<14} "
+                          f"p50={stats['p50_ms']:.1f}ms p99={stats['p99_ms']:.1f}ms")
+    finally:
+        torch.set_num_threads(default_threads)
+
+    total_macs = sum(l['macs'] for l in layers.values())
+    return {
+        'params': sum(p.numel() for p in model.parameters()),
+        'macs': total_macs,
+        'gmacs': total_macs / 1e9,
+        'peak_activation_bytes': peak_bytes,
+        'peak_activation_method': peak_method,
+        'output_shape': list(layers[next(reversed(layers))]['output_shape']) if layers else None,
+        'latency': latency,
+        'layers': layers,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Profile cost of pellet counting models')
+    parser.add_argument('--models', nargs='+', default=list(MODELS.keys()), choices=list(MODELS.keys()))
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 4, 8])
+    parser.add_argument('--threads', nargs='+', type=int,
+                        default=sorted({1, max(1, (os.cpu_count() or 1) // 2), os.cpu_count() or 1}))
+    parser.add_argument('--input-size', type=int, default=512)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--output', default='profile_results.json')
+    args = parser.parse_args()
+
+    results = {
+        'meta': {
+            'torch': torch.__version__,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'input_size': args.input_size,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'models': OrderedDict(),
+    }
+    for name in args.models:
+        results['models'][name] = profile_model(name, MODELS[name], args.batch_sizes, args.threads,
+                                                input_size=args.input_size, runs=args.runs)
+
+    print(f"\n{'Model':<26}{'Params':>12}{'GMACs':>10}{'Peak MB':>10}{'p50 ms (b1)':>13}")
+    for name, r in results['models'].items():
+        b1 = [l for l in r['latency'] if l['batch_size'] == min(args.batch_sizes)
+              and l['memory_format'] == 'contiguous' and l['threads'] == max(args.threads)]
+        p50 = b1[0]['p50_ms'] if b1 else float('nan')
+        print(f"{name:<26}{r['params']:>12,}{r['gmacs']:>10.2f}"
+              f"{r['peak_activation_bytes'] / 2**20:>10.1f}{p50:>13.1f}")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"💾 Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash
-from utils.model_utils import get_feed_ratio, set_feed_ratio
+from utils.feed_config import get_feed_ratio, set_feed_ratio
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 
@@ -1,10 +1,43 @@
 from flask import Blueprint, request, jsonify
-from utils.model_utils import get_model, predict_pellets
-from utils.model_utils import get_feed_ratio
+from utils.feed_config import get_feed_ratio
+from utils import timeseries
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
 
 
+def _token_device():
+    """Device authenticated by an `Authorization: Bearer <api_token>` header, else None"""
+    from utils.device_registry import registry
+    auth = request.headers.get('Authorization', '')
+    return registry.by_token(auth[len('Bearer '):]) if auth.startswith('Bearer ') else None
+
+
+def _request_device():
+    """Device this request is about: its API token, else a device_id field (id or device key) the user owns"""
+    from flask_login import current_user
+    from utils.device_registry import registry
+    if request.headers.get('Authorization', '').startswith('Bearer '):
+        return _token_device()
+    value = request.values.get('device_id', '').strip()
+    if not value or not current_user.is_authenticated:
+        return None
+    device = registry.get(int(value)) if value.isdigit() else registry.by_key(value)
+    if device is None or (device.user_id != current_user.id and not current_user.is_admin):
+        return None
+    return device
+
+
+def _parse_time(value, default):
+    """Epoch seconds or ISO 8601 (naive = server local time) -> epoch seconds"""
+    import datetime
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
 # New endpoint for pellet counting
 @api_bp.route('/count_pellets', methods=['POST'])
 def count_pellets():
@@ -14,9 +47,27 @@ def count_pellets():
     if not image or image.filename == '':
         return jsonify({'error': 'Empty filename'}), 400
     try:
-        model = get_model()
-        pellet_count = predict_pellets(model, image)
-        config = get_feed_ratio()
+        # Optional accuracy mode: TTA + ensemble, with the spread across variants as confidence
+        accuracy_mode = request.form.get('accuracy', '').lower() in ('1', 'true', 'yes')
+        from utils.inference_pool import get_inference_pool
+        pool = get_inference_pool()
+        if pool is not None:
+            # Model runs in a worker process; only PIL/NumPy decoding happens here
+            result = pool.predict(image, accuracy_mode=accuracy_mode)
+        else:
+            # torch is only imported once the first image is counted
+            from utils.model_utils import get_model, predict_pellets
+            result = predict_pellets(get_model(), image, accuracy_mode=accuracy_mode)
+        confidence = None
+        if accuracy_mode:
+            pellet_count = result['pellet_count']
+            confidence = {k: result[k] for k in ('std', 'variance', 'cv', 'variants')}
+        else:
+            pellet_count = result
+        from flask_login import current_user
+        device = _request_device()
+        owner_id = current_user.id if current_user.is_authenticated else (device.user_id if device else None)
+        config = get_feed_ratio(owner_id)
         pellets = float(config.get('pellets', 1))
         grams = float(config.get('grams', 1))
         if pellets <= 0:
@@ -24,15 +75,14 @@ def count_pellets():
         grams_to_dispense = round(grams * (pellet_count / pellets), 2)
 
         # Get user's next active schedule and subtract dispensed grams
-        from flask_login import current_user
         from app import db, FeedSchedule
         import datetime
         scheduled_grams = None
         remaining_grams = None
-        if current_user.is_authenticated:
+        if owner_id is not None:
             now = datetime.datetime.now().time()
             schedule = db.session.query(FeedSchedule).filter(
-                FeedSchedule.created_by == current_user.id,
+                FeedSchedule.created_by == owner_id,
                 FeedSchedule.is_active == True,
                 FeedSchedule.feed_time >= now
             ).order_by(FeedSchedule.feed_time.asc()).first()
@@ -40,11 +90,122 @@ def count_pellets():
                 scheduled_grams = schedule.amount_grams
                 remaining_grams = round(scheduled_grams - grams_to_dispense, 2)
 
+        # Uploads without a device identity (web, scripts) count for the owner's default device,
+        # the same device their device-less schedules dispense to
+        if device is None and owner_id is not None:
+            from utils.device_registry import registry
+            device = registry.default_for_user(owner_id)
+        timeseries.record('pellet_count', pellet_count, device_id=device.id if device else None)
+        timeseries.record('pellet_grams', grams_to_dispense, device_id=device.id if device else None)
+
+        # Persist the count; only counts following a scheduled dispense feed adaptive amounts
+        from app import DispenseLog, PelletCount
+        from utils.adaptive_feeding import preceding_dispense
+        dispense = preceding_dispense(db, DispenseLog, device.id) if device else None
+        db.session.add(PelletCount(
+            device_id=device.id if device else None,
+            schedule_id=dispense.schedule_id if dispense else None,
+            dispense_log_id=dispense.id if dispense else None,
+            pellet_count=pellet_count,
+            leftover_grams=grams_to_dispense,
+            remaining_grams=remaining_grams
+        ))
+        db.session.commit()
         return jsonify({
+            'device_id': device.id if device else None,
             'pellet_count': pellet_count,
             'grams_to_dispense': grams_to_dispense,
             'scheduled_grams': scheduled_grams,
-            'remaining_grams': remaining_grams
+            'remaining_grams': remaining_grams,
+            'confidence': confidence
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+
+
+# Device heartbeat: authenticated by the device's API token, coalesced in memory, flushed in bulk
+@api_bp.route('/heartbeat', methods=['POST'])
+def heartbeat():
+    from flask import current_app
+    from utils.device_registry import registry
+    from utils.heartbeats import heartbeats
+    device = _token_device()
+    if device is None:
+        return jsonify({'error': 'Unknown device token'}), 401
+    data = request.get_json(silent=True) or {}
+    if data.get('device_id') not in (None, device.device_key):
+        return jsonify({'error': 'device_id does not match token'}), 403
+    telemetry = {k: v for k, v in data.items() if k != 'device_id'}
+    heartbeats.record(device.id, telemetry)
+    heartbeats.start(current_app._get_current_object(), registry.db, registry.model)
+    # Numeric telemetry (uptime, temperature, ...) also goes to the time-series store
+    for key, value in telemetry.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            timeseries.record(f'device.{key}', value, device_id=device.id)
+    return jsonify({'ok': True})
+
+
+# Range queries over the telemetry store, e.g. ?series=dispensed_grams&device_id=3&start=2025-01-01&agg=sum
+@api_bp.route('/telemetry', methods=['GET'])
+def telemetry():
+    import time
+    from flask_login import current_user
+    from utils.device_registry import registry
+    if not current_user.is_authenticated:
+        return jsonify({'error': 'Login required'}), 401
+    series = request.args.get('series')
+    if not series:
+        return jsonify({'error': 'series is required'}), 400
+    device_id = request.args.get('device_id', type=int)
+    if device_id:
+        device = registry.get(device_id)
+        if device is None or (device.user_id != current_user.id and not current_user.is_admin):
+            return jsonify({'error': 'Unknown device'}), 404
+    elif not current_user.is_admin:
+        return jsonify({'error': 'device_id is required'}), 400
+    try:
+        end = _parse_time(request.args.get('end'), time.time())
+        start = _parse_time(request.args.get('start'), end - 7 * timeseries.DAY)
+        resolution = request.args.get('resolution', 'auto')
+        resolution = timeseries.auto_resolution(start, end) if resolution == 'auto' else int(resolution)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid range: {e}'}), 400
+    agg = request.args.get('agg', 'sum')
+    if agg not in ('sum', 'mean', 'count'):
+        return jsonify({'error': 'agg must be sum, mean or count'}), 400
+    rows = timeseries.store.query(series, device_id, start, end, resolution)
+    if agg == 'sum':
+        points = [[ts, total] for ts, total, _ in rows]
+    elif agg == 'mean':
+        points = [[ts, total / count] for ts, total, count in rows]
+    else:
+        points = [[ts, count] for ts, _, count in rows]
+    return jsonify({'series': series, 'device_id': device_id, 'start': start, 'end': end,
+                    'resolution': resolution, 'agg': agg, 'points': points})
+
+
+# Consumption rates, next-day forecasts and anomalies per device (admins: ?all=1 for the whole fleet)
+@api_bp.route('/analytics', methods=['GET'])
+def analytics():
+    from flask_login import current_user
+    from utils.device_registry import registry
+    if not current_user.is_authenticated:
+        return jsonify({'error': 'Login required'}), 401
+    if current_user.is_admin and request.args.get('all', '').lower() in ('1', 'true', 'yes'):
+        devices = registry.all()
+    else:
+        devices = registry.for_user(current_user.id)
+    device_id = request.args.get('device_id', type=int)
+    if device_id is not None:
+        devices = [d for d in devices if d.id == device_id]
+        if not devices:
+            return jsonify({'error': 'Unknown device'}), 404
+    # NumPy is only imported once analytics are first requested
+    from utils.analytics import get_analytics
+    names = {d.id: d.name for d in devices}
+    results = [dict(r, name=names[r['device_id']]) for r in get_analytics(names)]
+    return jsonify({
+        'devices': results,
+        'forecast_grams': round(sum(r['forecast_grams'] for r in results), 1),
+        'anomalies': sum(len(r['anomalies']) for r in results),
+    })
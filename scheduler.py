@@ -1,24 +1,115 @@
-from apscheduler.schedulers.background import BackgroundScheduler
-from datetime import datetime
-
-
-# Check database for logged-in user and their schedule
-def feed_chickens():
-    from app import app, db, FeedSchedule, User
-    with app.app_context():
-        # Get all active schedules
-        schedules = FeedSchedule.query.filter_by(is_active=True).all()
-        for schedule in schedules:
-            user = db.session.get(User, schedule.created_by)
-            print(f"Feeding triggered for user {user.username} at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-            print(f"Scheduled time: {schedule.feed_time}, Amount: {schedule.amount_grams}g")
-            # TODO: Add actual feeding logic here (e.g., GPIO, database update, etc.)
-
-scheduler = BackgroundScheduler()
-# Example: Feed every day at 8:00 AM
-scheduler.add_job(feed_chickens, 'cron', hour=8, minute=0)
-
-# Start the scheduler (call this in app.py)
-def start_scheduler():
-    if not scheduler.running:
+"""
+Automated feeding scheduler
+- Exactly one process runs the BackgroundScheduler: the one started with RUN_SCHEDULER=1
+  (or `python app.py`); web workers only write FeedSchedule rows
+- The scheduler process re-syncs its cron jobs from the database every RESYNC_SECONDS, so
+  schedules added, toggled or deleted in any worker are picked up without cross-process calls
+- A nightly job (SCHEDULER_NIGHTLY_HOUR, local time) runs batch maintenance such as
+  adaptive schedule amounts
+- APScheduler is only imported in the scheduler process
+"""
+
+import os
+import atexit
+import threading
+
+
+RESYNC_SECONDS = int(os.getenv('SCHEDULER_RESYNC_SECONDS', '60'))
+NIGHTLY_HOUR = int(os.getenv('SCHEDULER_NIGHTLY_HOUR', '2'))
+
+scheduler = None
+_start_lock = threading.Lock()
+# Set by start_scheduler; passed in rather than imported so `python app.py` never re-imports app
+_app = None
+_feed_task = None
+_schedule_model = None
+_nightly_task = None
+
+
+def scheduler_enabled():
+    """Whether this process is the designated scheduler process"""
+    return os.getenv('RUN_SCHEDULER', '').lower() in ('1', 'true', 'yes')
+
+
+def _job_id(schedule_id):
+    return f'schedule_{schedule_id}'
+
+
+def schedule_job(schedule):
+    """Add or replace the cron job for a FeedSchedule (no-op outside the scheduler process)"""
+    if scheduler is None:
+        return
+    from apscheduler.triggers.cron import CronTrigger
+    scheduler.add_job(
+        func=_feed_task,
+        trigger=CronTrigger(hour=schedule.feed_time.hour, minute=schedule.feed_time.minute),
+        args=[schedule.id],
+        id=_job_id(schedule.id),
+        replace_existing=True
+    )
+
+
+def unschedule_job(schedule_id):
+    """Remove the cron job for a FeedSchedule (no-op outside the scheduler process)"""
+    if scheduler is None:
+        return
+    try:
+        scheduler.remove_job(_job_id(schedule_id))
+    except Exception:
+        pass
+
+
+def sync_jobs():
+    """Reconcile scheduled jobs with the active FeedSchedule rows"""
+    with _app.app_context():
+        try:
+            active = {s.id: s for s in _schedule_model.query.filter_by(is_active=True).all()}
+        except Exception as e:
+            print(f"⚠️ Could not load feed schedules: {e}")
+            return
+        for job in scheduler.get_jobs():
+            if job.id.startswith('schedule_') and int(job.id.split('_', 1)[1]) not in active:
+                scheduler.remove_job(job.id)
+        for schedule in active.values():
+            job = scheduler.get_job(_job_id(schedule.id))
+            fields = {f.name: str(f) for f in job.trigger.fields} if job is not None else {}
+            if (job is None or fields.get('hour') != str(schedule.feed_time.hour)
+                    or fields.get('minute') != str(schedule.feed_time.minute)):
+                schedule_job(schedule)
+
+
+def run_nightly():
+    """Run the nightly task inside an app context"""
+    with _app.app_context():
+        try:
+            _nightly_task()
+        except Exception as e:
+            print(f"⚠️ Nightly task failed: {e}")
+
+
+def start_scheduler(app, feed_task, schedule_model, nightly_task=None):
+    """
+    Start the process-wide scheduler, load jobs from the database and keep them in sync.
+    feed_task(schedule_id) runs a scheduled feed; schedule_model is the FeedSchedule model;
+    nightly_task() (optional) runs once a night at NIGHTLY_HOUR.
+    """
+    global scheduler, _app, _feed_task, _schedule_model, _nightly_task
+    with _start_lock:
+        if scheduler is not None:
+            if _app is not app:
+                print("⚠️ Scheduler already running in this process; ignoring a second start")
+            return scheduler
+        _app, _feed_task, _schedule_model, _nightly_task = app, feed_task, schedule_model, nightly_task
+        from apscheduler.schedulers.background import BackgroundScheduler
+        scheduler = BackgroundScheduler()
         scheduler.start()
+    atexit.register(lambda: scheduler.shutdown(wait=False))
+    sync_jobs()
+    scheduler.add_job(sync_jobs, 'interval', seconds=RESYNC_SECONDS,
+                      id='resync_schedules', replace_existing=True)
+    if nightly_task is not None:
+        scheduler.add_job(run_nightly, 'cron', hour=NIGHTLY_HOUR, minute=0, id='nightly',
+                          replace_existing=True, coalesce=True, misfire_grace_time=3600)
+    feeding_jobs = sum(1 for job in scheduler.get_jobs() if job.id.startswith('schedule_'))
+    print(f"⏰ Scheduler started in process {os.getpid()} ({feeding_jobs} feeding jobs)")
+    return scheduler
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Headless batch scoring of feeder images
+- Images are decoded and resized by a multi-worker DataLoader; inference runs in large batches
+- Optional tiling (image resized to tiles x 512 and split into 512x512 tiles) and fp16/bf16 inference
+- Per-image counts and grams (from the feed ratio) are written to CSV or Parquet
+- Optional density-map dump into a single .npy memmap (row i = i-th scored image)
+
+Usage:
+    python score_images.py --model checkpoints/inference_manifest.json --input ./captures --output counts.csv
+    python score_images.py --model best.pth --input "archive/**/*.jpg" --output counts.parquet \
+        --batch-size 64 --workers 8 --precision fp16 --dump-density densities.npy
+"""
+
+import os
+import csv
+import glob
+import time
+import argparse
+
+import numpy as np
+import torch
+import cv2
+from torch.utils.data import Dataset, DataLoader
+
+try:
+    import pandas as pd
+    PANDAS_AVAILABLE = True
+except ImportError:
+    PANDAS_AVAILABLE = False
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+INPUT_SIZE = 512
+
+
+def find_images(inputs):
+    """Expand directories (recursively) and glob patterns into a sorted, de-duplicated path list"""
+    paths = set()
+    for entry in inputs:
+        if os.path.isdir(entry):
+            for root, _, files in os.walk(entry):
+                paths.update(os.path.join(root, f) for f in files if f.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            paths.update(p for p in glob.glob(entry, recursive=True) if p.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(paths)
+
+
+class ImageScoringDataset(Dataset):
+    """
+    Decode-only dataset: (index, CHW float tensor in [0,1]) resized like CrowdDataset.
+    With tiles > 1 each item is a (tiles*tiles, 3, 512, 512) stack of tiles.
+    Unreadable images yield an empty tensor and are reported as errors.
+    """
+    def __init__(self, paths, tiles=1):
+        self.paths = paths
+        self.tiles = tiles
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        img = cv2.imread(self.paths[index], cv2.IMREAD_COLOR)
+        if img is None:
+            return index, torch.empty(0)
+        size = INPUT_SIZE * self.tiles
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        img = cv2.resize(img, (size, size), interpolation=cv2.INTER_LINEAR)
+        tensor = torch.from_numpy(np.ascontiguousarray(img.transpose((2, 0, 1)))).float().div_(255.0)
+        if self.tiles > 1:
+            # (3, t*512, t*512) -> (t*t, 3, 512, 512), row-major tile order
+            tensor = tensor.view(3, self.tiles, INPUT_SIZE, self.tiles, INPUT_SIZE)
+            tensor = tensor.permute(1, 3, 0, 2, 4).reshape(-1, 3, INPUT_SIZE, INPUT_SIZE)
+        return index, tensor
+
+
+def collate_scoring(batch):
+    """Stack decodable items (tiles flattened into the batch); unreadable indices are returned separately"""
+    indices, tensors, failed = [], [], []
+    for index, tensor in batch:
+        if tensor.numel() == 0:
+            failed.append(index)
+            continue
+        indices.append(index)
+        tensors.append(tensor if tensor.dim() == 4 else tensor.unsqueeze(0))
+    images = torch.cat(tensors) if tensors else torch.empty(0, 3, INPUT_SIZE, INPUT_SIZE)
+    return indices, images, failed
+
+
+def load_scoring_model(model_path, device):
+    """Inference manifest (.json) or any training checkpoint understood by load_model_smart"""
+    if model_path.endswith('.json'):
+        from checkpointing import load_inference_model
+        return load_inference_model(model_path, device)
+    from utils.model_loading import load_model_smart
+    return load_model_smart(model_path, device).eval()
+
+
+def stitch_tiles(density, tiles):
+    """(n*t*t, 1, h, w) tile predictions -> (n, t*h, t*w) full density maps"""
+    if tiles == 1:
+        return density[:, 0]
+    _, _, h, w = density.shape
+    density = density.view(-1, tiles, tiles, h, w).permute(0, 1, 3, 2, 4)
+    return density.reshape(-1, tiles * h, tiles * w)
+
+
+def write_results(rows, output_path):
+    fields = ['path', 'pellet_count', 'grams', 'status']
+    if output_path.endswith('.parquet'):
+        if not PANDAS_AVAILABLE:
+            raise RuntimeError("Parquet output requires pandas (and pyarrow); use a .csv output instead")
+        pd.DataFrame(rows, columns=fields).to_parquet(output_path, index=False)
+        return
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def score_images(model_path, inputs, output_path, batch_size=32, num_workers=4, precision='fp32',
+                 tiles=1, dump_density=None, pellets_per_unit=None, grams_per_unit=None):
+    """Score every image under `inputs`; returns the list of result rows"""
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if precision == 'fp16' and device.type != 'cuda':
+        raise ValueError("fp16 inference needs CUDA; use --precision bf16 or fp32 on CPU")
+    paths = find_images(inputs)
+    if not paths:
+        raise FileNotFoundError(f"No images found in {inputs}")
+
+    if pellets_per_unit is None or grams_per_unit is None:
+        from utils.feed_config import get_feed_ratio
+        ratio = get_feed_ratio()
+        pellets_per_unit = float(ratio.get('pellets', 1)) if pellets_per_unit is None else pellets_per_unit
+        grams_per_unit = float(ratio.get('grams', 1)) if grams_per_unit is None else grams_per_unit
+    if pellets_per_unit <= 0:
+        raise ValueError("Invalid pellets value in feed ratio")
+
+    model = load_scoring_model(model_path, device)
+    autocast_dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(precision)
+    if device.type == 'cuda':
+        model = model.to(memory_format=torch.channels_last)
+
+    # Each DataLoader item is one image; tiles are flattened into the model batch by the collate fn
+    dataset = ImageScoringDataset(paths, tiles=tiles)
+    loader = DataLoader(dataset, batch_size=max(1, batch_size // (tiles * tiles)), shuffle=False,
+                        num_workers=num_workers, pin_memory=device.type == 'cuda',
+                        collate_fn=collate_scoring, persistent_workers=num_workers > 0)
+
+    counts = np.full(len(paths), np.nan, dtype=np.float64)
+    density_out = None
+    start = time.time()
+    with torch.inference_mode():
+        for indices, images, failed in loader:
+            for index in failed:
+                print(f"⚠️ Cannot read image: {paths[index]}")
+            if not indices:
+                continue
+            images = images.to(device, non_blocking=True)
+            if device.type == 'cuda':
+                images = images.contiguous(memory_format=torch.channels_last)
+            with torch.autocast(device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+                density = model(images)
+            density = stitch_tiles(density.float(), tiles)
+            counts[indices] = density.sum(dim=(1, 2)).double().cpu().numpy()
+
+            if dump_density is not None:
+                if density_out is None:
+                    # Shape is only known after the first forward pass
+                    density_out = np.lib.format.open_memmap(
+                        dump_density, mode='w+', dtype=np.float16, shape=(len(paths),) + tuple(density.shape[1:]))
+                density_out[indices] = density.half().cpu().numpy()
+
+    elapsed = time.time() - start
+    if density_out is not None:
+        density_out.flush()
+
+    rows = []
+    for path, count in zip(paths, counts):
+        ok = not np.isnan(count)
+        rows.append({
+            'path': path,
+            'pellet_count': round(float(count), 2) if ok else None,
+            'grams': round(grams_per_unit * (float(count) / pellets_per_unit), 2) if ok else None,
+            'status': 'ok' if ok else 'unreadable',
+        })
+    write_results(rows, output_path)
+
+    scored = int((~np.isnan(counts)).sum())
+    print(f"✅ Scored {scored}/{len(paths)} images in {elapsed:.1f}s "
+          f"({scored / max(elapsed, 1e-9):.1f} img/s) -> {output_path}")
+    if density_out is not None:
+        print(f"🗺️ Density maps written to {dump_density} (rows follow the output order)")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch pellet counting over image directories')
+    parser.add_argument('--model', required=True, help='Inference manifest (.json) or checkpoint (.pth)')
+    parser.add_argument('--input', nargs='+', required=True, help='Image directories and/or glob patterns')
+    parser.add_argument('--output', default='pellet_counts.csv', help='.csv or .parquet')
+    parser.add_argument('--batch-size', type=int, default=32, help='Model batch size (in tiles)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Decode workers')
+    parser.add_argument('--precision', choices=['fp32', 'fp16', 'bf16'], default='fp32')
+    parser.add_argument('--tiles', type=int, default=1,
+                        help='Split each image into tiles x tiles model inputs (higher effective resolution)')
+    parser.add_argument('--dump-density', default=None, help='Write all density maps to this .npy memmap')
+    parser.add_argument('--pellets', type=float, default=None, help='Override feed ratio pellets')
+    parser.add_argument('--grams', type=float, default=None, help='Override feed ratio grams')
+    args = parser.parse_args()
+    if args.precision == 'fp16' and not torch.cuda.is_available():
+        parser.error("--precision fp16 needs CUDA; use bf16 or fp32 on CPU")
+
+    score_images(args.model, args.input, args.output, batch_size=args.batch_size, num_workers=args.workers,
+                 precision=args.precision, tiles=args.tiles, dump_density=args.dump_density,
+                 pellets_per_unit=args.pellets, grams_per_unit=args.grams)
+
+
+if __name__ == '__main__':
+    main()
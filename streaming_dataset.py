@@ -0,0 +1,279 @@
+"""
+Streaming, resumable dataset over WebDataset-style tar shards
+- Each shard holds `<key>.jpg` + `<key>.npy` pairs (see write_shards)
+- Shards are split across ranks and DataLoader workers; reads are prefetched on a thread
+- Shard order and the sample shuffle buffer are seeded by (seed, epoch) for deterministic epochs
+- set_position() resumes mid-epoch by skipping already-consumed samples without decoding them;
+  the per-worker counts are derived exactly from the shard sizes in shards.json, so exact
+  mid-epoch resume needs an index (with plain shard URLs the interrupted epoch restarts)
+"""
+
+import io
+import os
+import json
+import glob
+import queue
+import random
+import tarfile
+import threading
+import subprocess
+import urllib.request
+
+import numpy as np
+import torch
+import cv2
+from torch.utils.data import IterableDataset, get_worker_info
+
+from my_dataloader import resize_density_map, augment_sample
+
+
+SHARD_INDEX = 'shards.json'
+
+
+def write_shards(img_root, gt_dmap_root, out_dir, samples_per_shard=256, gt_downsample=4, target_size=512):
+    """
+    Pack an image/density-map directory pair into tar shards plus a shards.json index.
+    Images are stored as the original encoded bytes; density maps are stored already
+    resized to the model output grid.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    img_names = sorted(
+        filename for filename in os.listdir(img_root)
+        if os.path.isfile(os.path.join(img_root, filename))
+    )
+    index = {'gt_downsample': gt_downsample, 'target_size': target_size, 'shards': []}
+    for shard_no, start in enumerate(range(0, len(img_names), samples_per_shard)):
+        names = img_names[start:start + samples_per_shard]
+        shard_name = f'shard-{shard_no:06d}.tar'
+        with tarfile.open(os.path.join(out_dir, shard_name), 'w') as tar:
+            for img_name in names:
+                key = os.path.splitext(img_name)[0]
+                tar.add(os.path.join(img_root, img_name), arcname=key + '.jpg')
+
+                gt_path = os.path.join(gt_dmap_root, os.path.splitext(img_name)[0] + '.npy')
+                gt_dmap = resize_density_map(np.load(gt_path).astype(np.float32), target_size, gt_downsample)
+                buf = io.BytesIO()
+                np.save(buf, gt_dmap)
+                info = tarfile.TarInfo(key + '.npy')
+                info.size = buf.tell()
+                buf.seek(0)
+                tar.addfile(info, buf)
+        index['shards'].append({'url': shard_name, 'samples': len(names)})
+    with open(os.path.join(out_dir, SHARD_INDEX), 'w') as f:
+        json.dump(index, f, indent=2)
+    return os.path.join(out_dir, SHARD_INDEX)
+
+
+def _open_url(url):
+    """File-like stream for a local path, http(s) URL or `pipe:<command>` (e.g. pipe:aws s3 cp ... -)"""
+    if url.startswith(('http://', 'https://')):
+        return urllib.request.urlopen(url)
+    if url.startswith('pipe:'):
+        return subprocess.Popen(url[5:], shell=True, stdout=subprocess.PIPE, bufsize=1 << 20).stdout
+    return open(url, 'rb')
+
+
+def _iter_tar_samples(url):
+    """Yield (key, {ext: bytes}) from a tar stream, grouping consecutive members by key"""
+    stream = _open_url(url)
+    try:
+        with tarfile.open(fileobj=stream, mode='r|*') as tar:
+            key, sample = None, {}
+            for member in tar:
+                if not member.isfile():
+                    continue
+                member_key, ext = os.path.splitext(member.name)
+                if key is not None and member_key != key:
+                    yield key, sample
+                    sample = {}
+                key = member_key
+                sample[ext.lstrip('.')] = tar.extractfile(member).read()
+            if key is not None and sample:
+                yield key, sample
+    finally:
+        stream.close()
+
+
+class ShardedStreamingDataset(IterableDataset):
+    """
+    Iterable CrowdDataset over tar shards.
+    `source` is a shard directory / shards.json path (sizes known, enables exact resume and DDP
+    step capping) or a list/glob of shard URLs.
+    """
+    def __init__(self, source, gt_downsample=4, target_size=512, augment=False, shuffle=True,
+                 shuffle_buffer=256, prefetch=64, seed=0, rank=0, world_size=1):
+        self.gt_downsample = gt_downsample
+        self.target_size = target_size
+        self.augment = augment
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.prefetch = prefetch
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        self._resume = None  # (epoch, batches_consumed, batch_size, num_workers)
+        self.shards = self._resolve(source)
+
+    @staticmethod
+    def _resolve(source):
+        """[(url, samples or None)] for every shard"""
+        if isinstance(source, (list, tuple)):
+            return [(url, None) for url in source]
+        index_path = os.path.join(source, SHARD_INDEX) if os.path.isdir(source) else source
+        if index_path.endswith('.json') and os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+            base = os.path.dirname(index_path)
+            return [(s['url'] if '://' in s['url'] or s['url'].startswith('pipe:')
+                     else os.path.join(base, s['url']), s['samples']) for s in index['shards']]
+        return [(url, None) for url in sorted(glob.glob(source))]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_position(self, epoch, batches_consumed, batch_size, num_workers):
+        """Resume `epoch` after `batches_consumed` batches (as counted by the training loop)"""
+        self.epoch = epoch
+        self._resume = (epoch, batches_consumed, batch_size, max(1, num_workers))
+
+    def _epoch_shards(self):
+        order = list(range(len(self.shards)))
+        if self.shuffle:
+            random.Random(self.seed * 1000003 + self.epoch).shuffle(order)
+        return [self.shards[i] for i in order]
+
+    def rank_shards(self):
+        return self._epoch_shards()[self.rank::self.world_size]
+
+    def rank_num_samples(self):
+        """Samples this rank will see in the current epoch (None when shard sizes are unknown)"""
+        counts = [n for _, n in self.rank_shards()]
+        return None if any(n is None for n in counts) else sum(counts)
+
+    def __len__(self):
+        total = self.rank_num_samples()
+        if total is None:
+            raise TypeError('Shard sizes unknown; use a shards.json index for len()')
+        return total
+
+    def worker_samples_consumed(self, batches, batch_size, num_workers):
+        """
+        Samples each worker of this rank has delivered after `batches` batches of the current
+        epoch, or None when shard sizes are unknown. Mirrors how DataLoader serves an
+        IterableDataset: batches come round-robin from the workers that still have data, and
+        each worker's last batch may be partial (uneven shard counts/sizes are fine).
+        """
+        sizes = [n for _, n in self.rank_shards()]
+        if any(n is None for n in sizes):
+            return None
+        remaining = [sum(sizes[w::num_workers]) for w in range(num_workers)]
+        consumed = [0] * num_workers
+        while batches > 0 and any(remaining):
+            for w in range(num_workers):
+                if batches == 0:
+                    break
+                if remaining[w]:
+                    take = min(batch_size, remaining[w])
+                    consumed[w] += take
+                    remaining[w] -= take
+                    batches -= 1
+        return consumed
+
+    def _skip_count(self, worker_id, num_workers):
+        if self._resume is None or self._resume[0] != self.epoch:
+            return 0
+        _, batches, batch_size, resume_workers = self._resume
+        if resume_workers != num_workers:
+            print(f"⚠️ Resume position recorded with {resume_workers} workers, now {num_workers}; "
+                  f"restarting epoch {self.epoch} from the beginning")
+            return 0
+        consumed = self.worker_samples_consumed(batches, batch_size, num_workers)
+        if consumed is None:
+            if worker_id == 0 and batches:
+                print(f"⚠️ Shard sizes unknown (no {SHARD_INDEX}); cannot resume mid-epoch exactly, "
+                      f"restarting epoch {self.epoch} from the beginning")
+            return 0
+        return consumed[worker_id]
+
+    def _prefetched(self, shards):
+        """Raw samples from `shards`, read ahead on a background thread"""
+        buf = queue.Queue(maxsize=self.prefetch)
+        done = object()
+        stop = threading.Event()
+
+        def reader():
+            try:
+                for url, _ in shards:
+                    for sample in _iter_tar_samples(url):
+                        while not stop.is_set():
+                            try:
+                                buf.put(sample, timeout=0.1)
+                                break
+                            except queue.Full:
+                                continue
+                        if stop.is_set():
+                            return
+            except Exception as e:
+                buf.put(e)
+            finally:
+                buf.put(done)
+
+        thread = threading.Thread(target=reader, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = buf.get()
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+
+    def _decode(self, sample):
+        img = cv2.imdecode(np.frombuffer(sample['jpg'], dtype=np.uint8), cv2.IMREAD_COLOR)
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB).astype(np.float32) / 255.0
+        img = cv2.resize(img, (self.target_size, self.target_size), interpolation=cv2.INTER_LINEAR)
+
+        gt_dmap = np.load(io.BytesIO(sample['npy'])).astype(np.float32)
+        if gt_dmap.ndim == 3:
+            gt_dmap = gt_dmap[0]
+        ds_size = self.target_size // self.gt_downsample if self.gt_downsample > 1 else self.target_size
+        if gt_dmap.shape != (ds_size, ds_size):
+            gt_dmap = resize_density_map(gt_dmap, self.target_size, self.gt_downsample)[0]
+
+        img_tensor = torch.from_numpy(np.ascontiguousarray(img.transpose((2, 0, 1))))
+        gt_tensor = torch.from_numpy(gt_dmap[np.newaxis, :, :].copy())
+        if self.augment:
+            return augment_sample(img_tensor, gt_tensor)
+        return img_tensor, gt_tensor
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker else (0, 1)
+        shards = self.rank_shards()[worker_id::num_workers]
+        skip = self._skip_count(worker_id, num_workers)
+        rng = random.Random((self.seed * 1000003 + self.epoch) * 7919 + self.rank * 131 + worker_id)
+
+        def ordered():
+            if not self.shuffle:
+                for _, sample in self._prefetched(shards):
+                    yield sample
+                return
+            buffer = []
+            for _, sample in self._prefetched(shards):
+                buffer.append(sample)
+                if len(buffer) >= self.shuffle_buffer:
+                    idx = rng.randrange(len(buffer))
+                    buffer[idx], buffer[-1] = buffer[-1], buffer[idx]
+                    yield buffer.pop()
+            rng.shuffle(buffer)
+            yield from buffer
+
+        # Skipped samples go through the same deterministic order but are never decoded
+        for i, sample in enumerate(ordered()):
+            if i < skip:
+                continue
+            yield self._decode(sample)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Hyperparameter sweep runner for OptimizedTrainingConfig
+- grid / random search with median early-stopping, or successive halving
+- Trials run in parallel worker processes that all read one memory-mapped dataset cache
+  (built once by my_dataloader.build_dataset_cache), so data is decoded only once
+- Writes a leaderboard (CSV + JSON) ranked by best validation MAE
+
+Usage:
+    python sweep.py --mode random --trials 16 --epochs 30 --workers 4
+    python sweep.py --mode halving --trials 27 --min-epochs 3 --eta 3 --max-epochs 81
+    python sweep.py --mode grid --space space.json
+"""
+
+import os
+import csv
+import json
+import math
+import random
+import argparse
+import itertools
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+# Search space: a list means categorical choices (and the grid values);
+# {"loguniform": [lo, hi]} / {"uniform": [lo, hi]} are continuous ranges for random/halving
+DEFAULT_SPACE = {
+    'initial_lr': {'loguniform': [1e-5, 1e-3]},
+    'weight_decay': {'loguniform': [1e-6, 1e-3]},
+    'mse_weight': [0.5, 1.0, 2.0],
+    'mae_weight': [0.0, 0.5, 1.0],
+    'count_loss_weight': [0.5, 1.0, 2.0, 4.0],
+    't_max': [25, 50, 100],
+}
+
+
+def sample_params(space, rng):
+    params = {}
+    for name, spec in space.items():
+        if isinstance(spec, list):
+            params[name] = rng.choice(spec)
+        elif 'loguniform' in spec:
+            lo, hi = spec['loguniform']
+            params[name] = float(math.exp(rng.uniform(math.log(lo), math.log(hi))))
+        elif 'uniform' in spec:
+            lo, hi = spec['uniform']
+            params[name] = float(rng.uniform(lo, hi))
+        else:
+            raise ValueError(f"Unsupported spec for {name}: {spec}")
+    return params
+
+
+def grid_params(space):
+    names = list(space)
+    for name in names:
+        if not isinstance(space[name], list):
+            raise ValueError(f"Grid search needs a list of values for {name}")
+    return [dict(zip(names, values)) for values in itertools.product(*(space[n] for n in names))]
+
+
+def _init_worker(threads):
+    import torch
+    torch.set_num_threads(threads)
+
+
+def run_trial(job):
+    """Train one trial from start_epoch to end_epoch, resuming from/saving to its state file"""
+    import torch
+    import torch.optim as optim
+    import train
+
+    config = train.OptimizedTrainingConfig()
+    for name, value in job['params'].items():
+        setattr(config, name, value)
+    config.cache_dir = job['cache_dir']
+    config.num_workers = 0  # Parallelism comes from the trial processes
+    config.pin_memory = False
+    config.use_mixed_precision = False
+
+    train_loader, val_loader = train.build_dataloaders(config)
+    model = train.EnhancedMCNNForPellets().to(config.device)
+    criterion = train.CombinedLoss(
+        mse_weight=config.mse_weight,
+        mae_weight=config.mae_weight,
+        ssim_weight=config.ssim_weight,
+        count_weight=config.count_loss_weight
+    ).to(config.device)
+    optimizer = optim.AdamW(model.parameters(), lr=config.initial_lr, weight_decay=config.weight_decay)
+    scheduler = optim.lr_scheduler.CosineAnnealingWarmRestarts(
+        optimizer, T_0=int(config.t_max), T_mult=2, eta_min=1e-6)
+
+    history = []
+    # Only a halving rung continues a trial; epoch 0 always starts fresh
+    if job['start_epoch'] > 0:
+        state = torch.load(job['state_path'], map_location=config.device)
+        model.load_state_dict(state['model_state_dict'])
+        optimizer.load_state_dict(state['optimizer_state_dict'])
+        scheduler.load_state_dict(state['scheduler_state_dict'])
+        history = state['history']
+
+    stopped_early = False
+    reports, lock = job.get('reports'), job.get('lock')
+    for epoch in range(job['start_epoch'], job['end_epoch']):
+        train.train_one_epoch(model, train_loader, criterion, optimizer, config)
+        scheduler.step()
+        val_mae = train.compute_metrics(model, val_loader, config.device, criterion)[1]
+        history.append(val_mae)
+        best = min(history)
+        print(f"🧪 trial {job['trial_id']} epoch {epoch + 1}: val MAE {val_mae:.2f} (best {best:.2f})")
+
+        # Median stopping rule against other trials at the same epoch
+        if reports is not None:
+            with lock:
+                others = list(reports.get(epoch, []))
+                reports[epoch] = others + [best]
+            if epoch + 1 >= job['grace_epochs'] and len(others) >= 3 and best > float(np.median(others)):
+                stopped_early = True
+                print(f"✂️ trial {job['trial_id']} stopped at epoch {epoch + 1} (worse than median)")
+                break
+
+    torch.save({
+        'model_state_dict': model.state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'scheduler_state_dict': scheduler.state_dict(),
+        'history': history,
+        'params': job['params'],
+    }, job['state_path'])
+    return {
+        'trial_id': job['trial_id'],
+        'params': job['params'],
+        'epochs': len(history),
+        'best_mae': min(history) if history else float('inf'),
+        'last_mae': history[-1] if history else float('inf'),
+        'stopped_early': stopped_early,
+        'state_path': job['state_path'],
+    }
+
+
+def _make_job(trial_id, params, args, start_epoch, end_epoch, reports=None, lock=None):
+    return {
+        'trial_id': trial_id,
+        'params': params,
+        'start_epoch': start_epoch,
+        'end_epoch': end_epoch,
+        'state_path': os.path.join(args.out_dir, 'trials', f'trial_{trial_id:03d}.pth'),
+        'cache_dir': args.cache_dir,
+        'grace_epochs': args.grace_epochs,
+        'reports': reports,
+        'lock': lock,
+    }
+
+
+def run_median_stopping(trials, args, pool):
+    manager = mp.get_context('spawn').Manager()
+    reports, lock = manager.dict(), manager.Lock()
+    jobs = [_make_job(i, p, args, 0, args.epochs, reports, lock) for i, p in enumerate(trials)]
+    return list(pool.map(run_trial, jobs))
+
+
+def run_successive_halving(trials, args, pool):
+    """Train all trials for min_epochs, keep the best 1/eta, multiply the budget by eta, repeat"""
+    alive = {i: p for i, p in enumerate(trials)}
+    trained = {i: 0 for i in alive}
+    results = {}
+    budget = args.min_epochs
+    while alive:
+        target = min(budget, args.max_epochs)
+        jobs = [_make_job(i, p, args, trained[i], target) for i, p in alive.items()]
+        print(f"\n🪜 Rung: {len(jobs)} trials -> {target} epochs")
+        for result in pool.map(run_trial, jobs):
+            results[result['trial_id']] = result
+            trained[result['trial_id']] = target
+        if target >= args.max_epochs or len(alive) == 1:
+            break
+        keep = max(1, len(alive) // args.eta)
+        ranked = sorted(alive, key=lambda i: results[i]['best_mae'])
+        for i in ranked[keep:]:
+            results[i]['stopped_early'] = True
+        alive = {i: alive[i] for i in ranked[:keep]}
+        budget *= args.eta
+    return list(results.values())
+
+
+def write_leaderboard(results, out_dir):
+    ranked = sorted(results, key=lambda r: r['best_mae'])
+    with open(os.path.join(out_dir, 'leaderboard.json'), 'w') as f:
+        json.dump(ranked, f, indent=2)
+    with open(os.path.join(out_dir, 'leaderboard.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['rank', 'trial_id', 'best_mae', 'last_mae', 'epochs', 'stopped_early', 'params'])
+        for rank, r in enumerate(ranked, 1):
+            writer.writerow([rank, r['trial_id'], r['best_mae'], r['last_mae'], r['epochs'],
+                             r['stopped_early'], json.dumps(r['params'])])
+    return ranked
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hyperparameter sweep for pellet counting training')
+    parser.add_argument('--mode', choices=['grid', 'random', 'halving'], default='random')
+    parser.add_argument('--space', default=None, help='JSON search space (defaults to DEFAULT_SPACE)')
+    parser.add_argument('--trials', type=int, default=16, help='Number of sampled trials (random/halving)')
+    parser.add_argument('--epochs', type=int, default=30, help='Epochs per trial (grid/random)')
+    parser.add_argument('--grace-epochs', type=int, default=5, help='Epochs before median stopping applies')
+    parser.add_argument('--min-epochs', type=int, default=3, help='First rung budget (halving)')
+    parser.add_argument('--max-epochs', type=int, default=81, help='Last rung budget (halving)')
+    parser.add_argument('--eta', type=int, default=3, help='Keep 1/eta of trials per rung (halving)')
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 1) // 4))
+    parser.add_argument('--cache-dir', default='./data/cache')
+    parser.add_argument('--out-dir', default='./sweeps/latest')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    space = DEFAULT_SPACE
+    if args.space:
+        with open(args.space) as f:
+            space = json.load(f)
+    rng = random.Random(args.seed)
+    trials = grid_params(space) if args.mode == 'grid' else [sample_params(space, rng) for _ in range(args.trials)]
+    trials_dir = os.path.join(args.out_dir, 'trials')
+    os.makedirs(trials_dir, exist_ok=True)
+    # --out-dir is reused across sweeps; stale trial states must not leak into this one
+    stale = [f for f in os.listdir(trials_dir) if f.startswith('trial_') and f.endswith('.pth')]
+    for name in stale:
+        os.remove(os.path.join(trials_dir, name))
+    if stale:
+        print(f"🧹 Removed {len(stale)} trial states from a previous sweep in {trials_dir}")
+
+    # Decode the dataset once in the parent; every trial process memory-maps the same files
+    import train
+    config = train.OptimizedTrainingConfig()
+    for split, img_root, gt_root in (('train', config.train_images, config.train_densitymaps),
+                                     ('val', config.val_images, config.val_densitymaps)):
+        split_dir = os.path.join(args.cache_dir, split)
+        if not train.dataset_cache_exists(split_dir, config.gt_downsample, config.target_size, img_root, gt_root):
+            print(f"🗄️ Building {split} dataset cache in {split_dir}")
+            train.build_dataset_cache(img_root, gt_root, split_dir,
+                                      gt_downsample=config.gt_downsample, target_size=config.target_size)
+
+    threads = max(1, (os.cpu_count() or 1) // args.workers)
+    print(f"🔍 {args.mode} sweep: {len(trials)} trials on {args.workers} workers x {threads} threads")
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=mp.get_context('spawn'),
+                             initializer=_init_worker, initargs=(threads,)) as pool:
+        if args.mode == 'halving':
+            results = run_successive_halving(trials, args, pool)
+        else:
+            results = run_median_stopping(trials, args, pool)
+
+    ranked = write_leaderboard(results, args.out_dir)
+    print(f"\n🏆 Leaderboard ({args.out_dir}/leaderboard.csv)")
+    for rank, r in enumerate(ranked[:10], 1):
+        flag = ' (stopped)' if r['stopped_early'] else ''
+        print(f"{rank:>3}. trial {r['trial_id']:<4} MAE {r['best_mae']:.2f} after {r['epochs']} epochs{flag} "
+              f"{json.dumps(r['params'])}")
+
+
+if __name__ == '__main__':
+    main()
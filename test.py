@@ -17,95 +17,10 @@ except ImportError:
 from my_dataloader import CrowdDataset
 
 
-def load_model_smart(model_param_path, device):
-    '''
-    Smart model loading that handles different checkpoint formats and model types
-    '''
-    # Load checkpoint
-    checkpoint = torch.load(model_param_path, map_location=device)
-    
-    # Try to determine model type from checkpoint
-    if isinstance(checkpoint, dict):
-        if 'model_state_dict' in checkpoint:
-            state_dict = checkpoint['model_state_dict']
-            print(f"✅ Loaded checkpoint from epoch {checkpoint.get('epoch', 'unknown')}")
-        else:
-            state_dict = checkpoint
-        
-        # Check if this is an enhanced model or original model based on keys
-        if any('fusion' in key for key in state_dict.keys()):
-            # This is likely an Enhanced model
-            try:
-                from enhanced_mcnn_model import EnhancedMCNNForPellets
-                model = EnhancedMCNNForPellets().to(device)
-                model.load_state_dict(state_dict)
-                print("✅ Loaded Enhanced MCNN model")
-                return model
-            except Exception as e:
-                print(f"⚠️ Failed to load as Enhanced model: {e}")
-        
-        # Try original ImprovedMCNN
-        try:
-            from mcnn_model import ImprovedMCNN
-            model = ImprovedMCNN().to(device)
-            model.load_state_dict(state_dict)
-            print("✅ Loaded Improved MCNN model")
-            return model
-        except Exception as e:
-            print(f"⚠️ Failed to load as Improved model: {e}")
-        
-        # Try original MCNN
-        try:
-            from mcnn_model import MCNN
-            model = MCNN().to(device)
-            model.load_state_dict(state_dict)
-            print("✅ Loaded Original MCNN model")
-            return model
-        except Exception as e:
-            print(f"❌ Failed to load as Original model: {e}")
-    
-    raise Exception("Could not determine model type or load checkpoint")
-
+# Shared helpers (kept importable from here for existing scripts)
+from utils.model_loading import load_model_smart
+from utils.model_eval import cal_mae, cal_mae_multi
 
-def cal_mae(img_root,gt_dmap_root,model_param_path):
-    '''
-    Calculate the MAE, MSE, and RMSE of the test data.
-    img_root: the root of test image data.
-    gt_dmap_root: the root of test ground truth density-map data.
-    model_param_path: the path of specific mcnn parameters.
-    '''
-    import numpy as np
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    
-    # Smart model loading
-    mcnn = load_model_smart(model_param_path, device)
-    
-    # Get list of image files
-    img_names = [f for f in os.listdir(img_root) if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
-    dataset=CrowdDataset(img_root,gt_dmap_root,img_names,gt_downsample=4)
-    dataloader=torch.utils.data.DataLoader(dataset,batch_size=2,shuffle=False)
-    mcnn.eval()
-    mae, mse = 0.0, 0.0
-    with torch.no_grad():
-        for i,(img,gt_dmap) in enumerate(dataloader):
-            img=img.to(device)
-            gt_dmap=gt_dmap.to(device)
-            # forward propagation
-            et_dmap=mcnn(img)
-            # Calculate counts
-            pred_count = et_dmap.data.sum().item()
-            gt_count = gt_dmap.data.sum().item()
-            diff = pred_count - gt_count
-            mae += abs(diff)
-            mse += diff * diff
-            del img,gt_dmap,et_dmap
-
-    mae /= len(dataloader)
-    mse /= len(dataloader)
-    rmse = np.sqrt(mse)
-    
-    print(f"model_param_path: {model_param_path}")
-    print(f"MAE: {mae:.2f}, MSE: {mse:.2f}, RMSE: {rmse:.2f}")
 
 def compare_predictions(img_root, gt_dmap_root, model_param_path, index):
     '''
@@ -1,10 +1,14 @@
+import os
 import requests
 
 url = "http://127.0.0.1:5000/api/count_pellets"
 image_path = "./test.jpg"
+# Optional: the device's API token (Devices page) so the count is recorded for that feeder
+device_token = os.getenv("DEVICE_TOKEN")
 
 with open(image_path, "rb") as img:
     files = {"image": img}
-    response = requests.post(url, files=files)
+    headers = {"Authorization": f"Bearer {device_token}"} if device_token else {}
+    response = requests.post(url, files=files, headers=headers)
 
-print(response.json())
\ No newline at end of file
+print(response.json())
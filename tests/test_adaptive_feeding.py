@@ -0,0 +1,18 @@
+from utils import adaptive_feeding
+from utils.adaptive_feeding import plan_amounts
+
+
+def test_large_leftover_reduces_amount_by_at_most_max_step():
+    changes = plan_amounts([(1, 100, 60.0)])
+
+    assert changes == {1: round(100 * (1 - adaptive_feeding.MAX_STEP))}
+
+
+def test_leftover_at_target_keeps_amount():
+    assert plan_amounts([(1, 100, 100 * adaptive_feeding.TARGET_LEFTOVER)]) == {}
+
+
+def test_empty_tray_increases_amount_within_bounds():
+    changes = plan_amounts([(1, 80, 0.0), (2, 150, 0.0)])
+
+    assert changes == {1: 82}  # 80 + 0.5 * 4; 150 is already the maximum
@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('torch')
+pytest.importorskip('cv2')
+plt = pytest.importorskip('matplotlib.pyplot')
+
+from my_dataloader import build_dataset_cache, dataset_cache_exists
+
+
+def make_split(tmp_path, n=2, size=32):
+    img_root, gt_root = tmp_path / 'images', tmp_path / 'densitymaps'
+    img_root.mkdir()
+    gt_root.mkdir()
+    for i in range(n):
+        plt.imsave(str(img_root / f'img_{i}.png'), np.full((size, size, 3), i / n, dtype=np.float32))
+        np.save(str(gt_root / f'img_{i}.npy'), np.full((size, size), 0.01, dtype=np.float32))
+    return str(img_root), str(gt_root)
+
+
+def test_changed_density_map_triggers_rebuild(tmp_path):
+    img_root, gt_root = make_split(tmp_path)
+    cache_dir = str(tmp_path / 'cache')
+    build_dataset_cache(img_root, gt_root, cache_dir, gt_downsample=4, target_size=32)
+    assert dataset_cache_exists(cache_dir, 4, 32, img_root, gt_root)
+
+    relabelled = os.path.join(gt_root, 'img_1.npy')
+    np.save(relabelled, np.full((32, 32), 0.02, dtype=np.float32))
+    st = os.stat(relabelled)
+    os.utime(relabelled, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))  # same size, newer mtime
+
+    assert not dataset_cache_exists(cache_dir, 4, 32, img_root, gt_root)
+    build_dataset_cache(img_root, gt_root, cache_dir, gt_downsample=4, target_size=32)
+    assert dataset_cache_exists(cache_dir, 4, 32, img_root, gt_root)
+    density = np.load(os.path.join(cache_dir, 'density.npy'))
+    assert density[1].sum() == pytest.approx(2 * density[0].sum())
+
+
+def test_added_image_triggers_rebuild(tmp_path):
+    img_root, gt_root = make_split(tmp_path)
+    cache_dir = str(tmp_path / 'cache')
+    build_dataset_cache(img_root, gt_root, cache_dir, gt_downsample=4, target_size=32)
+
+    plt.imsave(os.path.join(img_root, 'img_2.png'), np.zeros((32, 32, 3), dtype=np.float32))
+    np.save(os.path.join(gt_root, 'img_2.npy'), np.zeros((32, 32), dtype=np.float32))
+
+    assert not dataset_cache_exists(cache_dir, 4, 32, img_root, gt_root)
@@ -0,0 +1,31 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+np = pytest.importorskip('numpy')
+
+from utils import model_utils
+
+
+class StubModel(torch.nn.Module):
+    """Density map of ones at 1/4 resolution; records every batch it sees"""
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def forward(self, x):
+        self.calls.append(tuple(x.shape))
+        return torch.ones(x.shape[0], 1, x.shape[2] // 4, x.shape[3] // 4)
+
+
+def test_accuracy_mode_without_ensemble_uses_the_given_model(monkeypatch):
+    monkeypatch.setattr(model_utils, 'ENSEMBLE_CHECKPOINTS', [])
+    monkeypatch.setattr(model_utils, 'get_model', lambda *a, **k: pytest.fail('default model loaded'))
+    model = StubModel()
+
+    result = model_utils.predict_array(model, np.zeros((3, 64, 64), dtype=np.float32),
+                                       torch.device('cpu'), accuracy_mode=True, scales=(1.0,))
+
+    assert len(model.calls) == 1
+    assert model.calls[0][0] == len(model_utils.TTA_FLIPS)
+    assert result['variants'] == len(model_utils.TTA_FLIPS)
+    assert result['pellet_count'] == pytest.approx(16 * 16)
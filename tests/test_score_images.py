@@ -0,0 +1,43 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+cv2 = pytest.importorskip('cv2')
+
+from score_images import INPUT_SIZE, ImageScoringDataset, collate_scoring, stitch_tiles
+
+
+QUADRANTS = [[0, 60], [120, 180]]  # gray level of each tile, row-major
+
+
+def write_quadrant_image(path):
+    size = INPUT_SIZE * 2
+    img = np.zeros((size, size, 3), dtype=np.uint8)
+    for r in range(2):
+        for c in range(2):
+            img[r * INPUT_SIZE:(r + 1) * INPUT_SIZE, c * INPUT_SIZE:(c + 1) * INPUT_SIZE] = QUADRANTS[r][c]
+    cv2.imwrite(str(path), img)
+    return str(path)
+
+
+def test_tiles_2_round_trip_keeps_tile_order(tmp_path):
+    paths = [write_quadrant_image(tmp_path / 'a.png'), write_quadrant_image(tmp_path / 'b.png'),
+             str(tmp_path / 'missing.png')]
+    dataset = ImageScoringDataset(paths, tiles=2)
+
+    indices, images, failed = collate_scoring([dataset[i] for i in range(len(paths))])
+
+    assert indices == [0, 1] and failed == [2]
+    assert images.shape == (8, 3, INPUT_SIZE, INPUT_SIZE)
+    expected = torch.tensor([v for row in QUADRANTS for v in row] * 2, dtype=torch.float32) / 255.0
+    assert torch.allclose(images.mean(dim=(1, 2, 3)), expected, atol=1e-6)
+
+    # Stand-in model: 1-channel density map at 1/4 resolution
+    density = stitch_tiles(images[:, :1, ::4, ::4], tiles=2)
+
+    assert density.shape == (2, INPUT_SIZE // 2, INPUT_SIZE // 2)
+    half = INPUT_SIZE // 4
+    for r in range(2):
+        for c in range(2):
+            block = density[:, r * half:(r + 1) * half, c * half:(c + 1) * half]
+            assert torch.allclose(block, torch.full_like(block, QUADRANTS[r][c] / 255.0), atol=1e-6)
@@ -0,0 +1,50 @@
+from utils.timeseries import DAY, RAW, TimeSeriesStore
+
+
+NOW = 1_700_000_000 - 1_700_000_000 % DAY + 12 * 3600  # noon, UTC
+TODAY = NOW // DAY
+
+
+def make_store(tmp_path, **kwargs):
+    return TimeSeriesStore(path=str(tmp_path / 'telemetry.sqlite'), **kwargs)
+
+
+def test_60s_query_over_packed_raw_chunks(tmp_path):
+    store = make_store(tmp_path)
+    base = (TODAY - 2) * DAY
+    for i in range(10):
+        store.record('dispensed_grams', 5.0, device_id=1, ts=base + i * 30)
+    store.flush()
+    store.compact(now=NOW)
+
+    points = store.query('dispensed_grams', 1, base, base + 3600, resolution=60)
+
+    assert [(ts - base, total, count) for ts, total, count in points] == [
+        (m * 60, 10.0, 2) for m in range(5)]
+
+
+def test_60s_query_falls_back_to_rollups_after_raw_expired(tmp_path):
+    store = make_store(tmp_path, raw_days=1)
+    base = (TODAY - 5) * DAY
+    for i in range(10):
+        store.record('dispensed_grams', 5.0, device_id=1, ts=base + i * 30)
+    store.flush()
+    store.compact(now=NOW)
+
+    points = store.query('dispensed_grams', 1, base, base + 3600, resolution=60)
+
+    # Raw points are gone; the 5-minute rollup still covers the range
+    assert [(ts - base, total, count) for ts, total, count in points] == [(0, 50.0, 10)]
+
+
+def test_raw_query_includes_staged_and_packed_points(tmp_path):
+    store = make_store(tmp_path)
+    store.record('pellet_count', 3, device_id=2, ts=(TODAY - 1) * DAY + 10)
+    store.flush()
+    store.compact(now=NOW)
+    store.record('pellet_count', 4, device_id=2, ts=TODAY * DAY + 10)
+    store.flush()
+
+    points = store.query('pellet_count', 2, (TODAY - 1) * DAY, NOW, resolution=RAW)
+
+    assert [(total, count) for _, total, count in points] == [(3.0, 1), (4.0, 1)]
@@ -8,10 +8,16 @@ Optimized training script for MCNN pellet counting with maximum accuracy focus
 """
 
 import os
+import copy
+import contextlib
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
-from torch.utils.data import DataLoader
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, Sampler
+from torch.utils.data.distributed import DistributedSampler
 import numpy as np
 import time
 import csv
@@ -20,7 +26,7 @@ import matplotlib.pyplot as plt
 
 # Import our enhanced models and dataloader
 try:
-    from enhanced_mcnn_model import EnhancedMCNNForPellets
+    from enhanced_mcnn_model import EnhancedMCNNForPellets, LightweightMCNN
     ENHANCED_AVAILABLE = True
     print("✅ Using enhanced models and dataloader")
 except ImportError as e:
@@ -30,15 +36,10 @@ except ImportError as e:
 
 # Import dataloader (use original for compatibility)
 from my_dataloader import CrowdDataset as EnhancedPelletDataset
-
-# Optional advanced losses
-try:
-    from pytorch_msssim import ssim, SSIM
-    SSIM_AVAILABLE = True
-    print("✅ SSIM loss available")
-except ImportError:
-    SSIM_AVAILABLE = False
-    print("⚠️ SSIM loss not available")
+from my_dataloader import CachedCrowdDataset, BatchAugmenter, build_dataset_cache, dataset_cache_exists
+from evaluation import evaluate_models, accumulate_counts, finalize_metrics
+from checkpointing import CheckpointManager
+from streaming_dataset import ShardedStreamingDataset
 
 
 class OptimizedTrainingConfig:
@@ -67,25 +68,96 @@ class OptimizedTrainingConfig:
         
         # Model saving
         self.save_dir = './checkpoints'
+        self.keep_top_k = 3  # Checkpoints kept on disk, ranked by validation MAE
+        self.inference_fp16 = False  # Store the exported inference weights in float16
         self.log_csv = os.path.join(self.save_dir, 'training_log_optimized.csv')
         
         # Loss weights
         self.mse_weight = 1.0
         self.mae_weight = 0.5
-        self.ssim_weight = 0.3 if SSIM_AVAILABLE else 0.0
+        # SSIM is computed locally (SeparableSSIM), so this term is now on for every install; before,
+        # installs without pytorch_msssim trained with 0.0 here - set 0.0 to reproduce those runs
+        self.ssim_weight = 0.3
         self.count_loss_weight = 2.0  # Focus on accurate counting
         
+        # Progress-bar refresh interval in steps (loss values are only synced to host here)
+        self.log_interval = 20
+        
         # Mixed precision
         self.use_mixed_precision = torch.cuda.is_available()
         
+        # CPU fast path: benchmark channels_last / bfloat16 autocast / torch.compile at startup
+        self.cpu_optimize = False
+        self.cpu_try_compile = False
+        self.cpu_benchmark_steps = 5
+        self.channels_last = False
+        self.cpu_bf16 = False
+        self.compile_model = False
+        
         # Data settings
         self.target_size = 512
         self.gt_downsample = 4  # 128x128 output
+        self.train_images = './data/train_data/images'
+        self.train_densitymaps = './data/train_data/densitymaps'
+        self.val_images = './data/test_data/images'
+        self.val_densitymaps = './data/test_data/densitymaps'
+        self.cache_dir = None  # Preprocessed memmap cache (built on first use)
+        self.gpu_augment = False  # Augment whole batches on the training device instead of in workers
+        
+        # Streaming tar shards (directory with shards.json, or glob/URL list) instead of train_images
+        self.train_shards = None
+        self.stream_seed = 0
+        self.resume_every_batches = 200  # Rolling mid-epoch resume state when streaming
+        
+        # Distributed data parallel (launch with torchrun; batch_size is per process)
+        self.distributed = False
+        self.dist_backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+        self.rank = 0
+        self.local_rank = 0
+        self.world_size = 1
+        
+        # Knowledge distillation (train.py --mode distill)
+        self.teacher_checkpoint = None
+        self.distill_alpha = 0.5  # Weight of ground-truth loss vs. teacher loss
+        self.student_save_dir = './checkpoints_student'
+        self.latency_runs = 20
+
+
+class SeparableSSIM(nn.Module):
+    """
+    SSIM with an 11x11 Gaussian window (sigma 1.5, valid padding) applied as two 1D convolutions.
+    All five local statistics (x, y, x^2, y^2, xy) are filtered in a single grouped conv pass.
+    """
+    def __init__(self, win_size=11, sigma=1.5, data_range=1.0, k1=0.01, k2=0.03):
+        super(SeparableSSIM, self).__init__()
+        coords = torch.arange(win_size, dtype=torch.float32) - win_size // 2
+        g = torch.exp(-(coords ** 2) / (2 * sigma ** 2))
+        self.register_buffer('window', (g / g.sum()).view(1, 1, 1, win_size))
+        self.c1 = (k1 * data_range) ** 2
+        self.c2 = (k2 * data_range) ** 2
+    
+    def _filter(self, x):
+        channels = x.size(1)
+        w = self.window.to(x.dtype)
+        x = F.conv2d(x, w.expand(channels, 1, 1, -1), groups=channels)
+        return F.conv2d(x, w.transpose(2, 3).expand(channels, 1, -1, 1), groups=channels)
+    
+    def forward(self, x, y):
+        c = x.size(1)
+        stats = self._filter(torch.cat([x, y, x * x, y * y, x * y], dim=1))
+        mu_x, mu_y, xx, yy, xy = torch.split(stats, c, dim=1)
+        mu_xx, mu_yy, mu_xy = mu_x * mu_x, mu_y * mu_y, mu_x * mu_y
+        sigma_x, sigma_y, sigma_xy = xx - mu_xx, yy - mu_yy, xy - mu_xy
+        ssim_map = ((2 * mu_xy + self.c1) * (2 * sigma_xy + self.c2)) / \
+                   ((mu_xx + mu_yy + self.c1) * (sigma_x + sigma_y + self.c2))
+        return ssim_map.mean()
 
 
 class CombinedLoss(nn.Module):
     """
     Advanced loss combining multiple objectives for better pellet counting
+    - MSE, L1 and count terms are all derived from one difference map
+    - loss_dict values are detached tensors; call .item() only when logging
     """
     def __init__(self, mse_weight=1.0, mae_weight=0.5, ssim_weight=0.3, count_weight=2.0):
         super(CombinedLoss, self).__init__()
@@ -94,116 +166,319 @@ class CombinedLoss(nn.Module):
         self.ssim_weight = ssim_weight
         self.count_weight = count_weight
         
-        self.mse_loss = nn.MSELoss()
-        self.mae_loss = nn.L1Loss()
-        
-        if SSIM_AVAILABLE and ssim_weight > 0:
-            self.ssim_loss = SSIM(data_range=1.0, size_average=True, channel=1)
-        else:
-            self.ssim_loss = None
+        self.ssim_loss = SeparableSSIM(data_range=1.0) if ssim_weight > 0 else None
     
     def forward(self, pred, target):
-        # Basic pixel-wise losses
-        mse = self.mse_loss(pred, target)
-        mae = self.mae_loss(pred, target)
+        # Pixel-wise terms from a single difference map
+        diff = pred - target
+        mse = diff.pow(2).mean()
+        mae = diff.abs().mean()
         
-        # Count-based loss (most important for accuracy)
-        pred_count = torch.sum(pred, dim=(2, 3))
-        target_count = torch.sum(target, dim=(2, 3))
-        count_loss = nn.functional.mse_loss(pred_count, target_count)
+        # Count-based loss (most important for accuracy): sum(pred) - sum(target) == sum(diff)
+        count_loss = diff.sum(dim=(2, 3)).pow(2).mean()
         
         # Combine losses
         total_loss = (self.mse_weight * mse + 
                      self.mae_weight * mae + 
                      self.count_weight * count_loss)
         
-        # Add SSIM if available
-        if self.ssim_loss is not None and self.ssim_weight > 0:
+        loss_dict = {
+            'mse': mse.detach(),
+            'mae': mae.detach(),
+            'count_loss': count_loss.detach(),
+        }
+        
+        if self.ssim_loss is not None:
             # SSIM expects values in [0,1], so normalize
             pred_norm = torch.clamp(pred / (pred.max() + 1e-8), 0, 1)
             target_norm = torch.clamp(target / (target.max() + 1e-8), 0, 1)
-            ssim_val = self.ssim_loss(pred_norm, target_norm)
-            ssim_loss = 1.0 - ssim_val
-            total_loss += self.ssim_weight * ssim_loss
-            
-            return total_loss, {
-                'mse': mse.item(),
-                'mae': mae.item(), 
-                'count_loss': count_loss.item(),
-                'ssim_loss': ssim_loss.item(),
-                'total': total_loss.item()
-            }
-        
-        return total_loss, {
-            'mse': mse.item(),
-            'mae': mae.item(),
-            'count_loss': count_loss.item(), 
-            'total': total_loss.item()
-        }
+            ssim_loss = 1.0 - self.ssim_loss(pred_norm, target_norm)
+            total_loss = total_loss + self.ssim_weight * ssim_loss
+            loss_dict['ssim_loss'] = ssim_loss.detach()
+        
+        loss_dict['total'] = total_loss.detach()
+        return total_loss, loss_dict
 
 
-def compute_metrics(model, dataloader, device, criterion):
-    """Comprehensive metric computation"""
+class DistillationLoss(nn.Module):
+    """
+    Student loss against both the ground truth and the teacher's density maps
+    - Ground-truth term reuses CombinedLoss
+    - Teacher term matches density maps pixel-wise and in total count
+    """
+    def __init__(self, base_criterion, alpha=0.5, count_weight=2.0):
+        super(DistillationLoss, self).__init__()
+        self.base_criterion = base_criterion
+        self.alpha = alpha
+        self.count_weight = count_weight
+    
+    def forward(self, pred, target, teacher_pred):
+        gt_loss, loss_dict = self.base_criterion(pred, target)
+        
+        # Soft targets from the teacher
+        kd_map = nn.functional.mse_loss(pred, teacher_pred)
+        kd_count = nn.functional.mse_loss(torch.sum(pred, dim=(2, 3)),
+                                          torch.sum(teacher_pred, dim=(2, 3)))
+        kd_loss = kd_map + self.count_weight * kd_count
+        
+        total_loss = self.alpha * gt_loss + (1.0 - self.alpha) * kd_loss
+        loss_dict = dict(loss_dict, kd_loss=kd_loss.detach(), total=total_loss.detach())
+        return total_loss, loss_dict
+
+
+def measure_latency(model, device, batch_size=1, input_size=512, warmup=5, runs=20):
+    """Median forward latency in milliseconds for a random input batch"""
     model.eval()
-    total_loss = 0.0
-    total_mae = 0.0
-    total_mse = 0.0
+    x = torch.rand(batch_size, 3, input_size, input_size, device=device)
+    timings = []
+    with torch.no_grad():
+        for i in range(warmup + runs):
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            model(x)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            if i >= warmup:
+                timings.append((time.perf_counter() - start) * 1000.0)
+    return float(np.median(timings))
+
+
+def compute_metrics(model, dataloader, device, criterion):
+    """Comprehensive metric computation (per-image counts accumulated on-device)"""
+    metrics = evaluate_models([model], dataloader, device, criterion)[0]
+    return metrics['loss'], metrics['mae'], metrics['mse'], metrics['rmse']
+
+
+def train_one_epoch(model, dataloader, criterion, optimizer, config, augmenter=None):
+    """Plain single-process training epoch (used by sweep.py); returns the mean training loss"""
+    model.train()
+    total_loss = torch.zeros((), dtype=torch.float64, device=config.device)
     total_samples = 0
+    for images, targets in dataloader:
+        images = images.to(config.device)
+        targets = targets.to(config.device)
+        if augmenter is not None:
+            images, targets = augmenter(images, targets)
+        
+        optimizer.zero_grad()
+        predictions = model(images)
+        loss, _ = criterion(predictions, targets)
+        loss.backward()
+        torch.nn.utils.clip_grad_norm_(model.parameters(), config.gradient_clip_norm)
+        optimizer.step()
+        
+        total_loss += loss.detach().double() * images.size(0)
+        total_samples += images.size(0)
+    return total_loss.item() / max(total_samples, 1)
+
+
+class EvalShardSampler(Sampler):
+    """Strided, non-padded split of a dataset across ranks so all-reduced metrics count every image once"""
+    def __init__(self, dataset, rank, world_size):
+        self.indices = list(range(rank, len(dataset), world_size))
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+def setup_distributed(config):
+    """Initialise the process group from torchrun environment variables (RANK, WORLD_SIZE, LOCAL_RANK)"""
+    config.rank = int(os.environ.get('RANK', 0))
+    config.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    config.world_size = int(os.environ.get('WORLD_SIZE', 1))
+    dist.init_process_group(backend=config.dist_backend, rank=config.rank, world_size=config.world_size)
     
-    with torch.no_grad():
-        for images, targets in dataloader:
-            images = images.to(device)
-            targets = targets.to(device)
-            
-            predictions = model(images)
-            loss, loss_dict = criterion(predictions, targets)
-            
-            # Count-based metrics
-            pred_counts = torch.sum(predictions, dim=(2, 3))
-            target_counts = torch.sum(targets, dim=(2, 3))
-            
-            batch_size = images.size(0)
-            total_samples += batch_size
-            total_loss += loss.item() * batch_size
-            
-            # Accumulate errors
-            for i in range(batch_size):
-                pred_count = pred_counts[i].item()
-                target_count = target_counts[i].item()
-                error = abs(pred_count - target_count)
-                total_mae += error
-                total_mse += error * error
+    if config.dist_backend == 'nccl':
+        torch.cuda.set_device(config.local_rank)
+        config.device = torch.device('cuda', config.local_rank)
+    else:
+        config.device = torch.device('cpu')
+        config.use_mixed_precision = False
+        # Split cores between the processes on this node instead of oversubscribing
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+        config.pin_memory = False
+
+
+def all_reduce_sum(tensor, config):
+    """Sum a tensor across ranks (no-op when not distributed)"""
+    if config.distributed:
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def _cpu_autocast(enabled):
+    return torch.autocast('cpu', dtype=torch.bfloat16) if enabled else contextlib.nullcontext()
+
+
+def select_cpu_training_options(model, criterion, images, targets, config):
+    """
+    Time a few forward/backward steps for each CPU option combination on a copy of the model
+    and return the fastest as {'channels_last', 'bf16', 'compile'}
+    """
+    candidates = [
+        {'channels_last': False, 'bf16': False, 'compile': False},
+        {'channels_last': True, 'bf16': False, 'compile': False},
+        {'channels_last': False, 'bf16': True, 'compile': False},
+        {'channels_last': True, 'bf16': True, 'compile': False},
+    ]
+    if config.cpu_try_compile and hasattr(torch, 'compile'):
+        candidates += [dict(c, compile=True) for c in candidates]
     
-    avg_loss = total_loss / total_samples
-    avg_mae = total_mae / total_samples
-    avg_mse = total_mse / total_samples
-    avg_rmse = np.sqrt(avg_mse)
+    results = []
+    for option in candidates:
+        trial = copy.deepcopy(model).train()
+        x = images
+        if option['channels_last']:
+            trial = trial.to(memory_format=torch.channels_last)
+            x = images.contiguous(memory_format=torch.channels_last)
+        try:
+            if option['compile']:
+                trial = torch.compile(trial)
+            timings = []
+            # First step includes compilation / kernel selection and is not timed
+            for step in range(config.cpu_benchmark_steps + 1):
+                start = time.perf_counter()
+                with _cpu_autocast(option['bf16']):
+                    predictions = trial(x)
+                loss, _ = criterion(predictions.float(), targets)
+                loss.backward()
+                trial.zero_grad(set_to_none=True)
+                if step > 0:
+                    timings.append(time.perf_counter() - start)
+            step_ms = float(np.median(timings)) * 1000.0
+            results.append((step_ms, option))
+            print(f"   ⏱️ {option}: {step_ms:.1f} ms/step")
+        except Exception as e:
+            print(f"   ⚠️ {option} unavailable: {e}")
+        finally:
+            del trial
     
-    return avg_loss, avg_mae, avg_mse, avg_rmse
+    if not results:
+        return candidates[0]
+    return min(results, key=lambda r: r[0])[1]
 
 
-def train_optimized():
-    """Main optimized training function"""
-    config = OptimizedTrainingConfig()
+def build_dataloaders(config):
+    """Create train/validation datasets and loaders from the config"""
+    # Per-sample augmentation in workers unless batches are augmented on-device
+    worker_augment = not config.gpu_augment
+    if config.train_shards:
+        # Stream from tar shards; validation still uses the local test set
+        train_dataset = ShardedStreamingDataset(
+            config.train_shards, gt_downsample=config.gt_downsample, target_size=config.target_size,
+            augment=worker_augment, seed=config.stream_seed, rank=config.rank, world_size=config.world_size)
+        val_dataset = EnhancedPelletDataset(
+            config.val_images,
+            config.val_densitymaps,
+            gt_downsample=config.gt_downsample,
+            augment=False
+        )
+    elif config.cache_dir:
+        # Decode/resize once, then read memory-mapped samples every epoch
+        splits = {}
+        for split, img_root, gt_root in (('train', config.train_images, config.train_densitymaps),
+                                         ('val', config.val_images, config.val_densitymaps)):
+            split_dir = os.path.join(config.cache_dir, split)
+            if not dataset_cache_exists(split_dir, config.gt_downsample, config.target_size, img_root, gt_root):
+                print(f"🗄️ Building {split} dataset cache in {split_dir}")
+                build_dataset_cache(img_root, gt_root, split_dir,
+                                    gt_downsample=config.gt_downsample, target_size=config.target_size)
+            splits[split] = split_dir
+        train_dataset = CachedCrowdDataset(splits['train'], augment=worker_augment)
+        val_dataset = CachedCrowdDataset(splits['val'], augment=False)
+    else:
+        # Datasets - use standard dataloader for compatibility
+        train_dataset = EnhancedPelletDataset(
+            config.train_images,
+            config.train_densitymaps,
+            gt_downsample=config.gt_downsample,
+            augment=worker_augment
+        )
+        
+        val_dataset = EnhancedPelletDataset(
+            config.val_images,
+            config.val_densitymaps,
+            gt_downsample=config.gt_downsample,
+            augment=False
+        )
+    
+    # Each rank sees a disjoint shard when distributed
+    train_sampler = val_sampler = None
+    streaming = isinstance(train_dataset, ShardedStreamingDataset)
+    if config.distributed:
+        if not streaming:
+            train_sampler = DistributedSampler(train_dataset, num_replicas=config.world_size,
+                                               rank=config.rank, shuffle=True)
+        val_sampler = EvalShardSampler(val_dataset, config.rank, config.world_size)
+    
+    # Data loaders (streaming shards are split/shuffled by the dataset itself; workers are
+    # recreated each epoch so they pick up the new epoch and resume position)
+    train_loader = DataLoader(
+        train_dataset,
+        batch_size=config.batch_size,
+        shuffle=train_sampler is None and not streaming,
+        sampler=train_sampler,
+        num_workers=config.num_workers,
+        pin_memory=config.pin_memory,
+        persistent_workers=True if config.num_workers > 0 and not streaming else False
+    )
+    
+    val_loader = DataLoader(
+        val_dataset,
+        batch_size=config.batch_size,
+        shuffle=False,
+        sampler=val_sampler,
+        num_workers=config.num_workers,
+        pin_memory=config.pin_memory,
+        persistent_workers=True if config.num_workers > 0 else False
+    )
+    
+    if config.rank == 0:
+        if streaming:
+            print(f"📊 Training shards: {len(train_dataset.shards)} (streaming)")
+        else:
+            print(f"📊 Training samples: {len(train_dataset)}")
+            print(f"📊 Training batches: {len(train_loader)} per process x {config.world_size} processes")
+        print(f"📊 Validation samples: {len(val_dataset)}")
+    return train_loader, val_loader
+
+
+def train_optimized(config=None):
+    """
+    Main optimized training function
+    Multi-process: torchrun --nnodes=N --nproc_per_node=P train.py --distributed
+    (rank 0 owns checkpoints and CSV logging; validation metrics are all-reduced)
+    """
+    config = config or OptimizedTrainingConfig()
+    if config.distributed:
+        setup_distributed(config)
+    is_main = config.rank == 0
     
     # Create save directory
     os.makedirs(config.save_dir, exist_ok=True)
     
-    print(f"🚀 Starting Optimized Pellet Counting Training")
-    print(f"📱 Device: {config.device}")
-    print(f"🎯 Target: Maximum accuracy for small dense pellets")
-    print(f"📊 Enhanced features: {'✅' if ENHANCED_AVAILABLE else '❌'}")
-    print(f"🔧 SSIM loss: {'✅' if SSIM_AVAILABLE else '❌'}")
+    if is_main:
+        print(f"🚀 Starting Optimized Pellet Counting Training")
+        print(f"📱 Device: {config.device}")
+        print(f"🌐 Processes: {config.world_size} ({config.dist_backend if config.distributed else 'single'})")
+        print(f"🎯 Target: Maximum accuracy for small dense pellets")
+        print(f"📊 Enhanced features: {'✅' if ENHANCED_AVAILABLE else '❌'}")
     
     # Initialize model
     model = EnhancedMCNNForPellets().to(config.device)
     model_name = "EnhancedMCNN" if ENHANCED_AVAILABLE else "ImprovedMCNN"
-    print(f"✅ Using {model_name}")
     
     # Count parameters
     total_params = sum(p.numel() for p in model.parameters())
     trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
-    print(f"📈 Model parameters: {total_params:,} total, {trainable_params:,} trainable")
+    if is_main:
+        print(f"✅ Using {model_name}")
+        print(f"📈 Model parameters: {total_params:,} total, {trainable_params:,} trainable")
     
     # Loss function
     criterion = CombinedLoss(
@@ -241,43 +516,8 @@ def train_optimized():
     else:
         scaler = None
     
-    # Datasets - use standard dataloader for compatibility
-    train_dataset = EnhancedPelletDataset(
-        './data/train_data/images',
-        './data/train_data/densitymaps',
-        gt_downsample=config.gt_downsample,
-        augment=True
-    )
-    
-    val_dataset = EnhancedPelletDataset(
-        './data/test_data/images', 
-        './data/test_data/densitymaps',
-        gt_downsample=config.gt_downsample,
-        augment=False
-    )
-    
-    # Data loaders
-    train_loader = DataLoader(
-        train_dataset,
-        batch_size=config.batch_size,
-        shuffle=True,
-        num_workers=config.num_workers,
-        pin_memory=config.pin_memory,
-        persistent_workers=True if config.num_workers > 0 else False
-    )
-    
-    val_loader = DataLoader(
-        val_dataset,
-        batch_size=config.batch_size,
-        shuffle=False,
-        num_workers=config.num_workers,
-        pin_memory=config.pin_memory,
-        persistent_workers=True if config.num_workers > 0 else False
-    )
-    
-    print(f"📊 Training samples: {len(train_dataset)}")
-    print(f"📊 Validation samples: {len(val_dataset)}")
-    print(f"📊 Training batches: {len(train_loader)}")
+    train_loader, val_loader = build_dataloaders(config)
+    augmenter = BatchAugmenter() if config.gpu_augment else None
     
     # Initialize CSV logging with robust fallback for permission issues
     def _open_log_csv(path, mode='w'):
@@ -295,10 +535,12 @@ def train_optimized():
 
     # Ensure directory exists
     os.makedirs(config.save_dir, exist_ok=True)
-    log_file_obj, used_log_path = _open_log_csv(config.log_csv, 'w')
-    with log_file_obj as f:
-        writer = csv.writer(f)
-        writer.writerow(['epoch', 'lr', 'train_loss', 'train_mae', 'val_loss', 'val_mae', 'val_rmse', 'time'])
+    used_log_path = None
+    if is_main:
+        log_file_obj, used_log_path = _open_log_csv(config.log_csv, 'w')
+        with log_file_obj as f:
+            writer = csv.writer(f)
+            writer.writerow(['epoch', 'lr', 'train_loss', 'train_mae', 'val_loss', 'val_mae', 'val_rmse', 'time'])
     
     # Attempt to resume from the latest checkpoint if available
     def _find_latest_checkpoint(checkpoint_dir):
@@ -329,7 +571,8 @@ def train_optimized():
     start_epoch = 0
     if latest_ckpt_path:
         try:
-            print(f"🔁 Found checkpoint to resume: {latest_ckpt_path} (epoch {latest_epoch})")
+            if is_main:
+                print(f"🔁 Found checkpoint to resume: {latest_ckpt_path} (epoch {latest_epoch})")
             ck = torch.load(latest_ckpt_path, map_location=config.device)
             model.load_state_dict(ck.get('model_state_dict', model.state_dict()))
             optimizer.load_state_dict(ck.get('optimizer_state_dict', optimizer.state_dict()))
@@ -340,29 +583,101 @@ def train_optimized():
             best_mae = ck.get('best_mae', best_mae)
             start_epoch = ck.get('epoch', latest_epoch)
             best_epoch = start_epoch - 1
-            print(f"✅ Resumed from epoch {start_epoch}")
+            if is_main:
+                print(f"✅ Resumed from epoch {start_epoch}")
         except Exception as e:
             print(f"⚠️ Failed to resume from checkpoint: {e}")
 
+    # Streaming: continue from the rolling resume state (possibly mid-epoch) if it is newer
+    stream = train_loader.dataset if isinstance(train_loader.dataset, ShardedStreamingDataset) else None
+    resume_path = os.path.join(config.save_dir, 'resume_state.pth')
+    resume_epoch, resume_batches = -1, 0
+    if stream is not None and os.path.exists(resume_path):
+        rs = torch.load(resume_path, map_location=config.device)
+        if rs['epoch'] >= start_epoch:
+            model.load_state_dict(rs['model_state_dict'])
+            optimizer.load_state_dict(rs['optimizer_state_dict'])
+            scheduler.load_state_dict(rs['scheduler_state_dict'])
+            best_mae, best_epoch = rs['best_mae'], rs['best_epoch']
+            patience_counter = rs['patience_counter']
+            start_epoch, resume_epoch, resume_batches = rs['epoch'], rs['epoch'], rs['batches_consumed']
+            stream.set_position(resume_epoch, resume_batches, rs['batch_size'], rs['num_workers'])
+            if is_main:
+                print(f"🔁 Resuming stream at epoch {resume_epoch + 1}, batch {resume_batches}")
+
+    # CPU fast path: pick the fastest memory format / precision / compile combination
+    if config.cpu_optimize and config.device.type == 'cpu':
+        if is_main:
+            print("🔬 Benchmarking CPU training options...")
+        option = None
+        if is_main:
+            sample_images, sample_targets = next(iter(train_loader))
+            option = select_cpu_training_options(model, criterion, sample_images, sample_targets, config)
+        if config.distributed:
+            # Every rank must run the same configuration
+            shared = [option]
+            dist.broadcast_object_list(shared, src=0)
+            option = shared[0]
+        config.channels_last = option['channels_last']
+        config.cpu_bf16 = option['bf16']
+        config.compile_model = option['compile']
+        if is_main:
+            print(f"✅ CPU training options: {option}")
+    if config.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+
+    checkpoints = None
+    if is_main:
+        checkpoints = CheckpointManager(config.save_dir, prefix='best_optimized',
+                                        arch='EnhancedMCNNForPellets', keep_top_k=config.keep_top_k,
+                                        inference_fp16=config.inference_fp16)
+
+    # Wrap after loading weights so every rank starts from identical parameters
+    raw_model = model
+    if config.compile_model:
+        model = torch.compile(model)
+    if config.distributed:
+        model = DistributedDataParallel(
+            model, device_ids=[config.local_rank] if config.device.type == 'cuda' else None)
+
     # Training loop
     for epoch in range(start_epoch, config.epochs):
         start_time = time.time()
+        if isinstance(train_loader.sampler, DistributedSampler):
+            train_loader.sampler.set_epoch(epoch)
+        batches_done = resume_batches if epoch == resume_epoch else 0
+        max_batches = None
+        if stream is not None:
+            stream.set_epoch(epoch)
+            rank_samples = stream.rank_num_samples()
+            if config.distributed and rank_samples is not None:
+                # Ranks may hold different shard sizes; stop all of them at the shortest one
+                shortest = torch.tensor([rank_samples], device=config.device)
+                dist.all_reduce(shortest, op=dist.ReduceOp.MIN)
+                max_batches = int(shortest.item()) // config.batch_size
         
         # Training phase
         model.train()
-        train_loss = 0.0
+        train_loss = torch.zeros((), dtype=torch.float64, device=config.device)
         train_samples = 0
         
-        pbar = tqdm(train_loader, desc=f"Epoch {epoch+1}/{config.epochs}")
+        pbar = tqdm(train_loader, desc=f"Epoch {epoch+1}/{config.epochs}", disable=not is_main)
         for batch_idx, (images, targets) in enumerate(pbar):
+            if max_batches is not None and batches_done >= max_batches:
+                break
             images = images.to(config.device)
             targets = targets.to(config.device)
+            if augmenter is not None:
+                images, targets = augmenter(images, targets)
             
             optimizer.zero_grad()
             
+            if config.channels_last:
+                images = images.contiguous(memory_format=torch.channels_last)
+            
             # Forward pass with mixed precision
             if config.use_mixed_precision:
-                with torch.cuda.amp.autocast():
+                with torch.autocast('cuda'):
                     predictions = model(images)
                     loss, loss_dict = criterion(predictions, targets)
                 
@@ -372,29 +687,44 @@ def train_optimized():
                 scaler.step(optimizer)
                 scaler.update()
             else:
-                predictions = model(images)
-                loss, loss_dict = criterion(predictions, targets)
+                # bfloat16 autocast on CPU when selected; the loss is always computed in fp32
+                with _cpu_autocast(config.cpu_bf16):
+                    predictions = model(images)
+                loss, loss_dict = criterion(predictions.float(), targets)
                 loss.backward()
                 torch.nn.utils.clip_grad_norm_(model.parameters(), config.gradient_clip_norm)
                 optimizer.step()
             
-            # Update metrics
+            # Update metrics (kept on-device)
             batch_size = images.size(0)
-            train_loss += loss.item() * batch_size
+            train_loss += loss.detach().double() * batch_size
             train_samples += batch_size
             
             # Update progress bar
-            pbar.set_postfix({
-                'Loss': f"{loss.item():.6f}",
-                'Count Loss': f"{loss_dict.get('count_loss', 0):.6f}",
-                'LR': f"{optimizer.param_groups[0]['lr']:.2e}"
-            })
+            if is_main and batch_idx % config.log_interval == 0:
+                pbar.set_postfix({
+                    'Loss': f"{loss.item():.6f}",
+                    'Count Loss': f"{loss_dict['count_loss'].item():.6f}",
+                    'LR': f"{optimizer.param_groups[0]['lr']:.2e}"
+                })
+            
+            batches_done += 1
+            if stream is not None and is_main and batches_done % config.resume_every_batches == 0:
+                checkpoints.save_resume_state(
+                    resume_path, raw_model, optimizer, scheduler, epoch=epoch, batches_consumed=batches_done,
+                    batch_size=config.batch_size, num_workers=config.num_workers, best_mae=best_mae,
+                    best_epoch=best_epoch, patience_counter=patience_counter)
         
-        # Calculate training metrics
-        avg_train_loss = train_loss / train_samples
+        # Calculate training metrics (summed over ranks)
+        train_totals = all_reduce_sum(torch.stack([
+            train_loss, torch.tensor(float(train_samples), dtype=torch.float64, device=config.device)]), config)
+        avg_train_loss = (train_totals[0] / train_totals[1].clamp_min(1)).item()
         
-        # Validation phase
-        val_loss, val_mae, val_mse, val_rmse = compute_metrics(model, val_loader, config.device, criterion)
+        # Validation phase (each rank scores its shard; sums are all-reduced before averaging)
+        val_sums = accumulate_counts([raw_model], val_loader, config.device, criterion)[0]
+        val_metrics = finalize_metrics(all_reduce_sum(val_sums, config))
+        val_loss, val_mae, val_mse, val_rmse = (val_metrics['loss'], val_metrics['mae'],
+                                                val_metrics['mse'], val_metrics['rmse'])
         
         # Learning rate scheduling
         scheduler.step()
@@ -403,66 +733,236 @@ def train_optimized():
         # Timing
         epoch_time = time.time() - start_time
         
-        # Logging
-        print(f"\n📈 Epoch {epoch+1}/{config.epochs} | LR: {current_lr:.2e}")
-        print(f"   Train Loss: {avg_train_loss:.6f} | Val Loss: {val_loss:.6f}")
-        print(f"   Val MAE: {val_mae:.2f} | Val RMSE: {val_rmse:.2f}")
-        print(f"   Time: {epoch_time:.1f}s")
-        
-        # Save to CSV (use robust opener that falls back on permission errors)
-        try:
-            # Prefer the previously used log path if available (it may be a fallback)
-            log_target = used_log_path if 'used_log_path' in locals() and used_log_path else config.log_csv
-            f_obj, actual_path = _open_log_csv(log_target, 'a')
-            with f_obj as f:
-                writer = csv.writer(f)
-                writer.writerow([
-                    epoch + 1, current_lr, avg_train_loss, 0, val_loss, val_mae, val_rmse, epoch_time
-                ])
-            # remember the actual file we successfully wrote to
-            used_log_path = actual_path
-        except Exception as e:
-            # Don't crash training for logging problems; report and continue
-            print(f"⚠️ Failed to write training log to CSV: {e}")
+        if is_main:
+            # Logging
+            print(f"\n📈 Epoch {epoch+1}/{config.epochs} | LR: {current_lr:.2e}")
+            print(f"   Train Loss: {avg_train_loss:.6f} | Val Loss: {val_loss:.6f}")
+            print(f"   Val MAE: {val_mae:.2f} | Val RMSE: {val_rmse:.2f}")
+            print(f"   Time: {epoch_time:.1f}s")
+            
+            # Save to CSV (use robust opener that falls back on permission errors)
+            try:
+                # Prefer the previously used log path if available (it may be a fallback)
+                log_target = used_log_path or config.log_csv
+                f_obj, actual_path = _open_log_csv(log_target, 'a')
+                with f_obj as f:
+                    writer = csv.writer(f)
+                    writer.writerow([
+                        epoch + 1, current_lr, avg_train_loss, 0, val_loss, val_mae, val_rmse, epoch_time
+                    ])
+                # remember the actual file we successfully wrote to
+                used_log_path = actual_path
+            except Exception as e:
+                # Don't crash training for logging problems; report and continue
+                print(f"⚠️ Failed to write training log to CSV: {e}")
         
-        # Model saving and early stopping
+        # Model saving and early stopping (metrics are identical on every rank)
         if val_mae < best_mae - config.min_delta:
             best_mae = val_mae
             best_epoch = epoch
             patience_counter = 0
             
-            # Save best model
-            torch.save({
-                'epoch': epoch + 1,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'scheduler_state_dict': scheduler.state_dict(),
-                'best_mae': best_mae,
-                'config': config.__dict__
-            }, os.path.join(config.save_dir, f'best_optimized_epoch_{epoch+1}.pth'))
-            
-            print(f"✅ New best model saved with MAE={val_mae:.2f}")
+            # Save best model (written in the background)
+            if is_main:
+                checkpoints.save(epoch + 1, best_mae, raw_model, optimizer, scheduler,
+                                 config=dict(config.__dict__))
+                
+                print(f"✅ New best model queued for saving with MAE={val_mae:.2f}")
         else:
             patience_counter += 1
+        
+        # Epoch boundary: a restart continues with the next epoch instead of replaying this one
+        if stream is not None and is_main:
+            checkpoints.save_resume_state(
+                resume_path, raw_model, optimizer, scheduler, epoch=epoch + 1, batches_consumed=0,
+                batch_size=config.batch_size, num_workers=config.num_workers, best_mae=best_mae,
+                best_epoch=best_epoch, patience_counter=patience_counter)
             
         # Early stopping check
+        if patience_counter >= config.patience:
+            if is_main:
+                print(f"🛑 Early stopping triggered after {patience_counter} epochs without improvement")
+            break
+        
+        if is_main:
+            print("-" * 80)
+    
+    if checkpoints is not None:
+        checkpoints.close()
+    if config.distributed:
+        dist.barrier()
+        dist.destroy_process_group()
+    
+    # Training completion
+    if is_main:
+        print(f"\n🏁 Training completed!")
+        print(f"🏆 Best MAE: {best_mae:.2f} at epoch {best_epoch + 1}")
+        print(f"💾 Best model: best_optimized_epoch_{best_epoch + 1}.pth")
+    
+    return best_mae, best_epoch + 1
+
+
+def train_distill(teacher_checkpoint, config=None):
+    """
+    Knowledge distillation: train LightweightMCNN against EnhancedMCNNForPellets density maps
+    and report latency and MAE of teacher and student side by side
+    """
+    config = config or OptimizedTrainingConfig()
+    config.teacher_checkpoint = teacher_checkpoint
+    os.makedirs(config.student_save_dir, exist_ok=True)
+    
+    print(f"🚀 Starting Knowledge Distillation Training")
+    print(f"📱 Device: {config.device}")
+    print(f"👨‍🏫 Teacher checkpoint: {teacher_checkpoint}")
+    
+    # Frozen teacher
+    teacher = EnhancedMCNNForPellets(load_weights=True).to(config.device)
+    ck = torch.load(teacher_checkpoint, map_location=config.device)
+    teacher.load_state_dict(ck['model_state_dict'] if 'model_state_dict' in ck else ck)
+    teacher.eval()
+    for p in teacher.parameters():
+        p.requires_grad_(False)
+    
+    student = LightweightMCNN().to(config.device)
+    teacher_params = sum(p.numel() for p in teacher.parameters())
+    student_params = sum(p.numel() for p in student.parameters())
+    print(f"📈 Teacher parameters: {teacher_params:,} | Student parameters: {student_params:,}")
+    
+    base_criterion = CombinedLoss(
+        mse_weight=config.mse_weight,
+        mae_weight=config.mae_weight,
+        ssim_weight=config.ssim_weight,
+        count_weight=config.count_loss_weight
+    ).to(config.device)
+    criterion = DistillationLoss(base_criterion, alpha=config.distill_alpha,
+                                 count_weight=config.count_loss_weight)
+    
+    optimizer = optim.AdamW(student.parameters(), lr=config.initial_lr * 5,
+                            weight_decay=config.weight_decay)
+    scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=config.epochs, eta_min=1e-6)
+    
+    train_loader, val_loader = build_dataloaders(config)
+    augmenter = BatchAugmenter() if config.gpu_augment else None
+    
+    teacher_mae = compute_metrics(teacher, val_loader, config.device, base_criterion)[1]
+    print(f"👨‍🏫 Teacher Val MAE: {teacher_mae:.2f}")
+    
+    best_mae = float('inf')
+    best_epoch = -1
+    patience_counter = 0
+    checkpoints = CheckpointManager(config.student_save_dir, prefix='best_student', arch='LightweightMCNN',
+                                    keep_top_k=config.keep_top_k, inference_fp16=config.inference_fp16)
+    
+    for epoch in range(config.epochs):
+        start_time = time.time()
+        student.train()
+        train_loss = torch.zeros((), dtype=torch.float64, device=config.device)
+        train_samples = 0
+        
+        pbar = tqdm(train_loader, desc=f"Distill {epoch+1}/{config.epochs}")
+        for batch_idx, (images, targets) in enumerate(pbar):
+            images = images.to(config.device)
+            targets = targets.to(config.device)
+            if augmenter is not None:
+                images, targets = augmenter(images, targets)
+            
+            with torch.no_grad():
+                teacher_pred = teacher(images)
+            
+            optimizer.zero_grad()
+            predictions = student(images)
+            loss, loss_dict = criterion(predictions, targets, teacher_pred)
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(student.parameters(), config.gradient_clip_norm)
+            optimizer.step()
+            
+            batch_size = images.size(0)
+            train_loss += loss.detach().double() * batch_size
+            train_samples += batch_size
+            if batch_idx % config.log_interval == 0:
+                pbar.set_postfix({
+                    'Loss': f"{loss.item():.6f}",
+                    'KD Loss': f"{loss_dict['kd_loss'].item():.6f}"
+                })
+        
+        scheduler.step()
+        val_loss, val_mae, val_mse, val_rmse = compute_metrics(student, val_loader, config.device, base_criterion)
+        
+        print(f"\n📈 Epoch {epoch+1}/{config.epochs} | Train Loss: {train_loss.item() / train_samples:.6f}")
+        print(f"   Student Val MAE: {val_mae:.2f} | Teacher Val MAE: {teacher_mae:.2f}")
+        print(f"   Time: {time.time() - start_time:.1f}s")
+        
+        if val_mae < best_mae - config.min_delta:
+            best_mae = val_mae
+            best_epoch = epoch
+            patience_counter = 0
+            checkpoints.save(epoch + 1, best_mae, student,
+                             teacher_checkpoint=teacher_checkpoint, config=dict(config.__dict__))
+            print(f"✅ New best student saved with MAE={val_mae:.2f}")
+        else:
+            patience_counter += 1
+        
         if patience_counter >= config.patience:
             print(f"🛑 Early stopping triggered after {patience_counter} epochs without improvement")
             break
         
         print("-" * 80)
     
-    # Training completion
-    print(f"\n🏁 Training completed!")
-    print(f"🏆 Best MAE: {best_mae:.2f} at epoch {best_epoch + 1}")
-    print(f"💾 Best model: best_optimized_epoch_{best_epoch + 1}.pth")
+    # Side-by-side latency (CPU, batch 1) and accuracy report
+    cpu = torch.device('cpu')
+    checkpoints.close()
+    best_path = checkpoints.best_path
+    if best_path:
+        student.load_state_dict(torch.load(best_path, map_location=config.device)['model_state_dict'])
+    teacher_ms = measure_latency(teacher.to(cpu), cpu, runs=config.latency_runs)
+    student_ms = measure_latency(student.to(cpu), cpu, runs=config.latency_runs)
+    
+    print(f"\n🏁 Distillation completed!")
+    print(f"{'Model':<12}{'Params':>12}{'CPU ms':>10}{'Val MAE':>10}")
+    print(f"{'Teacher':<12}{teacher_params:>12,}{teacher_ms:>10.1f}{teacher_mae:>10.2f}")
+    print(f"{'Student':<12}{student_params:>12,}{student_ms:>10.1f}{best_mae:>10.2f}")
+    print(f"⚡ Speedup: {teacher_ms / student_ms:.1f}x | MAE delta: {best_mae - teacher_mae:+.2f}")
+    if best_path:
+        print(f"💾 Best student: {best_path}")
     
     return best_mae, best_epoch + 1
 
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Train MCNN pellet counting models')
+    parser.add_argument('--mode', choices=['optimized', 'distill'], default='optimized')
+    parser.add_argument('--teacher', default=None,
+                        help='Teacher checkpoint (EnhancedMCNNForPellets) for --mode distill')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Preprocessed dataset cache directory (built on first use)')
+    parser.add_argument('--gpu-augment', action='store_true',
+                        help='Augment collated batches on the training device')
+    parser.add_argument('--distributed', action='store_true',
+                        help='DistributedDataParallel across torchrun processes (gloo on CPU)')
+    parser.add_argument('--cpu-fast', action='store_true',
+                        help='Benchmark channels_last / bfloat16 autocast on CPU and train with the fastest')
+    parser.add_argument('--compile', action='store_true',
+                        help='Include torch.compile in the --cpu-fast benchmark')
+    parser.add_argument('--train-shards', default=None,
+                        help='Stream training data from tar shards (directory with shards.json, or glob)')
+    args = parser.parse_args()
+    
+    config = OptimizedTrainingConfig()
+    config.cache_dir = args.cache_dir
+    config.gpu_augment = args.gpu_augment
+    config.distributed = args.distributed
+    config.cpu_optimize = args.cpu_fast
+    config.cpu_try_compile = args.compile
+    config.train_shards = args.train_shards
+    
     try:
-        best_mae, best_epoch = train_optimized()
+        if args.mode == 'distill':
+            if not args.teacher:
+                parser.error('--mode distill requires --teacher')
+            best_mae, best_epoch = train_distill(args.teacher, config)
+        else:
+            best_mae, best_epoch = train_optimized(config)
         print(f"\n✅ Training successful!")
         print(f"📊 Final results: MAE={best_mae:.2f} at epoch {best_epoch}")
     except KeyboardInterrupt:
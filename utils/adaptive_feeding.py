@@ -0,0 +1,94 @@
+"""
+Adaptive schedule amounts from leftover-pellet counts
+- Runs nightly in the scheduler process when ADAPTIVE_FEEDING=1 (off by default), and only for
+  schedules created with auto_adjust
+- /api/count_pellets stores every count as a PelletCount row; a count is tied to a schedule only
+  when the device's latest successful dispense within ADAPTIVE_COUNT_WINDOW_MINUTES was that
+  schedule's, so captures unrelated to a feeding never move a dose
+- Each schedule's amount moves toward leaving ADAPTIVE_TARGET_LEFTOVER of it uneaten, by at most
+  ADAPTIVE_MAX_STEP per night, from the mean leftover of its counts over the last ADAPTIVE_DAYS
+  days (only counts taken since its last adjustment), clamped to the add_schedule bounds (20-150 g)
+- One aggregate query for all schedules, one executemany UPDATE for the changes
+"""
+
+import os
+import time
+from datetime import datetime, timedelta
+
+
+ENABLED = os.getenv('ADAPTIVE_FEEDING', '0').lower() in ('1', 'true', 'yes')
+DAYS = int(os.getenv('ADAPTIVE_DAYS', '7'))
+COUNT_WINDOW_MINUTES = int(os.getenv('ADAPTIVE_COUNT_WINDOW_MINUTES', '180'))
+TARGET_LEFTOVER = float(os.getenv('ADAPTIVE_TARGET_LEFTOVER', '0.05'))  # fraction of the dispensed amount
+MAX_STEP = float(os.getenv('ADAPTIVE_MAX_STEP', '0.15'))  # max relative change per night
+GAIN = 0.5  # share of the leftover error corrected per night
+MIN_OBSERVED_COUNTS = 3
+MIN_GRAMS, MAX_GRAMS = 20, 150  # same bounds as add_schedule
+
+
+def preceding_dispense(db, dispense_model, device_id, now=None):
+    """The device's latest successful dispense within COUNT_WINDOW_MINUTES before `now` (UTC), else None"""
+    DispenseLog = dispense_model
+    now = now or datetime.utcnow()
+    return db.session.query(DispenseLog).filter(
+        DispenseLog.device_id == device_id,
+        DispenseLog.status == 'success',
+        DispenseLog.timestamp <= now,
+        DispenseLog.timestamp >= now - timedelta(minutes=COUNT_WINDOW_MINUTES),
+    ).order_by(DispenseLog.timestamp.desc()).first()
+
+
+def mean_leftovers(db, schedule_model, count_model, since):
+    """
+    (schedule id, amount_grams, mean leftover grams) of active auto-adjust schedules with at least
+    MIN_OBSERVED_COUNTS post-dispense counts since `since` and since their last adjustment
+    """
+    FeedSchedule, PelletCount = schedule_model, count_model
+    rows = db.session.query(
+        FeedSchedule.id, FeedSchedule.amount_grams,
+        db.func.avg(PelletCount.leftover_grams), db.func.count(PelletCount.id),
+    ).join(PelletCount, PelletCount.schedule_id == FeedSchedule.id).filter(
+        FeedSchedule.is_active == True,
+        FeedSchedule.auto_adjust.is_(True),
+        PelletCount.timestamp >= since,
+        db.or_(FeedSchedule.adjusted_at.is_(None), PelletCount.timestamp > FeedSchedule.adjusted_at),
+    ).group_by(FeedSchedule.id, FeedSchedule.amount_grams).all()
+    return [(schedule_id, amount, float(leftover))
+            for schedule_id, amount, leftover, n in rows if n >= MIN_OBSERVED_COUNTS]
+
+
+def plan_amounts(observed):
+    """
+    observed: (schedule id, amount_grams, mean leftover grams after that schedule's dispenses)
+    Returns {schedule id: new amount} for the schedules whose amount changes
+    """
+    changes = {}
+    for schedule_id, amount, leftover in observed:
+        if amount <= 0:
+            continue
+        target = amount - GAIN * (leftover - TARGET_LEFTOVER * amount)
+        target = min(max(target, amount * (1 - MAX_STEP)), amount * (1 + MAX_STEP))
+        new_amount = min(max(int(round(target)), MIN_GRAMS), MAX_GRAMS)
+        if new_amount != amount:
+            changes[schedule_id] = new_amount
+    return changes
+
+
+def adjust_schedule_amounts(db, schedule_model, count_model, now=None):
+    """Nightly pass over all schedules; returns the number of schedules changed"""
+    if not ENABLED:
+        return 0
+    start = time.perf_counter()
+    now = now or datetime.utcnow()
+    observed = mean_leftovers(db, schedule_model, count_model, now - timedelta(days=DAYS))
+    changes = plan_amounts(observed)
+    if changes:
+        db.session.bulk_update_mappings(schedule_model, [
+            {'id': schedule_id, 'amount_grams': amount, 'adjusted_at': now}
+            for schedule_id, amount in changes.items()])
+        db.session.commit()
+    before = {schedule_id: amount for schedule_id, amount, _ in observed}
+    delta = sum(amount - before[schedule_id] for schedule_id, amount in changes.items())
+    print(f"🎯 Adaptive feeding: {len(changes)} of {len(observed)} observed schedules adjusted "
+          f"({delta:+d} g per feeding) in {(time.perf_counter() - start) * 1000:.0f} ms")
+    return len(changes)
@@ -0,0 +1,179 @@
+"""
+Consumption analytics across all feeders
+- Loads per-device daily bins (UTC days, last ANALYTICS_DAYS) of dispensed grams, failed
+  dispenses and counted pellet grams from the telemetry store into (devices x days) NumPy arrays
+- Consumption per day = dispensed grams minus the mean leftover grams counted that day
+- Forecasts next-day consumption with Holt's linear smoothing, one vectorized step per day
+  across every device at once, with a band from the smoothed one-step error
+- Flags anomalies for today: a leftover spike (> mean + ANOMALY_Z std of the device's history)
+  and failed dispenses (at least half of today's attempts failed)
+- Results are cached by the store's watermark; when new days arrive the smoothing state is
+  advanced over the new days only instead of replaying the whole window
+"""
+
+import os
+import time
+import threading
+
+import numpy as np
+
+from utils import timeseries
+
+
+WINDOW_DAYS = int(os.getenv('ANALYTICS_DAYS', '56'))
+ALPHA = float(os.getenv('ANALYTICS_ALPHA', '0.5'))  # level smoothing
+BETA = float(os.getenv('ANALYTICS_BETA', '0.1'))    # trend smoothing
+ANOMALY_Z = float(os.getenv('ANALYTICS_ANOMALY_Z', '3'))
+MIN_HISTORY_DAYS = 5
+MIN_LEFTOVER_GRAMS = 5.0
+
+
+class _HoltState:
+    """Per-device smoothing state after applying all days up to last_day (inclusive)"""
+    def __init__(self, n_devices):
+        self.level = np.zeros(n_devices)
+        self.trend = np.zeros(n_devices)
+        self.err_var = np.zeros(n_devices)
+        self.steps = np.zeros(n_devices, dtype=np.int64)
+        self.last_day = None
+
+    def step(self, x):
+        """Apply one day's consumption for all devices; devices start at their first non-zero day"""
+        started = self.steps > 0
+        starting = ~started & (x > 0)
+        predicted = self.level + self.trend
+        error = x - predicted
+        level = ALPHA * x + (1 - ALPHA) * predicted
+        trend = BETA * (level - self.level) + (1 - BETA) * self.trend
+        self.err_var = np.where(started & (self.steps > 1),
+                                (1 - ALPHA) * self.err_var + ALPHA * error ** 2, self.err_var)
+        self.level = np.where(started, level, np.where(starting, x, self.level))
+        self.trend = np.where(started, trend, self.trend)
+        self.steps += started | starting
+
+
+def _bins(series, device_index, start_day, end_day):
+    """(devices x days) sum and count arrays of a series; devices missing from the index are ignored"""
+    shape = (len(device_index), end_day - start_day)
+    sums, counts = np.zeros(shape), np.zeros(shape)
+    rows = [r for r in timeseries.store.daily_totals(series, start_day, end_day) if r[0] in device_index]
+    if rows:
+        device_ids, days, totals, ns = zip(*rows)
+        rows_idx = np.fromiter((device_index[d] for d in device_ids), dtype=np.int64, count=len(rows))
+        cols = np.asarray(days, dtype=np.int64) - start_day
+        # A day can come from both a packed chunk and late staged points
+        np.add.at(sums, (rows_idx, cols), totals)
+        np.add.at(counts, (rows_idx, cols), ns)
+    return sums, counts
+
+
+class AnalyticsEngine:
+    def __init__(self, window_days=WINDOW_DAYS):
+        self.window_days = window_days
+        self._lock = threading.Lock()
+        self._watermark = None
+        self._result = None
+        self._state = None
+        self._history = None  # consumption columns the state was built from, by absolute day
+        self._device_ids = None
+
+    def results(self, device_ids):
+        """Analytics for the given device ids (all feeders share one cached computation)"""
+        with self._lock:
+            watermark = timeseries.store.watermark()
+            day = int(time.time() // timeseries.DAY)
+            if (self._result is None or watermark != self._watermark or self._result['day'] != day
+                    or not set(device_ids) <= self._result['devices'].keys()):
+                self._result = self._compute(sorted(set(device_ids) | set(self._device_ids or ())), day)
+                self._watermark = watermark
+            by_device = self._result['devices']
+        return [by_device[d] for d in device_ids if d in by_device]
+
+    def _compute(self, device_ids, today):
+        start = time.perf_counter()
+        start_day = today - self.window_days
+        device_index = {d: i for i, d in enumerate(device_ids)}
+        dispensed, dispensed_n = _bins('dispensed_grams', device_index, start_day, today + 1)
+        failures, _ = _bins('dispense_failures', device_index, start_day, today + 1)
+        leftover_sum, leftover_n = _bins('pellet_grams', device_index, start_day, today + 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            leftover = np.where(leftover_n > 0, leftover_sum / leftover_n, np.nan)
+        consumption = np.clip(dispensed - np.nan_to_num(leftover), 0, None)
+
+        history = consumption[:, :-1]  # completed days only; today is partial
+        state = self._advance_state(device_ids, history, start_day, today)
+
+        forecast = np.clip(state.level + state.trend, 0, None)
+        band = 1.96 * np.sqrt(state.err_var)
+        rate_7d = history[:, -7:].mean(axis=1)
+        rate_28d = history[:, -28:].mean(axis=1)
+
+        # Leftover spike: today's mean leftover vs the device's past observed days
+        past = leftover[:, :-1]
+        observed = np.sum(~np.isnan(past), axis=1)
+        # Rows with no observations are zero-filled so nanmean/nanstd never see an all-NaN row
+        mean = np.nanmean(np.where(observed[:, None] > 0, past, 0), axis=1)
+        std = np.nanstd(np.where(observed[:, None] > 0, past, 0), axis=1)
+        today_leftover = leftover[:, -1]
+        spike = ((observed >= MIN_HISTORY_DAYS) & (today_leftover >= MIN_LEFTOVER_GRAMS)
+                 & (today_leftover > mean + ANOMALY_Z * np.maximum(std, 1.0)))
+        today_failures = failures[:, -1]
+        attempts = today_failures + dispensed_n[:, -1]
+        failing = (today_failures > 0) & (today_failures >= 0.5 * np.maximum(attempts, 1))
+
+        devices = {}
+        for i, device_id in enumerate(device_ids):
+            anomalies = []
+            if spike[i]:
+                anomalies.append('leftover_spike')
+            if failing[i]:
+                anomalies.append('failed_dispenses')
+            devices[device_id] = {
+                'device_id': device_id,
+                'rate_7d_grams': round(float(rate_7d[i]), 1),
+                'rate_28d_grams': round(float(rate_28d[i]), 1),
+                'trend_grams_per_day': round(float(state.trend[i]), 2),
+                'forecast_grams': round(float(forecast[i]), 1),
+                'forecast_low': round(float(max(forecast[i] - band[i], 0)), 1),
+                'forecast_high': round(float(forecast[i] + band[i]), 1),
+                'dispensed_today_grams': round(float(dispensed[i, -1]), 1),
+                'failures_today': int(today_failures[i]),
+                'leftover_today_grams': None if np.isnan(today_leftover[i]) else round(float(today_leftover[i]), 1),
+                'anomalies': anomalies,
+            }
+        elapsed = time.perf_counter() - start
+        print(f"📈 Analytics for {len(device_ids)} devices x {self.window_days} days in {elapsed * 1000:.0f} ms")
+        return {'day': today, 'devices': devices, 'elapsed_ms': round(elapsed * 1000, 1)}
+
+    def _advance_state(self, device_ids, history, start_day, today):
+        """Reuse the cached smoothing state when the days it was built from are unchanged"""
+        state = self._state
+        if state is not None and self._device_ids == device_ids and state.last_day is not None:
+            cached_start, cached = self._history
+            overlap_from = max(cached_start, start_day)
+            overlap_to = state.last_day + 1
+            unchanged = overlap_to > overlap_from and np.array_equal(
+                cached[:, overlap_from - cached_start:overlap_to - cached_start],
+                history[:, overlap_from - start_day:overlap_to - start_day])
+            if unchanged:
+                new_days = range(overlap_to, today)
+            else:
+                state = None
+        else:
+            state = None
+        if state is None:
+            state = _HoltState(len(device_ids))
+            new_days = range(start_day, today)
+        for day in new_days:
+            state.step(history[:, day - start_day])
+        state.last_day = today - 1
+        self._state, self._history, self._device_ids = state, (start_day, history), device_ids
+        return state
+
+
+engine = AnalyticsEngine()
+
+
+def get_analytics(device_ids):
+    """Cached analytics dicts for the given device ids"""
+    return engine.results(list(device_ids))
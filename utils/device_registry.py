@@ -0,0 +1,112 @@
+"""
+In-memory device registry
+- Snapshot of the Device table indexed by id, device_key, api_token and user, so dispatch and
+  device authentication are dict lookups with no DB hit
+- Device inserts/updates/deletes in this process mark the snapshot stale (SQLAlchemy mapper
+  events); other processes pick changes up after REGISTRY_TTL seconds
+"""
+
+import os
+import time
+import threading
+from collections import namedtuple
+
+
+REGISTRY_TTL = float(os.getenv('DEVICE_REGISTRY_TTL', '30'))
+
+DeviceInfo = namedtuple('DeviceInfo', 'id user_id name device_key url api_token')
+
+
+class DeviceRegistry:
+    def __init__(self, ttl=REGISTRY_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._stale = True
+        self._by_id = {}
+        self._by_key = {}
+        self._by_token = {}
+        self._by_user = {}
+        self.db = None
+        self.model = None  # Device model, set by init_registry
+
+    def invalidate(self, *args):
+        self._stale = True
+
+    def _ensure_fresh(self):
+        if not self._stale and time.monotonic() - self._loaded_at < self.ttl:
+            return
+        with self._lock:
+            if not self._stale and time.monotonic() - self._loaded_at < self.ttl:
+                return
+            self._reload()
+
+    def _reload(self):
+        Device = self.model
+        self._stale = False
+        rows = self.db.session.query(
+            Device.id, Device.user_id, Device.name, Device.device_key, Device.url, Device.api_token
+        ).order_by(Device.id).all()
+        by_id, by_key, by_token, by_user = {}, {}, {}, {}
+        for row in rows:
+            info = DeviceInfo(*row)
+            by_id[info.id] = info
+            by_key[info.device_key] = info
+            if info.api_token:
+                by_token[info.api_token] = info
+            by_user.setdefault(info.user_id, []).append(info)
+        # Swap whole dicts so concurrent readers never see a half-built index
+        self._by_id, self._by_key, self._by_token, self._by_user = by_id, by_key, by_token, by_user
+        self._loaded_at = time.monotonic()
+
+    def get(self, device_id):
+        self._ensure_fresh()
+        return self._by_id.get(device_id)
+
+    def by_key(self, device_key):
+        self._ensure_fresh()
+        return self._by_key.get(device_key)
+
+    def by_token(self, api_token):
+        self._ensure_fresh()
+        return self._by_token.get(api_token)
+
+    def for_user(self, user_id):
+        self._ensure_fresh()
+        return list(self._by_user.get(user_id, ()))
+
+    def all(self):
+        self._ensure_fresh()
+        return list(self._by_id.values())
+
+    def default_for_user(self, user_id):
+        """The user's first (oldest) device, used when a dispense does not name one"""
+        self._ensure_fresh()
+        devices = self._by_user.get(user_id)
+        return devices[0] if devices else None
+
+    def resolve(self, device_id=None, user_id=None):
+        """Device for a dispense: explicit device_id, else the user's default device"""
+        if device_id is not None:
+            return self.get(device_id)
+        if user_id is not None:
+            return self.default_for_user(user_id)
+        return None
+
+
+registry = DeviceRegistry()
+
+
+def init_registry(db, device_model):
+    """
+    Bind the registry to the app's db and Device model (once per process) and mark it stale
+    whenever a Device row changes in this process
+    """
+    from sqlalchemy import event
+    if registry.model is not None:
+        if registry.model is not device_model:
+            print("⚠️ Device registry is already bound; ignoring a second Device model")
+        return
+    registry.db, registry.model = db, device_model
+    for name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(device_model, name, registry.invalidate)
@@ -0,0 +1,131 @@
+"""
+Feed-to-gram ratio configuration service
+- The global ratio lives in config.json and is cached in memory; the file's mtime is re-checked at
+  most once per CHECK_INTERVAL seconds, so the request hot path normally never touches the filesystem
+- Writes go to a temp file in the same directory and are renamed over config.json, so readers never
+  see a half-written file
+- Optional per-user overrides are stored in the FeedRatio table (cached with a short TTL); the db
+  and model are injected (init_feed_config), so this module never imports app
+"""
+
+import os
+import json
+import time
+import tempfile
+import threading
+
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', 'config.json')
+DEFAULT_RATIO = {'pellets': 50, 'grams': 10}
+CHECK_INTERVAL = float(os.getenv('FEED_CONFIG_CHECK_INTERVAL', '1.0'))
+OVERRIDE_TTL = float(os.getenv('FEED_CONFIG_OVERRIDE_TTL', '30.0'))
+
+
+class FeedConfigService:
+    """Process-wide cached view of config.json plus per-user ratio overrides"""
+    def __init__(self, path=CONFIG_PATH, check_interval=CHECK_INTERVAL, override_ttl=OVERRIDE_TTL,
+                 db=None, ratio_model=None):
+        self.path = path
+        self.db = db
+        self.ratio_model = ratio_model  # FeedRatio; overrides are disabled until it is set
+        self.check_interval = check_interval
+        self.override_ttl = override_ttl
+        self._lock = threading.Lock()
+        self._ratio = None
+        self._mtime = None
+        self._checked_at = 0.0
+        self._overrides = {}  # user_id -> (expires_at, ratio or None)
+
+    def _stat_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _reload(self, mtime):
+        if mtime is None:
+            ratio = dict(DEFAULT_RATIO)
+        else:
+            with open(self.path, 'r') as f:
+                ratio = json.load(f)
+        self._ratio, self._mtime = ratio, mtime
+
+    def get(self, user_id=None):
+        """Effective ratio for `user_id` (its DB override if any, otherwise the global ratio)"""
+        if user_id is not None and self.ratio_model is not None:
+            override = self._get_override(user_id)
+            if override is not None:
+                return override
+        now = time.monotonic()
+        if self._ratio is not None and now - self._checked_at < self.check_interval:
+            return self._ratio
+        with self._lock:
+            if self._ratio is None or now - self._checked_at >= self.check_interval:
+                mtime = self._stat_mtime()
+                if self._ratio is None or mtime != self._mtime:
+                    self._reload(mtime)
+                self._checked_at = now
+            return self._ratio
+
+    def set(self, pellets, grams, user_id=None):
+        """Update the global ratio (atomic file replace) or a user's DB override"""
+        if user_id is not None:
+            self._set_override(user_id, pellets, grams)
+            return
+        ratio = {'pellets': pellets, 'grams': grams}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with self._lock:
+            fd, tmp_path = tempfile.mkstemp(prefix='.config.', suffix='.tmp', dir=directory)
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(ratio, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            self._ratio, self._mtime = ratio, self._stat_mtime()
+            self._checked_at = time.monotonic()
+
+    def _get_override(self, user_id):
+        now = time.monotonic()
+        cached = self._overrides.get(user_id)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        row = self.db.session.query(self.ratio_model).filter_by(user_id=user_id).first()
+        ratio = {'pellets': row.pellets, 'grams': row.grams} if row else None
+        self._overrides[user_id] = (now + self.override_ttl, ratio)
+        return ratio
+
+    def _set_override(self, user_id, pellets, grams):
+        row = self.db.session.query(self.ratio_model).filter_by(user_id=user_id).first()
+        if row is None:
+            row = self.ratio_model(user_id=user_id)
+            self.db.session.add(row)
+        row.pellets, row.grams = pellets, grams
+        self.db.session.commit()
+        self._overrides[user_id] = (time.monotonic() + self.override_ttl, {'pellets': pellets, 'grams': grams})
+
+    def clear_override(self, user_id):
+        self.db.session.query(self.ratio_model).filter_by(user_id=user_id).delete()
+        self.db.session.commit()
+        self._overrides.pop(user_id, None)
+
+
+feed_config = FeedConfigService()
+
+
+def init_feed_config(db, ratio_model):
+    """Bind per-user overrides to the app's db and FeedRatio model"""
+    feed_config.db, feed_config.ratio_model = db, ratio_model
+    return feed_config
+
+
+def get_feed_ratio(user_id=None):
+    return feed_config.get(user_id)
+
+
+def set_feed_ratio(pellets, grams, user_id=None):
+    feed_config.set(pellets, grams, user_id)
@@ -0,0 +1,104 @@
+"""
+Device heartbeat coalescing
+- /api/heartbeat only updates an in-memory dict (device id -> latest heartbeat)
+- A background thread flushes all pending heartbeats every HEARTBEAT_FLUSH_SECONDS in one
+  transaction (executemany UPDATE of status/last_seen/telemetry), then marks devices that have
+  been silent for HEARTBEAT_OFFLINE_SECONDS as offline with a single UPDATE
+- N heartbeats from the same device between flushes cost one row write
+"""
+
+import os
+import json
+import atexit
+import threading
+from datetime import datetime, timedelta
+
+
+FLUSH_SECONDS = float(os.getenv('HEARTBEAT_FLUSH_SECONDS', '10'))
+OFFLINE_SECONDS = float(os.getenv('HEARTBEAT_OFFLINE_SECONDS', '120'))
+MAX_TELEMETRY_BYTES = 4096
+
+
+class HeartbeatBuffer:
+    def __init__(self, flush_seconds=FLUSH_SECONDS, offline_seconds=OFFLINE_SECONDS):
+        self.flush_seconds = flush_seconds
+        self.offline_seconds = offline_seconds
+        self._pending = {}  # device id -> (last_seen, telemetry json or None)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._app = None
+        self._db = None
+        self._model = None  # Device model
+
+    def record(self, device_id, telemetry=None, seen_at=None):
+        """Coalesce a heartbeat; only the latest one per device survives until the next flush"""
+        payload = None
+        if telemetry:
+            payload = json.dumps(telemetry, separators=(',', ':'))
+            if len(payload) > MAX_TELEMETRY_BYTES:
+                payload = None
+        with self._lock:
+            self._pending[device_id] = (seen_at or datetime.utcnow(), payload)
+
+    def start(self, app, db, device_model):
+        """Start the flush thread once per process, bound to the running app's db and Device model"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._app, self._db, self._model = app, db, device_model
+            self._thread = threading.Thread(target=self._run, name='heartbeat-flush', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_seconds + 5)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_seconds):
+            self._flush_safely()
+        self._flush_safely()
+
+    def _flush_safely(self):
+        try:
+            with self._app.app_context():
+                self.flush()
+        except Exception as e:
+            print(f"⚠️ Heartbeat flush failed: {e}")
+
+    def flush(self):
+        """Write pending heartbeats in one transaction; returns the number of devices updated"""
+        db, Device = self._db, self._model
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        rows = []
+        for device_id, (seen_at, telemetry) in pending.items():
+            row = {'id': device_id, 'last_seen': seen_at, 'status': 'online'}
+            if telemetry is not None:
+                row['telemetry'] = telemetry
+            rows.append(row)
+        try:
+            # Rows with and without telemetry have different column sets; group for executemany
+            for has_telemetry in (True, False):
+                batch = [r for r in rows if ('telemetry' in r) == has_telemetry]
+                if batch:
+                    db.session.bulk_update_mappings(Device, batch)
+            cutoff = datetime.utcnow() - timedelta(seconds=self.offline_seconds)
+            db.session.query(Device).filter(Device.status == 'online', Device.last_seen < cutoff).update(
+                {'status': 'offline'}, synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            # Put the batch back unless a newer heartbeat arrived meanwhile
+            with self._lock:
+                for device_id, value in pending.items():
+                    self._pending.setdefault(device_id, value)
+            raise
+        return len(rows)
+
+
+heartbeats = HeartbeatBuffer()
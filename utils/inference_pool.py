@@ -0,0 +1,173 @@
+"""
+Inference worker process pool for /api/count_pellets
+- Enabled with INFERENCE_WORKERS=N; each worker is a long-lived spawned process with the model
+  preloaded and torch.set_num_threads pinned (INFERENCE_THREADS, default cpu_count // N)
+- The web process only decodes/resizes with PIL + NumPy (no torch import) and writes the input
+  into the worker's shared-memory slot; only a small request/result tuple goes over the pipe
+- Requests go to whichever worker is idle; a worker that dies is restarted on the next request
+"""
+
+import os
+import time
+import queue
+import atexit
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from utils.preprocess import INPUT_SIZE, load_image_array
+
+
+INPUT_SHAPE = (3, INPUT_SIZE, INPUT_SIZE)
+INPUT_BYTES = int(np.prod(INPUT_SHAPE)) * np.dtype(np.float32).itemsize
+REQUEST_TIMEOUT = float(os.getenv('INFERENCE_TIMEOUT', '30'))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _worker_main(worker_id, conn, shm_name, num_threads, model_path):
+    """Worker process: load the model once, then serve (accuracy_mode,) requests from the pipe"""
+    import torch
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+    from utils.model_utils import get_model, predict_array
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    slot = np.ndarray(INPUT_SHAPE, dtype=np.float32, buffer=shm.buf)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = get_model(model_path, device=device)
+    conn.send(('ready', os.getpid()))
+    try:
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError:
+                return
+            if request is None:
+                return
+            accuracy_mode, = request
+            timings = {}
+            try:
+                result = predict_array(model, slot, device, accuracy_mode=accuracy_mode, timings=timings)
+                conn.send(('ok', result, timings))
+            except Exception as e:
+                conn.send(('error', f"{type(e).__name__}: {e}", timings))
+    finally:
+        del slot
+        shm.close()
+
+
+class _Worker:
+    def __init__(self, ctx, worker_id, num_threads, model_path):
+        self.worker_id = worker_id
+        self.shm = shared_memory.SharedMemory(create=True, size=INPUT_BYTES)
+        self.slot = np.ndarray(INPUT_SHAPE, dtype=np.float32, buffer=self.shm.buf)
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, name=f'inference-{worker_id}', daemon=True,
+                                   args=(worker_id, child_conn, self.shm.name, num_threads, model_path))
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+
+    def wait_ready(self, timeout):
+        if not self.ready:
+            if not self.conn.poll(timeout):
+                raise TimeoutError(f"Inference worker {self.worker_id} did not start in {timeout}s")
+            self.conn.recv()
+            self.ready = True
+
+    def close(self):
+        try:
+            if self.process.is_alive():
+                self.conn.send(None)
+                self.process.join(timeout=5)
+        except (BrokenPipeError, OSError):
+            pass
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+        del self.slot
+        self.shm.close()
+        self.shm.unlink()
+
+
+class InferencePool:
+    """Fixed-size pool of model-serving processes; predict() is safe to call from many threads"""
+    def __init__(self, num_workers, num_threads=None, model_path=None, startup_timeout=120.0):
+        self.num_workers = num_workers
+        self.num_threads = num_threads or max(1, (os.cpu_count() or 1) // num_workers)
+        self.model_path = model_path
+        self.startup_timeout = startup_timeout
+        self._ctx = mp.get_context('spawn')
+        self._workers = [self._spawn(i) for i in range(num_workers)]
+        self._idle = queue.Queue()
+        for worker in self._workers:
+            self._idle.put(worker)
+        print(f"🧠 Inference pool: {num_workers} workers x {self.num_threads} threads")
+
+    def _spawn(self, worker_id):
+        return _Worker(self._ctx, worker_id, self.num_threads, self.model_path)
+
+    def predict(self, image_file, accuracy_mode=False, timeout=REQUEST_TIMEOUT):
+        """Decode in this process, run the model in an idle worker; same result as predict_pellets"""
+        from utils.metrics import record_stage_timings
+        start = time.perf_counter()
+        input_array = load_image_array(image_file)
+        timings = {'preprocess': time.perf_counter() - start}
+        try:
+            worker = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError('All inference workers are busy')
+        try:
+            if not worker.process.is_alive():
+                worker = self._replace(worker)
+            worker.wait_ready(self.startup_timeout)
+            sent = time.perf_counter()
+            worker.slot[...] = input_array
+            worker.conn.send((accuracy_mode,))
+            if not worker.conn.poll(timeout):
+                # A stuck worker can't be trusted with the slot again
+                worker = self._replace(worker)
+                raise TimeoutError(f'Inference timed out after {timeout}s')
+            status, result, worker_timings = worker.conn.recv()
+            timings.update(worker_timings)
+            # Slot copy, pipe round trip and worker wake-up on top of the worker's own stages
+            timings['ipc'] = time.perf_counter() - sent - sum(worker_timings.values())
+        except (EOFError, BrokenPipeError, ConnectionResetError):
+            worker = self._replace(worker)
+            raise RuntimeError('Inference worker exited unexpectedly')
+        finally:
+            self._idle.put(worker)
+        record_stage_timings(timings)
+        if status != 'ok':
+            raise RuntimeError(result)
+        return result
+
+    def _replace(self, worker):
+        print(f"⚠️ Restarting inference worker {worker.worker_id}")
+        worker.close()
+        replacement = self._spawn(worker.worker_id)
+        self._workers[worker.worker_id] = replacement
+        return replacement
+
+    def close(self):
+        for worker in self._workers:
+            worker.close()
+
+
+def get_inference_pool():
+    """Process-wide pool when INFERENCE_WORKERS > 0, otherwise None (predict in-process)"""
+    global _pool
+    num_workers = int(os.getenv('INFERENCE_WORKERS', '0'))
+    if num_workers <= 0:
+        return None
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                threads = int(os.getenv('INFERENCE_THREADS', '0')) or None
+                _pool = InferencePool(num_workers, threads, os.getenv('INFERENCE_MODEL_PATH') or None)
+                atexit.register(_pool.close)
+    return _pool
@@ -0,0 +1,186 @@
+"""
+In-process metrics with a Prometheus text exposition at /metrics
+- Counter / Gauge / Histogram with labels; one lock per metric, no external dependency
+- init_metrics(app) times every request, counts SQL statements per request (SQLAlchemy
+  cursor events) and registers the /metrics endpoint
+- Values are per process: scrape each worker, or run a single web process per container
+"""
+
+import os
+import time
+import bisect
+import threading
+
+from flask import Response, g, has_request_context, request
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+_registry = []
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + list(extra or [])
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {value}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [per-bucket counts (+Inf last), sum, count]
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def _render_value(self, key, value):
+        counts, total, n = value[0][:], value[1], value[2]
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, [("le", le)])} {cumulative}')
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f'{self.name}_sum{labels} {total}')
+        lines.append(f'{self.name}_count{labels} {n}')
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+def render_metrics():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics used across the app
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Request latency by endpoint',
+                            ('endpoint', 'method', 'status'))
+REQUEST_DB_QUERIES = Histogram('http_request_db_queries', 'SQL statements executed per request',
+                               ('endpoint',), buckets=COUNT_BUCKETS)
+PREDICT_STAGE_LATENCY = Histogram('predict_stage_duration_seconds',
+                                  'predict_pellets time per stage (preprocess, inference, postprocess, ipc)',
+                                  ('stage',))
+DISPENSE_TOTAL = Counter('dispense_total', 'dispense_feed outcomes', ('trigger_type', 'status'))
+IOT_ROUND_TRIP = Histogram('iot_round_trip_seconds', 'IoT device round-trip time', ('device',))
+SCHEDULER_LAG = Histogram('scheduler_lag_seconds', 'Actual minus planned fire time of scheduled feeds',
+                          buckets=(0.1, 0.5, 1.0, 2.0, 5.0, 15.0, 30.0, 60.0, 300.0))
+
+
+def record_stage_timings(timings):
+    """Observe a {stage: seconds} dict (as filled by model_utils.predict_array)"""
+    for stage, seconds in timings.items():
+        PREDICT_STAGE_LATENCY.observe(seconds, stage=stage)
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g._metrics_queries = g.get('_metrics_queries', 0) + 1
+
+
+def init_metrics(app):
+    """Request timing, per-request SQL counts and the /metrics endpoint"""
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    if not event.contains(Engine, 'before_cursor_execute', _count_query):
+        event.listen(Engine, 'before_cursor_execute', _count_query)
+
+    @app.before_request
+    def _start_request_timer():
+        g._metrics_start = time.perf_counter()
+        g._metrics_queries = 0
+
+    @app.after_request
+    def _observe_request(response):
+        start = g.get('_metrics_start')
+        if start is not None:
+            endpoint = request.endpoint or 'unmatched'
+            REQUEST_LATENCY.observe(time.perf_counter() - start, endpoint=endpoint,
+                                    method=request.method, status=response.status_code)
+            REQUEST_DB_QUERIES.observe(g.get('_metrics_queries', 0), endpoint=endpoint)
+        return response
+
+    token = os.getenv('METRICS_TOKEN')
+
+    @app.route('/metrics')
+    def metrics():
+        if token and request.headers.get('Authorization') != f'Bearer {token}':
+            return Response('Unauthorized\n', status=401, mimetype='text/plain')
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,46 @@
+"""
+Checkpoint evaluation on a test image/density-map directory
+- cal_mae_multi() decodes each batch once and scores every model on it
+"""
+
+import os
+
+import torch
+
+from my_dataloader import CrowdDataset
+from evaluation import evaluate_models
+from utils.model_loading import load_model_smart
+
+
+def cal_mae(img_root,gt_dmap_root,model_param_path,batch_size=8):
+    '''
+    Calculate the MAE, MSE, and RMSE of the test data.
+    img_root: the root of test image data.
+    gt_dmap_root: the root of test ground truth density-map data.
+    model_param_path: the path of specific mcnn parameters.
+    '''
+    return cal_mae_multi(img_root, gt_dmap_root, [model_param_path], batch_size)[model_param_path]
+
+
+def cal_mae_multi(img_root, gt_dmap_root, model_param_paths, batch_size=8, num_workers=4):
+    '''
+    Per-image MAE, MSE, and RMSE for several checkpoints in one pass over the test data.
+    Each batch is decoded once and scored by every model.
+    Returns {model_param_path: metrics dict}.
+    '''
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    
+    # Smart model loading
+    models = [load_model_smart(path, device) for path in model_param_paths]
+    
+    # Get list of image files
+    img_names = [f for f in os.listdir(img_root) if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
+    dataset=CrowdDataset(img_root,gt_dmap_root,img_names,gt_downsample=4)
+    dataloader=torch.utils.data.DataLoader(dataset,batch_size=batch_size,shuffle=False,
+                                           num_workers=num_workers,pin_memory=device.type == 'cuda')
+    results = dict(zip(model_param_paths, evaluate_models(models, dataloader, device)))
+    
+    for path, metrics in results.items():
+        print(f"model_param_path: {path}")
+        print(f"MAE: {metrics['mae']:.2f}, MSE: {metrics['mse']:.2f}, RMSE: {metrics['rmse']:.2f}")
+    return results
@@ -0,0 +1,66 @@
+"""
+Checkpoint loading shared by evaluation, batch scoring and the web app
+- load_model_smart() recognizes training checkpoints of every architecture in this repo
+  (LightweightMCNN students, EnhancedMCNNForPellets, ImprovedMCNN, MCNN)
+- Lives in utils/ so callers never `import test`, which can resolve to CPython's stdlib package
+"""
+
+import torch
+
+
+def load_model_smart(model_param_path, device):
+    '''
+    Smart model loading that handles different checkpoint formats and model types
+    '''
+    # Load checkpoint
+    checkpoint = torch.load(model_param_path, map_location=device)
+    
+    # Try to determine model type from checkpoint
+    if isinstance(checkpoint, dict):
+        if 'model_state_dict' in checkpoint:
+            state_dict = checkpoint['model_state_dict']
+            print(f"✅ Loaded checkpoint from epoch {checkpoint.get('epoch', 'unknown')}")
+        else:
+            state_dict = checkpoint
+        
+        # Distilled student checkpoints record their architecture explicitly
+        if checkpoint.get('arch') == 'LightweightMCNN':
+            from enhanced_mcnn_model import LightweightMCNN
+            model = LightweightMCNN(load_weights=True).to(device)
+            model.load_state_dict(state_dict)
+            print("✅ Loaded Lightweight MCNN model")
+            return model
+        
+        # Check if this is an enhanced model or original model based on keys
+        if any('fusion' in key for key in state_dict.keys()):
+            # This is likely an Enhanced model
+            try:
+                from enhanced_mcnn_model import EnhancedMCNNForPellets
+                model = EnhancedMCNNForPellets().to(device)
+                model.load_state_dict(state_dict)
+                print("✅ Loaded Enhanced MCNN model")
+                return model
+            except Exception as e:
+                print(f"⚠️ Failed to load as Enhanced model: {e}")
+        
+        # Try original ImprovedMCNN
+        try:
+            from mcnn_model import ImprovedMCNN
+            model = ImprovedMCNN().to(device)
+            model.load_state_dict(state_dict)
+            print("✅ Loaded Improved MCNN model")
+            return model
+        except Exception as e:
+            print(f"⚠️ Failed to load as Improved model: {e}")
+        
+        # Try original MCNN
+        try:
+            from mcnn_model import MCNN
+            model = MCNN().to(device)
+            model.load_state_dict(state_dict)
+            print("✅ Loaded Original MCNN model")
+            return model
+        except Exception as e:
+            print(f"❌ Failed to load as Original model: {e}")
+    
+    raise Exception("Could not determine model type or load checkpoint")
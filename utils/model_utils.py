@@ -1,66 +1,179 @@
 import torch
-from torchvision import transforms
-from PIL import Image
 import json
+import time
 import os
 
+from utils.preprocess import load_image_array
+
 MODEL_PATH = os.path.join(os.path.dirname(__file__), '..', 'models', 'feed_count_model.pth')
-CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', 'config.json')
+# Compact weights-only artifact exported by checkpointing.CheckpointManager
+INFERENCE_MANIFEST_PATH = os.getenv(
+    'MODEL_MANIFEST', os.path.join(os.path.dirname(__file__), '..', 'checkpoints', 'inference_manifest.json'))
 
 _model = None
+_model_key = None
 
 
 # Load the correct model architecture and weights
 def get_model(model_path=None, device=None):
+    global _model, _model_key
     import sys
     sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'model'))
     if device is None:
         device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     if model_path is None:
-        # Default path (update as needed)
-        model_path = os.path.join(os.path.dirname(__file__), '..', 'checkpoint', 'best_optimized_epoch_79.pth')
-    # Try to import enhanced model first
-    try:
-        from enhanced_mcnn_model import EnhancedMCNNForPellets
-        model = EnhancedMCNNForPellets().to(device)
-    except ImportError:
-        from mcnn_model import ImprovedMCNN
-        model = ImprovedMCNN().to(device)
-    checkpoint = torch.load(model_path, map_location=device)
-    if isinstance(checkpoint, dict) and 'model_state_dict' in checkpoint:
-        model.load_state_dict(checkpoint['model_state_dict'])
+        if os.path.exists(INFERENCE_MANIFEST_PATH):
+            model_path = INFERENCE_MANIFEST_PATH
+        else:
+            # Default path (update as needed)
+            model_path = os.path.join(os.path.dirname(__file__), '..', 'checkpoint', 'best_optimized_epoch_79.pth')
+    # Loaded once per process and reused across requests
+    if _model is not None and _model_key == (model_path, str(device)):
+        return _model
+    if model_path.endswith('.json'):
+        from checkpointing import load_inference_model
+        model = load_inference_model(model_path, device)
     else:
-        model.load_state_dict(checkpoint)
-    model.eval()
+        # Try to import enhanced model first
+        try:
+            from enhanced_mcnn_model import EnhancedMCNNForPellets
+            model = EnhancedMCNNForPellets().to(device)
+        except ImportError:
+            from mcnn_model import ImprovedMCNN
+            model = ImprovedMCNN().to(device)
+        checkpoint = torch.load(model_path, map_location=device)
+        if isinstance(checkpoint, dict) and 'model_state_dict' in checkpoint:
+            model.load_state_dict(checkpoint['model_state_dict'])
+        else:
+            model.load_state_dict(checkpoint)
+        model.eval()
+    _model, _model_key = model, (model_path, str(device))
     return model
 
 
-# Predict pellet count using the actual model output (sum of density map)
-def predict_pellets(model, image_file, device=None):
-    from PIL import Image
-    import numpy as np
-    import torch
+# Checkpoints used by accuracy mode (comma-separated; any .pth utils.model_loading.load_model_smart understands or a .json manifest)
+ENSEMBLE_CHECKPOINTS = [p.strip() for p in os.getenv('ENSEMBLE_CHECKPOINTS', '').split(',') if p.strip()]
+TTA_SCALES = (0.75, 1.0, 1.25)
+TTA_FLIPS = ((), (3,), (2,), (2, 3))  # none, horizontal, vertical, both
+
+_ensemble = None
+_ensemble_key = None
+
+
+def get_ensemble(model_paths=None, device=None):
+    """Models for accuracy mode, loaded once per process; [] when no ensemble checkpoints are set"""
+    global _ensemble, _ensemble_key
     if device is None:
         device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    image = Image.open(image_file).convert('RGB')
+    model_paths = list(model_paths or ENSEMBLE_CHECKPOINTS)
+    if not model_paths:
+        return []
+    key = (tuple(model_paths), str(device))
+    if _ensemble is not None and _ensemble_key == key:
+        return _ensemble
+    import sys
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+    models = []
+    for path in model_paths:
+        if path.endswith('.json'):
+            from checkpointing import load_inference_model
+            models.append(load_inference_model(path, device))
+        else:
+            from utils.model_loading import load_model_smart
+            models.append(load_model_smart(path, device).eval())
+    _ensemble, _ensemble_key = models, key
+    return models
+
+
+def _tta_batch(input_tensor, scales, flips):
+    """
+    Stack every (scale, flip) variant of a 1x3xHxW input into one zero-padded batch.
+    Returns the batch and each variant's valid (height, width) fraction of the canvas.
+    """
+    import torch.nn.functional as F
+    _, _, h, w = input_tensor.shape
+    sizes = [(max(8, int(round(h * s))), max(8, int(round(w * s)))) for s in scales]
+    canvas_h, canvas_w = max(sh for sh, _ in sizes), max(sw for _, sw in sizes)
+    variants, valid = [], []
+    for sh, sw in sizes:
+        scaled = input_tensor if (sh, sw) == (h, w) else F.interpolate(
+            input_tensor, size=(sh, sw), mode='bilinear', align_corners=False, antialias=sh < h)
+        for dims in flips:
+            variant = scaled.flip(dims) if dims else scaled
+            variants.append(F.pad(variant, (0, canvas_w - sw, 0, canvas_h - sh)))
+            valid.append((sh / canvas_h, sw / canvas_w))
+    return torch.cat(variants), valid
+
+
+def _predict_tta(models, input_tensor, scales, flips):
+    """Count for every (model, scale, flip) variant; one batched forward pass per model"""
+    import math
+    batch, valid = _tta_batch(input_tensor, scales, flips)
+    counts = []
+    with torch.no_grad():
+        for model in models:
+            output = model(batch)
+            out_h, out_w = output.shape[2:]
+            for i, (fh, fw) in enumerate(valid):
+                # Only sum the region covering the (unpadded) scaled image
+                counts.append(output[i, :, :math.ceil(out_h * fh), :math.ceil(out_w * fw)].sum())
+    return torch.stack(counts).double().cpu()
+
+
+# Predict pellet count using the actual model output (sum of density map)
+def predict_pellets(model, image_file, device=None, accuracy_mode=False, models=None,
+                    scales=TTA_SCALES, flips=TTA_FLIPS):
+    """
+    Default: single forward pass, returns the count as a float.
+    accuracy_mode: averages over flips x scales x ensemble models (`models`, else get_ensemble(),
+    else `model`) and returns {'pellet_count', 'std', 'variance', 'cv', 'variants'}; the spread across variants is a
+    confidence signal (high cv = uncertain tray).
+    Stage timings are recorded in utils.metrics.
+    """
+    from utils.metrics import record_stage_timings
     # Model expects 512x512 input, normalized to [0,1]
-    preprocess = transforms.Compose([
-        transforms.Resize((512, 512)),
-        transforms.ToTensor(),
-    ])
-    input_tensor = preprocess(image).unsqueeze(0).to(device)
+    start = time.perf_counter()
+    input_array = load_image_array(image_file)
+    timings = {'preprocess': time.perf_counter() - start}
+    result = predict_array(model, input_array, device, accuracy_mode, models, scales, flips, timings)
+    record_stage_timings(timings)
+    return result
+
+
+def predict_array(model, input_array, device=None, accuracy_mode=False, models=None,
+                  scales=TTA_SCALES, flips=TTA_FLIPS, timings=None):
+    """
+    predict_pellets on an already preprocessed 3x512x512 float32 array.
+    If `timings` is a dict, 'inference' and 'postprocess' durations (seconds) are added to it.
+    """
+    if device is None:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    start = time.perf_counter()
+    input_tensor = torch.from_numpy(input_array).unsqueeze(0).to(device)
     with torch.no_grad():
-        output = model(input_tensor)
+        if accuracy_mode:
+            # Without ensemble checkpoints, TTA runs on the model the caller is serving with
+            output = _predict_tta(models or get_ensemble(device=device) or [model], input_tensor, scales, flips)
+        else:
+            output = model(input_tensor)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+    inference_done = time.perf_counter()
+
+    if accuracy_mode:
+        mean = float(output.mean())
+        std = float(output.std(unbiased=False))
+        result = {
+            'pellet_count': mean,
+            'std': std,
+            'variance': std ** 2,
+            'cv': std / mean if mean > 0 else 0.0,
+            'variants': int(output.numel()),
+        }
+    else:
         # Output is a density map, sum to get count
-        pellet_count = float(output.sum().item())
-    return pellet_count
-
-def get_feed_ratio():
-    if not os.path.exists(CONFIG_PATH):
-        return {'pellets': 50, 'grams': 10}
-    with open(CONFIG_PATH, 'r') as f:
-        return json.load(f)
-
-def set_feed_ratio(pellets, grams):
-    with open(CONFIG_PATH, 'w') as f:
-        json.dump({'pellets': pellets, 'grams': grams}, f)
+        result = float(output.sum().item())
+    if timings is not None:
+        timings['inference'] = inference_done - start
+        timings['postprocess'] = time.perf_counter() - inference_done
+    return result
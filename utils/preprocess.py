@@ -0,0 +1,20 @@
+"""
+Model input preprocessing with PIL + NumPy only (no torch import)
+Shared by in-process prediction and the web side of the inference worker pool.
+"""
+
+import numpy as np
+from PIL import Image
+
+
+INPUT_SIZE = 512
+
+
+def load_image_array(image_file, size=INPUT_SIZE):
+    """
+    Decode an image (path or file object) into a float32 CHW array in [0, 1] at size x size.
+    Matches torchvision Resize((size, size)) + ToTensor() on a PIL image.
+    """
+    image = Image.open(image_file).convert('RGB').resize((size, size), Image.BILINEAR)
+    array = np.asarray(image, dtype=np.float32) / 255.0
+    return np.ascontiguousarray(array.transpose((2, 0, 1)))
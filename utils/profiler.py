@@ -0,0 +1,167 @@
+"""
+Opt-in sampling profiler for slow requests
+- PROFILE_SAMPLE_RATE (e.g. 0.01) of requests are profiled; off when 0 (the default)
+- A single daemon thread samples the stacks of profiled request threads via sys._current_frames()
+  every PROFILE_INTERVAL_MS; it sleeps when no sampled request is in flight
+- SQL statements and their durations are captured for profiled requests (SQLAlchemy cursor events)
+- Profiled requests slower than PROFILE_SLOW_MS are kept in an in-memory ring buffer
+  (PROFILE_BUFFER entries) shown on /admin/profiles
+"""
+
+import os
+import sys
+import time
+import random
+import threading
+from collections import Counter, deque
+from datetime import datetime
+
+from flask import g, has_request_context, request
+
+
+MAX_SQL_PER_REQUEST = 200
+MAX_STACK_DEPTH = 40
+
+
+class _Profile:
+    __slots__ = ('thread_id', 'stacks', 'samples', 'sql')
+
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.stacks = Counter()
+        self.samples = 0
+        self.sql = []
+
+
+class SamplingProfiler:
+    def __init__(self, sample_rate=0.01, slow_ms=500.0, interval_ms=5.0, buffer_size=100):
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.interval = interval_ms / 1000.0
+        self.records = deque(maxlen=buffer_size)
+        self._active = {}  # thread id -> _Profile
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._sample_loop, name='request-profiler', daemon=True)
+        self._thread.start()
+
+    def _sample_loop(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.interval)
+            # Held for the whole sample so stop() never reads a profile the sampler is updating
+            with self._lock:
+                if not self._active:
+                    self._wake.clear()
+                    continue
+                frames = sys._current_frames()
+                for thread_id, profile in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is None:
+                        continue
+                    stack = []
+                    while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                        code = frame.f_code
+                        stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                        frame = frame.f_back
+                    profile.stacks[';'.join(reversed(stack))] += 1
+                    profile.samples += 1
+                del frames
+
+    def start(self):
+        if random.random() >= self.sample_rate:
+            return
+        profile = _Profile(threading.get_ident())
+        g._profile = profile
+        g._profile_start = time.perf_counter()
+        with self._lock:
+            self._active[profile.thread_id] = profile
+        self._wake.set()
+
+    def stop(self, response):
+        profile = g.pop('_profile', None)
+        if profile is None:
+            return
+        with self._lock:
+            # Once removed under the lock the sampler can no longer touch this profile
+            self._active.pop(profile.thread_id, None)
+            stacks = profile.stacks.most_common(15)
+            samples = profile.samples
+        duration_ms = (time.perf_counter() - g.pop('_profile_start')) * 1000.0
+        if duration_ms < self.slow_ms:
+            return
+        self.records.append({
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'status': response.status_code if response is not None else None,
+            'duration_ms': round(duration_ms, 1),
+            'samples': samples,
+            'interval_ms': self.interval * 1000.0,
+            'stacks': stacks,
+            'sql': profile.sql,
+            'sql_ms': round(sum(ms for _, ms in profile.sql), 1),
+        })
+
+
+def _before_cursor(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and g.get('_profile') is not None:
+        conn.info.setdefault('_profile_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('_profile_query_start')
+    if not starts or not has_request_context():
+        return
+    elapsed_ms = (time.perf_counter() - starts.pop()) * 1000.0
+    profile = g.get('_profile')
+    if profile is not None and len(profile.sql) < MAX_SQL_PER_REQUEST:
+        profile.sql.append((statement, round(elapsed_ms, 2)))
+
+
+profiler = None
+
+
+def init_profiler(app):
+    """Install the profiling hooks when PROFILE_SAMPLE_RATE > 0; returns the profiler or None"""
+    global profiler
+    sample_rate = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+    if sample_rate <= 0:
+        return None
+    if profiler is None:
+        profiler = SamplingProfiler(
+            sample_rate=sample_rate,
+            slow_ms=float(os.getenv('PROFILE_SLOW_MS', '500')),
+            interval_ms=float(os.getenv('PROFILE_INTERVAL_MS', '5')),
+            buffer_size=int(os.getenv('PROFILE_BUFFER', '100')),
+        )
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+        event.listen(Engine, 'before_cursor_execute', _before_cursor)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor)
+
+    @app.before_request
+    def _start_profile():
+        profiler.start()
+
+    @app.after_request
+    def _stop_profile(response):
+        profiler.stop(response)
+        return response
+
+    @app.teardown_request
+    def _discard_profile(exc):
+        # Requests that raised never reach after_request
+        profile = g.pop('_profile', None)
+        if profile is not None:
+            with profiler._lock:
+                profiler._active.pop(profile.thread_id, None)
+
+    print(f"🔬 Request profiler on: {sample_rate:.2%} sampled, slow >= {profiler.slow_ms:.0f} ms")
+    return profiler
+
+
+def get_profiles():
+    """Captured slow-request profiles, newest first"""
+    return list(reversed(profiler.records)) if profiler is not None else []
@@ -0,0 +1,334 @@
+"""
+Append-only time-series store for feeder telemetry (pellet counts, dispensed grams, device metrics)
+- Lives in its own SQLite file (TELEMETRY_DB, default instance/telemetry.sqlite), not in ORM tables
+- record() only appends to an in-memory buffer; a background thread inserts the buffer into a
+  staging table every TELEMETRY_FLUSH_SECONDS
+- Once a UTC day is over its staged points are packed into one row per (series, device, day):
+  raw points plus 5-minute and hourly rollups, each stored as packed arrays (uint32 second
+  offsets, float64 sums, uint32 sample counts)
+- Retention: raw points TELEMETRY_RAW_DAYS, 5-minute rollups TELEMETRY_ROLLUP_DAYS, hourly forever
+- query() reads one small blob per day, so a months-long chart touches a few hundred rows
+"""
+
+import os
+import time
+import atexit
+import sqlite3
+import threading
+from array import array
+
+
+DAY = 86400
+RAW = 0
+ROLLUPS = (300, 3600)
+FLUSH_SECONDS = float(os.getenv('TELEMETRY_FLUSH_SECONDS', '10'))
+COMPACT_SECONDS = float(os.getenv('TELEMETRY_COMPACT_SECONDS', '3600'))
+RAW_DAYS = int(os.getenv('TELEMETRY_RAW_DAYS', '30'))
+ROLLUP_DAYS = int(os.getenv('TELEMETRY_ROLLUP_DAYS', '365'))
+MAX_BUFFER = 5000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS point (
+    series TEXT NOT NULL,
+    device_id INTEGER NOT NULL,
+    ts REAL NOT NULL,
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_point_series ON point (series, device_id, ts);
+CREATE TABLE IF NOT EXISTS chunk (
+    series TEXT NOT NULL,
+    device_id INTEGER NOT NULL,   -- 0 = not tied to a device
+    resolution INTEGER NOT NULL,  -- 0 = raw points, else bucket width in seconds
+    day INTEGER NOT NULL,         -- UTC days since the epoch
+    n INTEGER NOT NULL,
+    offsets BLOB NOT NULL,        -- uint32 seconds since the start of the day, sorted
+    sums BLOB NOT NULL,           -- float64 value (raw) or sum of the bucket's values
+    counts BLOB,                  -- uint32 samples per bucket; NULL for raw points
+    PRIMARY KEY (series, device_id, resolution, day)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0);
+"""
+
+
+def _unpack(blob, typecode):
+    values = array(typecode)
+    if blob:
+        values.frombytes(blob)
+    return values
+
+
+def _bucketize(points, width):
+    """Sorted (offset, value) points -> {bucket offset: [sum, count]}"""
+    buckets = {}
+    for offset, value in points:
+        bucket = buckets.setdefault(offset - offset % width, [0.0, 0])
+        bucket[0] += value
+        bucket[1] += 1
+    return buckets
+
+
+def auto_resolution(start, end):
+    """Coarsest useful bucket width for a chart spanning start..end (epoch seconds)"""
+    span = end - start
+    if span <= 2 * DAY:
+        return RAW
+    if span <= 14 * DAY:
+        return 300
+    if span <= 120 * DAY:
+        return 3600
+    return DAY
+
+
+class TimeSeriesStore:
+    def __init__(self, path=None, flush_seconds=FLUSH_SECONDS, compact_seconds=COMPACT_SECONDS,
+                 raw_days=RAW_DAYS, rollup_days=ROLLUP_DAYS):
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self.compact_seconds = compact_seconds
+        self.raw_days = raw_days
+        self.rollup_days = rollup_days
+        self._pending = []  # (series, device_id, ts, value)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_compact = 0.0
+
+    def _connect(self):
+        """Per-thread connection in autocommit mode; transactions are explicit"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def record(self, series, value, device_id=None, ts=None):
+        """Append one point; it becomes visible to query() after the next flush"""
+        if self.path is None:
+            return
+        with self._lock:
+            self._pending.append((series, device_id or 0, ts if ts is not None else time.time(), float(value)))
+            overflow = len(self._pending) >= MAX_BUFFER
+        self.start()
+        if overflow:
+            self.flush()
+
+    def start(self):
+        """Start the flush thread once per process"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='telemetry-flush', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_seconds + 5)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_seconds):
+            self._flush_safely()
+            if time.monotonic() - self._last_compact >= self.compact_seconds:
+                self._last_compact = time.monotonic()
+                try:
+                    self.compact()
+                except Exception as e:
+                    print(f"⚠️ Telemetry compaction failed: {e}")
+        self._flush_safely()
+
+    def _flush_safely(self):
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"⚠️ Telemetry flush failed: {e}")
+
+    def flush(self):
+        """Insert buffered points into the staging table in one transaction"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return 0
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('INSERT INTO point (series, device_id, ts, value) VALUES (?, ?, ?, ?)', pending)
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            with self._lock:
+                self._pending[:0] = pending
+            raise
+        return len(pending)
+
+    def compact(self, now=None):
+        """
+        Pack staged points of finished days into chunk rows and apply retention.
+        Late points for an already packed day are merged into its existing chunks.
+        """
+        today = int((now if now is not None else time.time()) // DAY)
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                'SELECT series, device_id, ts, value FROM point WHERE ts < ? ORDER BY series, device_id, ts',
+                (today * DAY,)).fetchall()
+            groups = {}
+            for series, device_id, ts, value in rows:
+                day, offset = divmod(int(ts), DAY)
+                groups.setdefault((series, device_id, day), []).append((offset, value))
+            for (series, device_id, day), points in groups.items():
+                self._write_day(conn, series, device_id, day, points, today)
+            conn.execute('DELETE FROM point WHERE ts < ?', (today * DAY,))
+            if groups:
+                conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+            conn.execute('DELETE FROM chunk WHERE resolution = ? AND day < ?', (RAW, today - self.raw_days))
+            conn.execute('DELETE FROM chunk WHERE resolution = ? AND day < ?', (ROLLUPS[0], today - self.rollup_days))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if groups:
+            print(f"🗜️ Packed {len(rows)} telemetry points into {len(groups)} day chunks")
+        return len(rows)
+
+    def _write_day(self, conn, series, device_id, day, points, today):
+        existing = {
+            resolution: (offsets, sums, counts)
+            for resolution, offsets, sums, counts in conn.execute(
+                'SELECT resolution, offsets, sums, counts FROM chunk '
+                'WHERE series = ? AND device_id = ? AND day = ?', (series, device_id, day))
+        }
+        out = []
+        if day >= today - self.raw_days:
+            raw = points
+            if RAW in existing:
+                offsets, sums, _ = existing[RAW]
+                raw = sorted(list(zip(_unpack(offsets, 'I'), _unpack(sums, 'd'))) + points)
+            out.append((RAW, [p[0] for p in raw], [p[1] for p in raw], None))
+        for width in ROLLUPS:
+            if width == ROLLUPS[0] and day < today - self.rollup_days:
+                continue
+            buckets = _bucketize(points, width)
+            if width in existing:
+                offsets, sums, counts = existing[width]
+                for offset, total, count in zip(_unpack(offsets, 'I'), _unpack(sums, 'd'), _unpack(counts, 'I')):
+                    bucket = buckets.setdefault(offset, [0.0, 0])
+                    bucket[0] += total
+                    bucket[1] += count
+            keys = sorted(buckets)
+            out.append((width, keys, [buckets[k][0] for k in keys], [buckets[k][1] for k in keys]))
+        conn.executemany(
+            'INSERT OR REPLACE INTO chunk (series, device_id, resolution, day, n, offsets, sums, counts) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [(series, device_id, resolution, day, len(offsets), array('I', offsets).tobytes(),
+              array('d', sums).tobytes(), array('I', counts).tobytes() if counts is not None else None)
+             for resolution, offsets, sums, counts in out])
+
+    def watermark(self):
+        """(compaction generation, last staged point rowid); changes whenever stored data changes"""
+        conn = self._connect()
+        generation = conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+        last_point = conn.execute('SELECT MAX(rowid) FROM point').fetchone()[0] or 0
+        return generation, last_point
+
+    def daily_totals(self, series, start_day, end_day):
+        """
+        (device_id, day, sum, count) rows of one series for all devices and UTC days in
+        [start_day, end_day), from the hourly rollups plus not yet packed points
+        """
+        conn = self._connect()
+        rows = [(device_id, day, sum(_unpack(sums, 'd')), sum(_unpack(counts, 'I')))
+                for device_id, day, sums, counts in conn.execute(
+                    'SELECT device_id, day, sums, counts FROM chunk WHERE series = ? AND resolution = ? '
+                    'AND day >= ? AND day < ?', (series, ROLLUPS[-1], start_day, end_day))]
+        rows.extend(conn.execute(
+            'SELECT device_id, CAST(ts / ? AS INTEGER) AS day, SUM(value), COUNT(*) FROM point '
+            'WHERE series = ? AND ts >= ? AND ts < ? GROUP BY device_id, day',
+            (DAY, series, start_day * DAY, end_day * DAY)))
+        return rows
+
+    def _tiers_for(self, resolution):
+        """
+        Stored tiers to read for a query width, best first: the coarsest tier that divides it,
+        then finer dividing tiers, then coarser tiers as a fallback once the finer ones expired
+        """
+        tiers = (RAW,) + ROLLUPS
+        fitting = [w for w in tiers if w == RAW or (resolution and w <= resolution and resolution % w == 0)]
+        return sorted(fitting, reverse=True) + [w for w in tiers if w not in fitting]
+
+    def query(self, series, device_id=None, start=None, end=None, resolution=None):
+        """
+        Points of one series in [start, end) (epoch seconds) as (ts, sum, count) tuples.
+        resolution: RAW (0), a bucket width in seconds, or None to pick one from the span.
+        Each day is read from the coarsest stored tier that divides the width; days whose
+        finer tiers have expired fall back to the finest tier still stored (coarser points).
+        """
+        end = end if end is not None else time.time()
+        start = start if start is not None else end - 7 * DAY
+        if resolution is None:
+            resolution = auto_resolution(start, end)
+        device_id = device_id or 0
+        conn = self._connect()
+        args = (series, device_id, int(start // DAY), int(end // DAY))
+        available = {}
+        for day, tier in conn.execute(
+                'SELECT day, resolution FROM chunk WHERE series = ? AND device_id = ? '
+                'AND day BETWEEN ? AND ?', args):
+            available.setdefault(day, set()).add(tier)
+        chosen = {}  # tier -> days read from it
+        preference = self._tiers_for(resolution)
+        for day, tiers in available.items():
+            chosen.setdefault(next(t for t in preference if t in tiers), []).append(day)
+        chunks = []
+        for tier, days in chosen.items():
+            placeholders = ','.join('?' * len(days))
+            chunks.extend(conn.execute(
+                f'SELECT day, offsets, sums, counts FROM chunk WHERE series = ? AND device_id = ? '
+                f'AND resolution = ? AND day IN ({placeholders})', (series, device_id, tier, *days)))
+        staged = conn.execute(
+            'SELECT ts, value FROM point WHERE series = ? AND device_id = ? AND ts >= ? AND ts < ?',
+            (series, device_id, start, end)).fetchall()
+
+        points = [(ts, value, 1) for ts, value in staged]
+        for day, offsets, sums, counts in chunks:
+            base = day * DAY
+            offsets, sums = _unpack(offsets, 'I'), _unpack(sums, 'd')
+            # Raw chunks store no counts: every raw point is one sample
+            counts = _unpack(counts, 'I') if counts is not None else [1] * len(offsets)
+            points.extend((base + o, v, c) for o, v, c in zip(offsets, sums, counts) if start <= base + o < end)
+        if not resolution:
+            points.sort()
+            return points
+
+        buckets = {}
+        for ts, total, count in points:
+            bucket = buckets.setdefault(int(ts) - int(ts) % resolution, [0.0, 0])
+            bucket[0] += total
+            bucket[1] += count
+        return [(ts, total, count) for ts, (total, count) in sorted(buckets.items())]
+
+store = TimeSeriesStore()
+
+
+def init_timeseries(app):
+    """Point the store at TELEMETRY_DB (default: telemetry.sqlite in the instance folder)"""
+    if store.path is None:
+        store.path = os.getenv('TELEMETRY_DB', os.path.join(app.instance_path, 'telemetry.sqlite'))
+    return store
+
+
+def record(series, value, device_id=None, ts=None):
+    """Record a point; telemetry must never break the request that produced it"""
+    try:
+        store.record(series, value, device_id=device_id, ts=ts)
+    except Exception as e:
+        print(f"⚠️ Telemetry record failed: {e}")